@@ -15,6 +15,18 @@ echo "Applying migrations..."
 python manage.py makemigrations
 python manage.py migrate
 
-# 4. Start Gunicorn (The main process that keeps the container alive)
+# 4. Start the torrent daemon (owns the libtorrent session and every pipeline;
+#    calibrates the encoder in the background on first boot). Restarted if it
+#    dies, so a crash costs a few seconds of 503s instead of the container
+echo "Starting torrentd..."
+(
+    while true; do
+        python manage.py torrentd
+        echo "torrentd exited with status $?, restarting in 2s..."
+        sleep 2
+    done
+) &
+
+# 5. Start Gunicorn (The main process that keeps the container alive)
 echo "Starting Gunicorn..."
 exec gunicorn --bind 0.0.0.0:8000 torrent.wsgi --timeout 300 --reload
@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRESET = "superfast"
+DEFAULT_THREADS = 2
+
+# Slowest (best quality per bit) first: calibration keeps the first that holds realtime
+CALIBRATION_PRESETS = ("faster", "veryfast", "superfast", "ultrafast")
+CALIBRATION_THREADS = (1, 2, 4, 8)
+# Encoders must beat realtime by this factor to leave room for decode, I/O and other titles
+REALTIME_MARGIN = 1.2
+
+_cached = None
+_cached_lock = threading.Lock()
+
+
+def calibration_path():
+    return os.getenv("ENCODER_CALIBRATION_FILE") or os.path.join(settings.MEDIA_ROOT, ".encoder_calibration.json")
+
+
+def load_calibration():
+    """The persisted calibration result, or None if this node was never calibrated."""
+    global _cached
+    with _cached_lock:
+        if _cached is None:
+            try:
+                with open(calibration_path()) as f:
+                    _cached = json.load(f)
+            except (OSError, ValueError):
+                _cached = {}
+        return _cached or None
+
+
+def encoder_settings():
+    """
+    Preset, threads per ffmpeg and slot count for this node.
+    FFMPEG_PRESET / FFMPEG_THREADS / FFMPEG_SLOTS override the calibration,
+    which overrides the built-in defaults.
+    """
+    calibrated = load_calibration() or {}
+    threads = max(1, int(os.getenv("FFMPEG_THREADS") or calibrated.get("threads") or DEFAULT_THREADS))
+    if os.getenv("FFMPEG_SLOTS"):
+        slots = int(os.getenv("FFMPEG_SLOTS"))
+    elif os.getenv("FFMPEG_THREADS") or not calibrated.get("slots"):
+        # One ffmpeg slot per `threads` cores
+        slots = (os.cpu_count() or 2) // threads
+    else:
+        slots = calibrated["slots"]
+    return {
+        "preset": os.getenv("FFMPEG_PRESET") or calibrated.get("preset") or DEFAULT_PRESET,
+        "threads": threads,
+        "slots": max(1, slots),
+    }
+
+
+def measure(preset, threads, streams, seconds):
+    """
+    Encode `seconds` of a synthetic 1080p clip through the full rendition
+    ladder, `streams` ffmpegs at once. Returns the slowest realtime factor.
+    """
+    from .services import RENDITIONS, VideoService, ladder_filter
+
+    service = VideoService()
+    service.ffmpeg_preset = preset
+    service.ffmpeg_threads = threads
+    filter_complex, labels = ladder_filter(RENDITIONS)
+    cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin',
+        '-threads', str(threads),
+        '-f', 'lavfi', '-i', f'testsrc2=size=1920x1080:rate=24:duration={seconds}',
+        '-filter_complex', filter_complex,
+    ]
+    for (_, _, bitrate, bufsize), label in zip(RENDITIONS, labels):
+        cmd.extend(['-map', label] + service.video_encode_args(bitrate, bufsize, service.segment_duration))
+        cmd.extend(['-f', 'null', '-'])
+
+    started = time.time()
+    procs = [subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE) for _ in range(streams)]
+    elapsed = []
+    for proc in procs:
+        _, err = proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(f"calibration encode failed: {err.decode(errors='replace').strip()}")
+        elapsed.append(time.time() - started)
+    return seconds / max(elapsed)
+
+
+def calibrate(streams=1, seconds=5, log=logger.info):
+    """
+    Find the cheapest setting whose slots all hold realtime at once: the
+    fewest threads per encoder (the most slots for the CPU, at least
+    `streams`), and among those the slowest preset (the best quality per
+    bit) that holds. Each setting is measured with every slot it would
+    get busy. The result is written to calibration_path() and returned.
+    """
+    global _cached
+    cpus = os.cpu_count() or 2
+    results = []
+    chosen = None
+    for threads in CALIBRATION_THREADS:
+        slots = cpus // threads
+        if threads > cpus or slots < streams:
+            continue
+        for preset in CALIBRATION_PRESETS:
+            factor = measure(preset, threads, slots, seconds)
+            results.append({"preset": preset, "threads": threads, "slots": slots, "realtime_factor": round(factor, 2)})
+            log(f"{preset:>10} threads={threads} x{slots}: {factor:.2f}x realtime")
+            if factor >= REALTIME_MARGIN:
+                chosen = results[-1]
+                break
+        if chosen:
+            break
+
+    if not results:
+        raise ValueError(f"{cpus} cores cannot run {streams} concurrent encoders")
+    if chosen is None:
+        # Nothing holds realtime: the fastest measured setting is the least bad
+        chosen = max(results, key=lambda r: r["realtime_factor"])
+        log(f"No setting holds {REALTIME_MARGIN}x realtime on all its slots; using the fastest")
+
+    data = {
+        **chosen,
+        "streams": streams,
+        "cpu_count": cpus,
+        "calibrated_at": time.time(),
+        "results": results,
+    }
+    path = calibration_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(path + ".tmp", path)
+    with _cached_lock:
+        _cached = data
+    return data
+
+
+def schedule_calibration(streams=1, seconds=5):
+    """
+    Calibrate an uncalibrated node in a background thread, so the first boot
+    is not held up by the sweep. Transcodes run on the default settings
+    meanwhile; the scheduler is resized once the result is in, and new
+    pipelines pick up the preset and thread count.
+    """
+    if load_calibration():
+        return None
+
+    def run():
+        try:
+            calibrate(streams=streams, seconds=seconds)
+        except (ValueError, RuntimeError, OSError) as e:
+            logger.warning(f"Encoder calibration failed, keeping the defaults: {e}")
+            return
+        from .scheduler import transcode_scheduler
+
+        transcode_scheduler.resize(encoder_settings()["slots"])
+
+    thread = threading.Thread(target=run, name="encoder-calibration", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,433 @@
+import logging
+import os
+import struct
+
+from .media_index import INDEXED_EXTENSIONS
+
+logger = logging.getLogger(__name__)
+
+MATROSKA_EXTENSIONS = (".mkv", ".webm")
+
+# Matroska element IDs (marker bits included)
+EBML_HEADER = 0x1A45DFA3
+SEGMENT = 0x18538067
+SEEK_HEAD = 0x114D9B74
+SEEK = 0x4DBB
+SEEK_ID = 0x53AB
+SEEK_POSITION = 0x53AC
+CUES = 0x1C53BB6B
+CLUSTER = 0x1F43B675
+INFO = 0x1549A966
+TIMESTAMP_SCALE = 0x2AD7B1
+TRACKS = 0x1654AE6B
+TRACK_ENTRY = 0xAE
+TRACK_NUMBER = 0xD7
+TRACK_TYPE = 0x83
+CUE_POINT = 0xBB
+CUE_TIME = 0xB3
+CUE_TRACK_POSITIONS = 0xB7
+CUE_TRACK = 0xF7
+CUE_CLUSTER_POSITION = 0xF1
+
+# MP4 boxes whose body is a list of boxes (on the way to a track's sample tables)
+MP4_CONTAINER_BOXES = (b"trak", b"mdia", b"minf", b"stbl", b"edts")
+
+# Top-level boxes/elements walked before giving up on a malformed file
+MAX_ELEMENTS = 64
+
+
+def _vint(data, pos, keep_marker=False):
+    """EBML variable-length integer at data[pos]: (value, length). Size values of all ones mean unknown (None)."""
+    first = data[pos]
+    length = 1
+    while length <= 8 and not first & (0x80 >> (length - 1)):
+        length += 1
+    if length > 8 or pos + length > len(data):
+        raise ValueError("bad EBML integer")
+    value = first if keep_marker else first & (0xFF >> length)
+    for b in data[pos + 1:pos + length]:
+        value = (value << 8) | b
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return None, length
+    return value, length
+
+
+def _element(data, pos=0):
+    """EBML element header at data[pos]: (id, size, header length)."""
+    element_id, id_len = _vint(data, pos, keep_marker=True)
+    size, size_len = _vint(data, pos + id_len)
+    return element_id, size, id_len + size_len
+
+
+def _children(body):
+    """(id, payload) of each element in an EBML master element's body."""
+    pos = 0
+    while pos < len(body):
+        element_id, size, length = _element(body, pos)
+        if size is None:
+            raise ValueError("unknown-size element in index")
+        yield element_id, body[pos + length:pos + length + size]
+        pos += length + size
+
+
+def _uint(value):
+    return int.from_bytes(value, "big")
+
+
+def _mp4_boxes(data, pos=0, end=None):
+    """(type, body start, body end) of each box in data[pos:end]."""
+    end = len(data) if end is None else end
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from(">I4s", data, pos)
+        header = 8
+        if size == 1:
+            size, header = struct.unpack_from(">Q", data, pos + 8)[0], 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise ValueError(f"bad {box_type!r} box")
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def _mp4_table(box, fmt):
+    """Entries of a full box laid out as version/flags, entry count, entries."""
+    count = struct.unpack_from(">I", box, 4)[0]
+    return list(struct.iter_unpack(fmt, box[8:8 + count * struct.calcsize(fmt)]))
+
+
+def _runs(entries):
+    for count, value in entries:
+        for _ in range(count):
+            yield value
+
+
+def _track_tables(data, start, end, tables):
+    for box_type, body, box_end in _mp4_boxes(data, start, end):
+        if box_type in MP4_CONTAINER_BOXES:
+            _track_tables(data, body, box_end, tables)
+        else:
+            tables.setdefault(box_type, data[body:box_end])
+    return tables
+
+
+def _sample_keyframes(tables):
+    """(pts seconds, byte offset) of the sync samples described by a track's sample tables."""
+    mdhd = tables[b"mdhd"]
+    timescale = struct.unpack_from(">I", mdhd, 20 if mdhd[0] == 1 else 12)[0]
+    if not timescale:
+        raise ValueError("zero timescale")
+    sample_size, sample_count = struct.unpack_from(">II", tables[b"stsz"], 4)
+    if sample_size:
+        sizes = [sample_size] * sample_count
+    else:
+        sizes = [size for size, in struct.iter_unpack(">I", tables[b"stsz"][12:12 + 4 * sample_count])]
+    if b"co64" in tables:
+        chunks = [offset for offset, in _mp4_table(tables[b"co64"], ">Q")]
+    else:
+        chunks = [offset for offset, in _mp4_table(tables[b"stco"], ">I")]
+    stsc = _mp4_table(tables[b"stsc"], ">III")
+    sync = {n for n, in _mp4_table(tables[b"stss"], ">I")} if b"stss" in tables else None
+    deltas = _runs(_mp4_table(tables[b"stts"], ">II"))
+    # Composition offsets are read signed whatever the box version, as ffmpeg does
+    offsets = _runs(_mp4_table(tables[b"ctts"], ">Ii")) if b"ctts" in tables else iter(())
+    # The first edit's media time is where presentation starts (the B-frame delay)
+    shift = 0
+    if b"elst" in tables:
+        elst = tables[b"elst"]
+        fmt = ">Qq" if elst[0] == 1 else ">Ii"
+        edits = _mp4_table(elst, fmt + "I")
+        shift = next((media_time for _, media_time, _ in edits if media_time >= 0), 0)
+
+    keyframes = []
+    sample, dts, entry = 1, 0, 0
+    for chunk, pos in enumerate(chunks, 1):
+        while entry + 1 < len(stsc) and stsc[entry + 1][0] <= chunk:
+            entry += 1
+        for _ in range(stsc[entry][1] if stsc else 0):
+            if sample > len(sizes):
+                break
+            offset = next(offsets, 0)
+            if sync is None or sample in sync:
+                keyframes.append(((dts + offset - shift) / timescale, pos))
+            pos += sizes[sample - 1]
+            dts += next(deltas, 0)
+            sample += 1
+    return keyframes
+
+
+def _mp4_keyframes(f, size):
+    pos = 0
+    for _ in range(MAX_ELEMENTS):
+        f.seek(pos)
+        header = f.read(16)
+        if len(header) < 8:
+            break
+        box_size, box_type = struct.unpack(">I4s", header[:8])
+        if box_size == 1:
+            box_size = struct.unpack(">Q", header[8:16])[0]
+        elif box_size == 0:
+            box_size = size - pos
+        if box_size < 8:
+            break
+        if box_type == b"moov":
+            f.seek(pos)
+            moov = f.read(box_size)
+            for box_type, body, end in _mp4_boxes(moov, 16 if header[:4] == b"\0\0\0\1" else 8):
+                if box_type != b"trak":
+                    continue
+                tables = _track_tables(moov, body, end, {})
+                # hdlr: version/flags, pre_defined, then the handler type
+                if tables.get(b"hdlr", b"")[8:12] == b"vide":
+                    return _sample_keyframes(tables)
+            raise ValueError("no video track in moov")
+        pos += box_size
+    raise ValueError("no moov box")
+
+
+def _mkv_keyframes(f):
+    def read(pos, length):
+        f.seek(pos)
+        return f.read(length)
+
+    element_id, size, length = _element(read(0, ContainerLayout.HEADER_READ))
+    if element_id != EBML_HEADER or size is None:
+        raise ValueError("not a Matroska file")
+    pos = length + size
+    element_id, _, length = _element(read(pos, ContainerLayout.HEADER_READ))
+    if element_id != SEGMENT:
+        raise ValueError("no Matroska segment")
+    segment_data = pos = pos + length
+
+    # Level-1 elements up to the first cluster, plus whatever the SeekHead points past them
+    found = {}
+    for _ in range(MAX_ELEMENTS):
+        header = read(pos, ContainerLayout.HEADER_READ)
+        if len(header) < 2:
+            break
+        element_id, size, length = _element(header)
+        if element_id == CLUSTER or size is None:
+            break
+        if element_id == SEEK_HEAD:
+            body = read(pos + length, size)
+            for target in (INFO, TRACKS, CUES):
+                seek = ContainerLayout._seek_position(body, target)
+                if seek is not None:
+                    found.setdefault(target, segment_data + seek)
+        elif element_id in (INFO, TRACKS, CUES):
+            found[element_id] = pos
+        pos += length + size
+
+    def body(target):
+        if target not in found:
+            raise ValueError(f"no element {target:#x}")
+        element_id, size, length = _element(read(found[target], ContainerLayout.HEADER_READ))
+        if element_id != target or size is None:
+            raise ValueError(f"element {target:#x} not where the SeekHead says")
+        return read(found[target] + length, size)
+
+    scale = 1000000
+    if INFO in found:
+        scale = next((_uint(value) for child, value in _children(body(INFO)) if child == TIMESTAMP_SCALE), scale)
+    video = None
+    for child, entry in _children(body(TRACKS)):
+        fields = dict(_children(entry)) if child == TRACK_ENTRY else {}
+        if _uint(fields.get(TRACK_TYPE, b"")) == 1:
+            video = _uint(fields.get(TRACK_NUMBER, b""))
+            break
+    if video is None:
+        raise ValueError("no video track")
+
+    keyframes = []
+    for child, point in _children(body(CUES)):
+        if child != CUE_POINT:
+            continue
+        fields = list(_children(point))
+        cue_time = next((_uint(value) for field, value in fields if field == CUE_TIME), None)
+        for field, value in fields:
+            if field != CUE_TRACK_POSITIONS or cue_time is None:
+                continue
+            positions = dict(_children(value))
+            if _uint(positions.get(CUE_TRACK, b"")) == video and CUE_CLUSTER_POSITION in positions:
+                # The cluster holding the keyframe: reading from there decodes it
+                keyframes.append((cue_time * scale / 1e9, segment_data + _uint(positions[CUE_CLUSTER_POSITION])))
+    return keyframes
+
+
+def read_keyframes(path):
+    """
+    (pts seconds, byte offset) of the video keyframes, straight from the
+    container's own index: the MP4 sample tables (stss, stts, ctts, stsc,
+    stsz, stco) or the Matroska Cues. None for other containers. The index
+    must be on disk; a malformed or missing one raises ValueError.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    try:
+        with open(path, "rb") as f:
+            if ext in INDEXED_EXTENSIONS:
+                return _mp4_keyframes(f, os.fstat(f.fileno()).st_size)
+            if ext in MATROSKA_EXTENSIONS:
+                return _mkv_keyframes(f)
+    except (KeyError, IndexError, struct.error) as e:
+        raise ValueError(f"unreadable container index: {e!r}")
+    return None
+
+
+class ContainerLayout:
+    """
+    Where a partially downloaded file keeps its index: the MP4 moov box or
+    the Matroska Cues. The container structure is walked as the bytes it
+    needs arrive, since a muxer may have put the index at the end of the
+    file, far ahead of sequential download.
+
+    advance() returns the byte range the walk is waiting on. The pipeline
+    raises priority on it, and on every range in `ranges` once found.
+    `blocking` is set for containers ffprobe cannot open without their
+    index (MP4).
+    """
+
+    HEADER_READ = 16
+
+    def __init__(self, source, path):
+        self.source = source
+        self.path = path
+        self.size = source.size
+        self.ranges = []
+        ext = os.path.splitext(path)[1].lower()
+        if ext in INDEXED_EXTENSIONS:
+            self.kind, self.blocking, walk = "mp4", True, self._walk_mp4()
+        elif ext in MATROSKA_EXTENSIONS:
+            self.kind, self.blocking, walk = "mkv", False, self._walk_mkv()
+        else:
+            self.kind, self.blocking, walk = None, False, None
+        self._walk = walk
+        self._want = next(walk) if walk else None
+
+    @property
+    def done(self):
+        return self._want is None
+
+    def tail_hint(self):
+        """Bytes worth fetching before the walk asks for them: MP4 indexes usually sit at the end."""
+        if self.kind != "mp4":
+            return None
+        return max(0, self.size - self.source.piece_length), self.size
+
+    def ready(self):
+        """True once the index is found and verified, or the container does not need one to open."""
+        if not self.blocking:
+            return True
+        return self.index_on_disk()
+
+    def index_on_disk(self):
+        """True once the located index (moov or Cues) is verified and can be read in full."""
+        return self.done and bool(self.ranges) and all(self.source.have_range(start, end) for start, end in self.ranges)
+
+    def advance(self):
+        """Feed the walk every range already on disk. Returns the (start, end) it waits on, or None when done."""
+        while self._want is not None:
+            start, length = self._want
+            end = min(start + length, self.size)
+            if start >= self.size:
+                self._finish()
+                break
+            if not self.source.have_range(start, end):
+                return start, end
+            try:
+                with open(self.path, "rb") as f:
+                    f.seek(start)
+                    data = f.read(end - start)
+                self._want = self._walk.send(data)
+            except StopIteration:
+                self._want = None
+            except Exception as e:
+                logger.warning(f"Container walk stopped for {self.path}: {e}")
+                self._finish()
+        return None
+
+    def _finish(self):
+        self._want = None
+        # Without a located index the probe simply reads what it can
+        if not self.ranges:
+            self.blocking = False
+
+    def _walk_mp4(self):
+        pos = 0
+        for _ in range(MAX_ELEMENTS):
+            header = yield (pos, self.HEADER_READ)
+            if len(header) < 8:
+                break
+            size, box_type = struct.unpack(">I4s", header[:8])
+            if size == 1:
+                size = struct.unpack(">Q", header[8:16])[0]
+            elif size == 0:
+                size = self.size - pos
+            if size < 8:
+                break
+            if box_type == b"moov":
+                self.ranges.append((pos, min(pos + size, self.size)))
+                return
+            pos += size
+            if pos >= self.size:
+                break
+        self._finish()
+
+    def _walk_mkv(self):
+        header = yield (0, self.HEADER_READ)
+        element_id, size, length = _element(header)
+        if element_id != EBML_HEADER or size is None:
+            return self._finish()
+        pos = length + size
+
+        header = yield (pos, self.HEADER_READ)
+        element_id, _, length = _element(header)
+        if element_id != SEGMENT:
+            return self._finish()
+        segment_data = pos + length
+
+        pos = segment_data
+        for _ in range(MAX_ELEMENTS):
+            header = yield (pos, self.HEADER_READ)
+            element_id, size, length = _element(header)
+            if element_id == CUES and size is not None:
+                self.ranges.append((pos, pos + length + size))
+                return
+            if element_id == SEEK_HEAD and size is not None:
+                body = yield (pos + length, size)
+                cues = self._seek_position(body, CUES)
+                if cues is not None:
+                    pos = segment_data + cues
+                    header = yield (pos, self.HEADER_READ)
+                    element_id, size, length = _element(header)
+                    if element_id == CUES and size is not None:
+                        self.ranges.append((pos, pos + length + size))
+                    return self._finish()
+            # Clusters are the media itself: walking them would mean downloading the film
+            if element_id == CLUSTER or size is None:
+                break
+            pos += length + size
+        self._finish()
+
+    @staticmethod
+    def _seek_position(body, target):
+        """SeekPosition of the target element in a SeekHead body, relative to the segment data."""
+        pos = 0
+        while pos < len(body):
+            element_id, size, length = _element(body, pos)
+            if size is None:
+                return None
+            if element_id == SEEK:
+                seek_id = seek_pos = None
+                inner, end = pos + length, pos + length + size
+                while inner < end:
+                    child_id, child_size, child_len = _element(body, inner)
+                    value = body[inner + child_len:inner + child_len + child_size]
+                    if child_id == SEEK_ID:
+                        seek_id = int.from_bytes(value, "big")
+                    elif child_id == SEEK_POSITION:
+                        seek_pos = int.from_bytes(value, "big")
+                    inner += child_len + child_size
+                if seek_id == target and seek_pos is not None:
+                    return seek_pos
+            pos += length + size
+        return None
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+
+from .ladder import rendition_demand
+from .load import load_governor
+from .metrics import metrics_registry
+from .models import MovieFile
+from .snapshots import status_registry
+from .tracing import PIPELINE_PROFILER, sample_stacks, timelines
+from .torrentd import TorrentdClient
+
+# "daemon": web workers forward to torrentd over TORRENTD_SOCKET
+# "embedded": this process owns the libtorrent session (single-process dev setups)
+TORRENT_BACKEND = os.getenv("TORRENT_BACKEND", "daemon")
+TORRENTD_SOCKET = os.getenv("TORRENTD_SOCKET", "/tmp/torrentd.sock")
+
+
+class LocalEngine:
+    """
+    Torrents and pipelines running in this process, keyed by info-hash.
+    torrentd serves this API over its socket; in embedded mode the web
+    views call it directly.
+    """
+
+    def __init__(self):
+        from .pipeline import start_torrent_engine
+
+        start_torrent_engine()
+        self._lock = threading.Lock()
+        self._movies = {}
+
+    def _movie_id(self, movie_id=None, info_hash=None):
+        if movie_id is not None:
+            return int(movie_id)
+        return self._movies.get(info_hash)
+
+    def add(self, movie_id):
+        """Start the movie's pipeline unless it is already running. Returns its info-hash."""
+        from .pipeline import process_video_thread, torrent_supervisor
+
+        started = not torrent_supervisor.is_active(int(movie_id))
+        pipeline = process_video_thread(int(movie_id), wait=False)
+        # An already running pipeline published its info-hash when it started
+        info_hash = pipeline.info_hash or (status_registry.get(movie_id) or {}).get("info_hash")
+        if info_hash:
+            with self._lock:
+                self._movies[info_hash] = int(movie_id)
+        return {"info_hash": info_hash, "started": started}
+
+    def status(self, movie_id=None, info_hash=None):
+        """Whether a pipeline runs for the movie, and its latest status snapshot (None if unknown)."""
+        from .pipeline import torrent_supervisor
+
+        movie_id = self._movie_id(movie_id, info_hash)
+        if movie_id is None:
+            return {"active": False, "snapshot": None}
+        return {"active": torrent_supervisor.is_active(movie_id), "snapshot": status_registry.get(movie_id)}
+
+    def prioritize(self, movie_id, segment, wait, res=None):
+        """JIT: transcode a segment (and its lookahead) in `res` now; True once it is on disk within wait seconds."""
+        from .pipeline import request_jit_segment
+
+        started = time.time()
+        movie = MovieFile.objects.get(id=movie_id)
+        if not movie.duration or not movie.file_path:
+            return False
+        future = request_jit_segment(movie, int(segment), res=res, wait=wait)
+        if future is None:
+            return False
+        try:
+            return bool(future.result(timeout=max(0, wait - (time.time() - started))))
+        except Exception:
+            return False
+
+    def remove(self, info_hash):
+        from .pipeline import torrent_manager
+
+        torrent_manager.remove_torrent(info_hash)
+        with self._lock:
+            movie_id = self._movies.pop(info_hash, None)
+        if movie_id is not None:
+            status_registry.drop(movie_id)
+        return True
+
+    def demand(self, movie_id, res):
+        rendition_demand.record(movie_id, res)
+        return True
+
+    def stats(self):
+        from .pipeline import torrent_supervisor
+        from .scheduler import transcode_scheduler
+
+        return {
+            **transcode_scheduler.stats(),
+            **torrent_supervisor.stats(),
+            "headroom": transcode_scheduler.has_headroom(),
+            "ladder": load_governor.stats(),
+        }
+
+    def metrics(self):
+        """Pipeline, swarm and transcode metrics in the Prometheus text format."""
+        return metrics_registry.render()
+
+    def timeline(self, movie_id=None):
+        """The movie's latest pipeline timeline (None if unknown), or summaries of all recent ones."""
+        if movie_id is None:
+            return timelines.recent()
+        return timelines.get(int(movie_id))
+
+    def profile(self, seconds, movie_id=None):
+        """
+        Collapsed Python stacks sampled for `seconds`: every thread, or only
+        the ones working for movie_id. None unless PIPELINE_PROFILER=1.
+        """
+        if not PIPELINE_PROFILER:
+            return None
+        if movie_id is None:
+            return sample_stacks(float(seconds))
+        from .scheduler import transcode_scheduler
+
+        movie_id = int(movie_id)
+        own_threads = ("torrent-supervisor", "progress-writer", f"finalize-{movie_id}")
+        return sample_stacks(
+            float(seconds),
+            lambda ident, name: name in own_threads or ident in transcode_scheduler.threads_running(movie_id),
+        )
+
+    def ping(self):
+        return "pong"
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """The engine the web views talk to, created on first use."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = LocalEngine() if TORRENT_BACKEND == "embedded" else TorrentdClient(TORRENTD_SOCKET)
+    return _engine
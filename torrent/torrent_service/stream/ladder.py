@@ -0,0 +1,200 @@
+import json
+import os
+import threading
+import time
+
+from django.conf import settings
+
+from .load import load_governor
+from .services import AUDIO_RENDITION, RENDITIONS, RESOLUTIONS, fit_rendition
+
+# "full": encode every rendition for every segment
+# "lazy": start from BASE_RENDITION, add renditions players ask for
+LADDER_MODE = os.getenv("LADDER_MODE", "full")
+BASE_RENDITION = os.getenv("BASE_RENDITION", "480p")
+# Seconds a playlist/segment request keeps a rendition in the active set
+DEMAND_TTL = int(os.getenv("LADDER_DEMAND_TTL", "600"))
+
+# Stream-copy the top rendition when the source is already browser-ready H.264
+PASSTHROUGH = os.getenv("LADDER_PASSTHROUGH", "1") == "1"
+PASSTHROUGH_MAX_LEVEL = int(os.getenv("PASSTHROUGH_MAX_LEVEL", "42"))
+PASSTHROUGH_PROFILES = {"constrained baseline", "baseline", "main", "high"}
+PASSTHROUGH_PIX_FMTS = {"yuv420p", "yuvj420p"}
+
+# Package audio once as a shared HLS audio group instead of muxing it into every rendition
+AUDIO_GROUP = os.getenv("HLS_AUDIO_GROUP", "1") == "1"
+# Stream-copy source audio into the group when it is already browser-safe AAC
+AUDIO_PASSTHROUGH = os.getenv("AUDIO_PASSTHROUGH", "1") == "1"
+
+
+class SourceLadder:
+    """
+    Renditions worth producing for one source. Rungs above the source
+    resolution are dropped, and the rung matching the source can be
+    stream-copied instead of re-encoded. Persisted as ladder.json in the
+    movie directory so the web tier can build the master playlist from it.
+    """
+
+    FILE = "ladder.json"
+
+    def __init__(self, renditions=None, copy=None, bandwidth=None, dims=None, audio=None):
+        self.renditions = [r for r in RESOLUTIONS if r in (renditions or RESOLUTIONS)]
+        self.copy = copy if copy in self.renditions else None
+        self.bandwidth = bandwidth or {}
+        self.dims = dims or {}
+        # None: audio muxed into each rendition; "aac"/"copy": shared audio group
+        self.audio = audio if audio in ("aac", "copy") else None
+
+    @staticmethod
+    def copyable(info):
+        codec = (info.get("codec_name") or "").lower()
+        profile = (info.get("profile") or "").lower()
+        pix_fmt = (info.get("pix_fmt") or "").lower()
+        level = info.get("level") or 0
+        return (
+            codec == "h264"
+            and profile in PASSTHROUGH_PROFILES
+            and pix_fmt in PASSTHROUGH_PIX_FMTS
+            and 0 < level <= PASSTHROUGH_MAX_LEVEL
+        )
+
+    @staticmethod
+    def audio_mode(info):
+        """How the shared audio group is produced: None (no group), "copy" or "aac"."""
+        if not AUDIO_GROUP:
+            return None
+        audio = (info or {}).get("audio")
+        if not audio:
+            return None
+        if AUDIO_PASSTHROUGH and (audio.get("codec_name") or "").lower() == "aac" and 0 < (audio.get("channels") or 0) <= 2:
+            return "copy"
+        return "aac"
+
+    @classmethod
+    def from_source(cls, info):
+        """Build the ladder from VideoService.probe_source output (full ladder when unknown)."""
+        if not info or not info.get("height"):
+            return cls(audio=cls.audio_mode(info))
+        width, height = info.get("width") or 0, info["height"]
+        # Widescreen sources are classed by width too: 1920x800 is a 1080p source
+        effective = max(height, width * 9 // 16)
+
+        renditions = [name for name, rung, _, _ in RENDITIONS if rung <= effective * 1.05]
+        if not renditions:
+            renditions = [RESOLUTIONS[-1]]
+
+        top_name, top_height = next((name, rung) for name, rung, _, _ in RENDITIONS if name == renditions[0])
+        copy = None
+        bandwidth = {}
+        dims = {}
+        if PASSTHROUGH and abs(effective - top_height) <= top_height * 0.05 and cls.copyable(info):
+            copy = top_name
+            dims[copy] = f"{width}x{height}"
+            if info.get("bit_rate"):
+                bandwidth[copy] = int(int(info["bit_rate"]) * 1.1)
+        if width:
+            # Encoded rungs keep the source aspect ratio inside their 16:9 box
+            for name, rung, _, _ in RENDITIONS:
+                if name in renditions and name != copy:
+                    dims[name] = "x".join(map(str, fit_rendition(width, height, rung)))
+        return cls(renditions, copy, bandwidth, dims, cls.audio_mode(info))
+
+    @classmethod
+    def load(cls, movie_dir):
+        """The persisted ladder, or None if the pipeline has not probed the source yet."""
+        try:
+            with open(os.path.join(movie_dir, cls.FILE)) as f:
+                return cls(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def save(self, movie_dir):
+        path = os.path.join(movie_dir, self.FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump({
+                "renditions": self.renditions,
+                "copy": self.copy,
+                "bandwidth": self.bandwidth,
+                "dims": self.dims,
+                "audio": self.audio,
+            }, f)
+        os.replace(path + ".tmp", path)
+
+
+_ladders = {}
+_ladders_lock = threading.Lock()
+
+
+def set_source_ladder(movie_id, ladder):
+    with _ladders_lock:
+        _ladders[int(movie_id)] = ladder
+
+
+def source_ladder(movie_id):
+    """The movie's ladder, loaded from ladder.json on first use in this process."""
+    ladder = _ladders.get(int(movie_id))
+    if ladder is None:
+        ladder = SourceLadder.load(os.path.join(settings.MEDIA_ROOT, "movies", str(movie_id)))
+        if ladder is None:
+            return SourceLadder()
+        set_source_ladder(movie_id, ladder)
+    return ladder
+
+
+class RenditionDemand:
+    """Last time players asked for each rendition of each movie."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen = {}
+
+    def record(self, movie_id, res):
+        # The audio group is always produced, only video rungs are demand-driven
+        if res not in RESOLUTIONS:
+            return
+        with self._lock:
+            self._seen.setdefault(int(movie_id), {})[res] = time.time()
+
+    def demanded(self, movie_id):
+        cutoff = time.time() - DEMAND_TTL
+        with self._lock:
+            seen = self._seen.get(int(movie_id), {})
+            return {res for res, at in seen.items() if at >= cutoff}
+
+    def forget(self, movie_id):
+        with self._lock:
+            self._seen.pop(int(movie_id), None)
+
+
+rendition_demand = RenditionDemand()
+
+
+def _with_audio(ladder, renditions):
+    return renditions + [AUDIO_RENDITION] if ladder.audio else renditions
+
+
+def base_renditions(movie_id):
+    """Renditions every segment gets, whatever the demand (plus the audio group)."""
+    ladder = source_ladder(movie_id)
+    available = ladder.renditions
+    if LADDER_MODE != "lazy":
+        return _with_audio(ladder, list(available))
+    if BASE_RENDITION in available:
+        return _with_audio(ladder, [BASE_RENDITION])
+    # Source below the base rung: use the best rung it has
+    return _with_audio(ladder, [available[0]])
+
+
+def active_renditions(movie_id):
+    """Renditions to encode for new segments of a movie, in ladder order, minus the rungs shed under load."""
+    ladder = source_ladder(movie_id)
+    wanted = set(base_renditions(movie_id)) | rendition_demand.demanded(movie_id)
+    video = [res for res in ladder.renditions if res in wanted]
+    return _with_audio(ladder, load_governor.allowed(video, keep=ladder.copy, movie_id=int(movie_id)))
+
+
+def packaged_renditions(movie_id):
+    """Renditions the stream packager encodes: the base set minus the rungs shed under load."""
+    ladder = source_ladder(movie_id)
+    video = [res for res in base_renditions(movie_id) if res != AUDIO_RENDITION]
+    return _with_audio(ladder, load_governor.allowed(video, keep=ladder.copy, movie_id=int(movie_id)))
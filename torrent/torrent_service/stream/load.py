@@ -0,0 +1,158 @@
+import logging
+import os
+import threading
+import time
+
+from .metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+# Step the rendition ladder down when encodes stop keeping up with playback
+LOAD_ADAPTIVE = os.getenv("LOAD_ADAPTIVE", "1") == "1"
+# Predicted realtime factor of the current ladder below which its top rung is dropped
+LOAD_STEP_DOWN_FACTOR = float(os.getenv("LOAD_STEP_DOWN_FACTOR", "1.1"))
+# Predicted realtime factor of the fuller ladder above which a dropped rung returns
+LOAD_STEP_UP_FACTOR = float(os.getenv("LOAD_STEP_UP_FACTOR", "1.5"))
+# 1-minute load average per core above which the ladder steps down whatever the encoders report
+LOAD_MAX_PER_CPU = float(os.getenv("LOAD_MAX_PER_CPU", "1.5"))
+# Rungs that may be dropped from the top: 1080p, then 720p
+LOAD_MAX_SHED = int(os.getenv("LOAD_MAX_SHED", "2"))
+# Seconds between two steps, so the effect of one is measured before the next
+LOAD_STEP_INTERVAL = int(os.getenv("LOAD_STEP_INTERVAL", "30"))
+# A title's ladder counts towards the decision while it asked for renditions this recently
+LADDER_ACTIVE_SECONDS = 120
+
+
+def rendition_cost(height):
+    """Relative encode cost of a 16:9 rung: its pixel count."""
+    return height * height * 16 // 9
+
+
+def cpu_load():
+    """1-minute load average per core (0 where the platform has none)."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (OSError, AttributeError):
+        return 0.0
+
+
+class LoadGovernor:
+    """
+    Node-wide cap on the rendition ladder. Every segment encode reports its
+    realtime factor and the rungs it produced; factor times pixel cost is
+    the node's encode throughput under the current load, which predicts the
+    realtime factor of any other set of rungs. Predictions are made for the
+    costliest ladder titles are actually encoding (their source ladders,
+    as passed to allowed()), so a step only counts if it removes work.
+    When that ladder is predicted below LOAD_STEP_DOWN_FACTOR (or the CPU is
+    overloaded), the top rung is dropped for new segments; it comes back
+    once the fuller ladder is predicted above LOAD_STEP_UP_FACTOR. Dropped
+    segments are backfilled at low priority, and the master playlist only
+    advertises rungs that are being produced.
+    """
+
+    ALPHA = 0.3
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.shed = 0
+        self.throughput = None
+        self.changed_at = 0
+        # movie_id -> (wanted video renditions, passthrough rung, last asked)
+        self._ladders = {}
+
+    def record_encode(self, realtime, heights):
+        """One finished encode: its realtime factor and the heights of the rungs it produced."""
+        cost = sum(rendition_cost(h) for h in heights)
+        if not LOAD_ADAPTIVE or cost <= 0 or realtime <= 0:
+            return
+        with self._lock:
+            sample = realtime * cost
+            if self.throughput is None:
+                self.throughput = sample
+            else:
+                self.throughput += self.ALPHA * (sample - self.throughput)
+            self._step(time.time())
+
+    @staticmethod
+    def _cap(renditions, keep, shed):
+        from .services import RESOLUTIONS
+
+        dropped = set(RESOLUTIONS[:shed]) - {keep}
+        return [res for res in renditions if res not in dropped] or renditions[-1:]
+
+    def _cost(self, shed, now):
+        """Encode cost of the costliest ladder in use with `shed` rungs dropped (the copy rung is free)."""
+        from .services import RENDITIONS
+
+        heights = {name: height for name, height, _, _ in RENDITIONS}
+        costs = [
+            sum(rendition_cost(heights[res]) for res in self._cap(renditions, keep, shed) if res != keep)
+            for renditions, keep, asked in self._ladders.values()
+            if now - asked < LADDER_ACTIVE_SECONDS
+        ]
+        return max(costs, default=0)
+
+    def _step(self, now):
+        from .services import RESOLUTIONS
+
+        if now - self.changed_at < LOAD_STEP_INTERVAL:
+            return
+        current = self._cost(self.shed, now)
+        if not current:
+            return
+        max_shed = min(LOAD_MAX_SHED, len(RESOLUTIONS) - 1)
+        overloaded = cpu_load() > LOAD_MAX_PER_CPU
+        shed = self.shed
+        if shed < max_shed and (overloaded or self.throughput / current < LOAD_STEP_DOWN_FACTOR):
+            # The next step that removes work: dropping 1080p does nothing for 720p sources
+            shed = next((s for s in range(shed + 1, max_shed + 1) if self._cost(s, now) < current), shed)
+        elif shed > 0 and not overloaded:
+            fuller = next(((s, self._cost(s, now)) for s in range(shed - 1, -1, -1) if self._cost(s, now) > current), None)
+            if fuller and self.throughput / fuller[1] >= LOAD_STEP_UP_FACTOR:
+                shed = fuller[0]
+        if shed == self.shed:
+            return
+        logger.warning(
+            f"Encoders at {self.throughput / current:.2f}x realtime, load {cpu_load():.2f}/core: "
+            f"{'dropping' if shed > self.shed else 'restoring'} "
+            f"{','.join(RESOLUTIONS[min(shed, self.shed):max(shed, self.shed)])} for new segments"
+        )
+        self.shed = shed
+        self.changed_at = now
+
+    def allowed(self, renditions, keep=None, movie_id=None):
+        """
+        The renditions left once the shed rungs are dropped. `keep` (the
+        stream-copied rung, which costs next to nothing) is never dropped,
+        nor is the last remaining rung. With movie_id, the title's ladder
+        counts towards the next decisions.
+        """
+        if not LOAD_ADAPTIVE:
+            return renditions
+        with self._lock:
+            if movie_id is not None and renditions:
+                self._ladders[movie_id] = (list(renditions), keep, time.time())
+            shed = self.shed
+        return self._cap(renditions, keep, shed) if shed else renditions
+
+    def stats(self):
+        from .services import RESOLUTIONS
+
+        with self._lock:
+            cost = self._cost(self.shed, time.time())
+            return {
+                "adaptive": LOAD_ADAPTIVE,
+                "shed": RESOLUTIONS[:self.shed],
+                "predicted_realtime": round(self.throughput / cost, 2) if self.throughput and cost else None,
+                "cpu_load": round(cpu_load(), 2),
+            }
+
+
+load_governor = LoadGovernor()
+
+metrics_registry.gauge(
+    "hyperflix_ladder_shed_rungs",
+    "Top rungs of the rendition ladder dropped for new segments because encoding cannot keep up",
+    collect=lambda: [((), load_governor.shed)],
+)
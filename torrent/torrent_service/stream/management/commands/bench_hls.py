@@ -0,0 +1,193 @@
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext, setup_test_environment, teardown_test_environment
+
+from stream.engine import TORRENT_BACKEND, TORRENTD_SOCKET
+from stream.manifest import record_segment
+from stream.models import MovieFile
+from stream.services import RESOLUTIONS, VideoService
+
+
+def rw_syscall_counts():
+    """
+    (read, write) syscalls made by this process so far; Linux only, None elsewhere.
+    stat/open/getdents are not counted: run the command under `strace -c -f` for those.
+    """
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return int(fields["syscr"]), int(fields["syscw"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmarks the HLS endpoints (playlists, HEAD probe, segments, status) against '
+        'a synthetic media tree in a throwaway database. The "rw sysc" column counts read/write '
+        'syscalls per request only; run under `strace -c -f` to see stat/open/getdents'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--movies', type=int, default=20, help='Synthetic titles (half live, half finished)')
+        parser.add_argument('--segments', type=int, default=720, help='Segments per rendition (720 = 2h film)')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per scenario')
+        parser.add_argument('--concurrency', type=int, default=8, help='Client threads')
+        parser.add_argument('--scenario', action='append', help='Run only these scenarios (repeatable)')
+        parser.add_argument('--keepdb', action='store_true', help='Reuse the test database between runs')
+        parser.add_argument('--keep-media', action='store_true', help='Leave the synthetic media tree on disk')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, keepdb=options['keepdb'])
+        media_root = tempfile.mkdtemp(prefix='hls-bench-')
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                live, finished = self.build_fixtures(media_root, options['movies'], options['segments'])
+                self.stdout.write(
+                    f"Media tree: {len(live) + len(finished)} titles x {len(RESOLUTIONS)} renditions x "
+                    f"{options['segments']} segments in {media_root}"
+                )
+                # HEAD and status ask the engine first; with no daemon running they take the fallback path
+                backend = TORRENT_BACKEND if TORRENT_BACKEND == "embedded" else f"daemon at {TORRENTD_SOCKET}"
+                self.stdout.write(f"Torrent engine: {backend}")
+                scenarios = self.scenarios(live, finished, options['segments'])
+                selected = options['scenario'] or list(scenarios)
+                self.stdout.write(
+                    f"{'scenario':<12} {'req':>6} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+                    f"{'queries':>8} {'rw sysc':>9}  status"
+                )
+                for name in selected:
+                    self.report(name, self.run(scenarios[name], options['requests'], options['concurrency']))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+            if options['keep_media']:
+                self.stdout.write(f"Media tree kept in {media_root}")
+            else:
+                shutil.rmtree(media_root, ignore_errors=True)
+
+    def build_fixtures(self, media_root, movies, segments):
+        """Half the titles mid-download (journal only), half finished (static VOD playlists)."""
+        service = VideoService()
+        duration = segments * service.segment_duration
+        live, finished = [], []
+        for i in range(movies):
+            done = i % 2 == 1
+            movie = MovieFile.objects.create(
+                imdb_id=f"tt-bench-{i}",
+                magnet_link=f"magnet:?xt=urn:btih:{i:040x}",
+                file_path=f"movies/bench-{i}.mkv",
+                download_status="READY" if done else "DOWNLOADING",
+                download_progress=100 if done else 50,
+                duration=duration,
+            )
+            movie_dir = os.path.join(media_root, "movies", str(movie.id))
+            # Live titles are half transcoded
+            count = segments if done else segments // 2
+            for res in RESOLUTIONS:
+                res_dir = os.path.join(movie_dir, res)
+                os.makedirs(res_dir)
+                for idx in range(count):
+                    open(service.segment_path(movie_dir, res, idx), "wb").close()
+                    record_segment(res_dir, idx, float(service.segment_duration))
+            if done:
+                service.finalize_playlists(movie_dir, duration, RESOLUTIONS)
+                finished.append(movie.id)
+            else:
+                live.append(movie.id)
+        return live, finished
+
+    def scenarios(self, live, finished, segments):
+        """Request factories: each returns (method, path) for one request."""
+        everyone = live + finished
+
+        def segment():
+            return "get", (
+                f"/api/video/{random.choice(everyone)}/stream_ts/"
+                f"?file=segment_{random.randrange(segments // 2):03d}.ts&res={random.choice(RESOLUTIONS)}"
+            )
+
+        return {
+            "master": lambda: ("get", f"/api/video/{random.choice(everyone)}/playlist/"),
+            "media_live": lambda: ("get", f"/api/video/{random.choice(live)}/playlist/?res={random.choice(RESOLUTIONS)}"),
+            "media_vod": lambda: ("get", f"/api/video/{random.choice(finished)}/playlist/?res={random.choice(RESOLUTIONS)}"),
+            "head": lambda: ("head", f"/api/video/{random.choice(everyone)}/playlist/"),
+            "segment": segment,
+            "status": lambda: ("get", f"/api/video/{random.choice(everyone)}/status/"),
+        }
+
+    def run(self, make_request, total, concurrency):
+        latencies = []
+        queries = []
+        statuses = {}
+        lock = threading.Lock()
+
+        def worker(count):
+            client = Client()
+            mine, my_queries, my_statuses = [], [], {}
+            try:
+                for _ in range(count):
+                    method, path = make_request()
+                    with CaptureQueriesContext(connection) as ctx:
+                        started = time.perf_counter()
+                        response = getattr(client, method)(path)
+                        mine.append(time.perf_counter() - started)
+                    my_queries.append(len(ctx.captured_queries))
+                    my_statuses[response.status_code] = my_statuses.get(response.status_code, 0) + 1
+            finally:
+                connection.close()
+            with lock:
+                latencies.extend(mine)
+                queries.extend(my_queries)
+                for code, n in my_statuses.items():
+                    statuses[code] = statuses.get(code, 0) + n
+
+        shares = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+        threads = [threading.Thread(target=worker, args=(n,)) for n in shares if n]
+        syscalls_before = rw_syscall_counts()
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        syscalls_after = rw_syscall_counts()
+
+        syscalls = None
+        if syscalls_before and syscalls_after and latencies:
+            # Process-wide read/write syscalls (not stat/open), divided over the scenario's requests
+            syscalls = sum(syscalls_after) - sum(syscalls_before)
+            syscalls /= len(latencies)
+        return {
+            "requests": len(latencies),
+            "elapsed": elapsed,
+            "latencies": sorted(latencies),
+            "queries": statistics.mean(queries) if queries else 0,
+            "rw_syscalls": syscalls,
+            "statuses": statuses,
+        }
+
+    def report(self, name, result):
+        latencies = result["latencies"]
+        if not latencies:
+            self.stdout.write(f"{name:<12} no requests")
+            return
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+        rps = result["requests"] / result["elapsed"]
+        syscalls = f"{result['rw_syscalls']:.1f}" if result["rw_syscalls"] is not None else "n/a"
+        statuses = ",".join(f"{code}x{n}" for code, n in sorted(result["statuses"].items()))
+        self.stdout.write(
+            f"{name:<12} {result['requests']:>6} {rps:>8.0f} {p50:>8.2f} {p99:>8.2f} "
+            f"{result['queries']:>8.1f} {syscalls:>9}  {statuses}"
+        )
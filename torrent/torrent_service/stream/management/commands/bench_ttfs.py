@@ -0,0 +1,196 @@
+import os
+import shutil
+import statistics
+import subprocess
+import tempfile
+
+import libtorrent as lt
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from stream import pipeline
+from stream.models import MovieFile
+from stream.services import VideoService
+from stream.snapshots import status_registry
+from stream.tracing import timelines
+from stream.trackers import tracker_registry
+
+# Session settings that keep libtorrent on the loopback interface
+LOOPBACK_SETTINGS = {
+    'enable_dht': False,
+    'enable_lsd': False,
+    'enable_upnp': False,
+    'enable_natpmp': False,
+    'allow_multiple_connections_per_ip': True,
+}
+
+
+def make_video(path, seconds, height, faststart):
+    """Synthetic test pattern with a tone, encoded like a typical release."""
+    cmd = [
+        'ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size={height * 16 // 9}x{height}:rate=24:duration={seconds}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+        '-c:v', 'libx264', '-preset', 'veryfast', '-g', '96',
+        '-c:a', 'aac', '-b:a', '128k',
+        '-shortest',
+    ]
+    if faststart:
+        cmd.extend(['-movflags', '+faststart'])
+    cmd.append(path)
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+
+def make_torrent(path, piece_size):
+    """torrent_info for a single-file torrent of path (piece_size 0 lets libtorrent pick)."""
+    fs = lt.file_storage()
+    lt.add_files(fs, path)
+    creator = lt.create_torrent(fs, piece_size)
+    lt.set_piece_hashes(creator, os.path.dirname(path))
+    return lt.torrent_info(lt.bencode(creator.generate()))
+
+
+def loopback_session(port, upload_rate=0):
+    """Session reachable only on 127.0.0.1, with no DHT, LSD or port mapping."""
+    return lt.session({
+        **LOOPBACK_SETTINGS,
+        'listen_interfaces': f'127.0.0.1:{port}',
+        'upload_rate_limit': upload_rate,
+    })
+
+
+class Command(BaseCommand):
+    help = (
+        'Measures start-to-PLAYABLE on the real pipeline, downloading a synthetic film '
+        'from local libtorrent seeders on loopback (no network needed)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--duration', type=int, default=120, help='Length of the synthetic film in seconds')
+        parser.add_argument('--height', type=int, default=1080, help='Source video height')
+        parser.add_argument('--container', choices=['mkv', 'mp4'], default='mkv')
+        parser.add_argument('--faststart', action='store_true', help='MP4 only: put moov before the media data')
+        parser.add_argument('--piece-size', type=int, default=0, help='Piece size in KiB (0: libtorrent default)')
+        parser.add_argument('--seeders', type=int, default=1)
+        parser.add_argument('--seed-rate', type=int, default=0, help='Upload cap per seeder in KiB/s (0: unlimited)')
+        parser.add_argument('--runs', type=int, default=1)
+        parser.add_argument('--timeout', type=int, default=900, help='Seconds before a run is abandoned')
+        parser.add_argument('--port', type=int, default=47000, help='First seeder listen port')
+        parser.add_argument('--keepdb', action='store_true', help='Reuse the test database between runs')
+
+    def handle(self, *args, **options):
+        work_dir = tempfile.mkdtemp(prefix='ttfs-bench-')
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, keepdb=options['keepdb'])
+        try:
+            seed_dir = os.path.join(work_dir, 'seed')
+            os.makedirs(seed_dir)
+            source = os.path.join(seed_dir, f"bench.{options['container']}")
+            self.stdout.write(f"Encoding {options['duration']}s synthetic {options['height']}p {options['container']}...")
+            try:
+                make_video(source, options['duration'], options['height'], options['faststart'])
+            except (OSError, subprocess.CalledProcessError) as e:
+                raise CommandError(f"Could not create the test video: {e}")
+            info = make_torrent(source, options['piece_size'] * 1024)
+            self.stdout.write(
+                f"Torrent: {os.path.getsize(source) / 1e6:.1f} MB, {info.num_pieces()} pieces of "
+                f"{info.piece_length() // 1024} KiB"
+            )
+
+            seeders = self.start_seeders(info, seed_dir, options['seeders'], options['port'], options['seed_rate'])
+            peers = "".join(f"&x.pe=127.0.0.1:{options['port'] + i}" for i in range(len(seeders)))
+            magnet = lt.make_magnet_uri(info) + peers
+
+            # The pipeline's own session goes loopback-only too, and announces to no tracker
+            tracker_registry.enabled = False
+            results = []
+            with override_settings(MEDIA_ROOT=os.path.join(work_dir, 'media')):
+                manager, _ = pipeline.start_torrent_engine()
+                manager.session.apply_settings({
+                    **LOOPBACK_SETTINGS,
+                    'listen_interfaces': f"127.0.0.1:{options['port'] + options['seeders']}",
+                })
+                for run in range(options['runs']):
+                    result = self.run_once(magnet, options['timeout'])
+                    results.append(result)
+                    self.report(f"run {run + 1}", result)
+            if len(results) > 1:
+                self.report("median", {
+                    key: statistics.median(r[key] for r in results if r.get(key) is not None)
+                    for key in results[0] if any(r.get(key) is not None for r in results)
+                })
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def start_seeders(self, info, seed_dir, count, port, rate_kib):
+        seeders = []
+        for i in range(count):
+            session = loopback_session(port + i, rate_kib * 1024)
+            params = lt.add_torrent_params()
+            params.ti = info
+            params.save_path = seed_dir
+            params.flags |= lt.torrent_flags.seed_mode
+            session.add_torrent(params)
+            seeders.append(session)
+        return seeders
+
+    def run_once(self, magnet, timeout):
+        """One pipeline from a fresh MovieFile, timed from its timeline spans."""
+        movie = MovieFile.objects.create(
+            imdb_id="tt-ttfs-bench",
+            magnet_link=magnet,
+            download_status="PENDING",
+        )
+        machine = pipeline.process_video_thread(movie.id, wait=False)
+        try:
+            if not machine.finished.wait(timeout):
+                raise CommandError(f"Run abandoned after {timeout}s in state {machine.state}")
+            if machine.state == "error":
+                raise CommandError(f"Pipeline failed for movie={movie.id}; see the log")
+            timeline = timelines.get(movie.id)
+        finally:
+            if machine.info_hash:
+                pipeline.torrent_manager.remove_torrent(machine.info_hash)
+            status_registry.drop(movie.id)
+
+        spans = timeline["spans"]
+
+        def phase(name):
+            # Probe retries re-enter the header and probe phases: their spans add up
+            durations = [s["duration"] for s in spans if s.get("phase") and s["name"] == name]
+            return sum(durations) if durations else None
+
+        def end(span):
+            return span["start"] + span["duration"]
+
+        first = next((s for s in spans if s["name"] == "encode" and s["segment"] == 0 and s.get("ok")), None)
+        finalizing = [s for s in spans if s.get("phase") and s["name"] == "finalizing"]
+        encodes = [s for s in spans if s["name"] == "encode" and s.get("ok") and s["duration"] > 0]
+        realtime = None
+        if encodes:
+            # Film seconds per second of encoding, download waits excluded
+            realtime = VideoService().segment_duration * len(encodes) / sum(s["duration"] for s in encodes)
+        return {
+            "metadata_wait": phase("metadata"),
+            "header_wait": phase("header"),
+            "probe": phase("probe"),
+            "first_segment": end(first) if first else None,
+            "total": end(finalizing[-1]) if finalizing else None,
+            "realtime": realtime,
+        }
+
+    def report(self, label, result):
+        def fmt(key):
+            value = result.get(key)
+            return f"{value:7.2f}s" if value is not None else "      -"
+
+        realtime = result.get("realtime")
+        self.stdout.write(
+            f"{label:<7} metadata {fmt('metadata_wait')}  header {fmt('header_wait')}  probe {fmt('probe')}  "
+            f"first segment {fmt('first_segment')}  total {fmt('total')}  "
+            f"encode {f'{realtime:.2f}x realtime' if realtime else '-'}"
+        )
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from stream.calibration import calibrate, calibration_path, load_calibration
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks x264 presets and thread counts on this node and saves the cheapest setting that holds realtime'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--streams', type=int, default=1, help='Fewest ffmpeg slots the chosen setting must keep above realtime')
+        parser.add_argument('--seconds', type=int, default=5, help='Length of the synthetic test clip')
+        parser.add_argument('--if-missing', action='store_true', help='Do nothing when this node is already calibrated')
+
+    def handle(self, *args, **options):
+        if options['if_missing'] and load_calibration():
+            self.stdout.write(f"Already calibrated ({calibration_path()})")
+            return
+        try:
+            result = calibrate(streams=options['streams'], seconds=options['seconds'], log=self.stdout.write)
+        except (ValueError, RuntimeError, OSError) as e:
+            raise CommandError(f"Calibration failed: {e}")
+        self.stdout.write(self.style.SUCCESS(
+            f"preset={result['preset']} threads={result['threads']} slots={result['slots']} "
+            f"({result['realtime_factor']}x realtime) saved to {calibration_path()}"
+        ))
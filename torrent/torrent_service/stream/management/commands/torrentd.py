@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from stream.calibration import schedule_calibration
+from stream.engine import TORRENTD_SOCKET, LocalEngine
+from stream.recovery import schedule_recovery
+from stream.torrentd import TorrentDaemon
+
+
+class Command(BaseCommand):
+    help = 'Runs the torrent daemon: libtorrent session, pipelines and transcodes, served over a Unix socket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', default=TORRENTD_SOCKET, help='Unix socket path (default: TORRENTD_SOCKET)')
+        parser.add_argument('--no-calibrate', action='store_true', help='Do not calibrate an uncalibrated node in the background')
+
+    def handle(self, *args, **options):
+        engine = LocalEngine()
+        schedule_recovery(engine)
+        if not options['no_calibrate'] and schedule_calibration():
+            self.stdout.write("Calibrating the encoder in the background (default settings until it finishes)")
+
+        server = TorrentDaemon(engine, options['socket'])
+        self.stdout.write(f"torrentd listening on {options['socket']}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,87 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Journal of published segments, one per rendition folder
+MANIFEST_FILE = "manifest.log"
+# Suffix ffmpeg writes to before a segment is renamed into place
+PARTIAL_SUFFIX = ".part"
+
+# Parsed journals kept per process (one per rendition folder); the least recently read is dropped first
+MANIFEST_CACHE_ENTRIES = int(os.getenv("MANIFEST_CACHE_ENTRIES", "256"))
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def manifest_path(rendition_dir):
+    return os.path.join(rendition_dir, MANIFEST_FILE)
+
+
+def record_segment(rendition_dir, segment_index, duration):
+    """Append a published segment and its real duration to the rendition's journal."""
+    with open(manifest_path(rendition_dir), "a") as f:
+        f.write(f"{segment_index},{duration:.3f}\n")
+
+
+def retract_segment(rendition_dir, segment_index):
+    """Mark a segment as withdrawn (discarded for re-encoding)."""
+    try:
+        with open(manifest_path(rendition_dir), "a") as f:
+            f.write(f"{segment_index},-\n")
+    except OSError:
+        pass
+
+
+def read_manifest(rendition_dir):
+    """
+    {segment_index: duration} for a rendition. The journal is append-only,
+    so each process keeps what it parsed (for the MANIFEST_CACHE_ENTRIES
+    most recently read renditions) and only reads the new tail.
+    """
+    path = manifest_path(rendition_dir)
+    try:
+        size = os.stat(path).st_size
+    except OSError:
+        return {}
+
+    with _cache_lock:
+        offset, entries = _cache.get(path, (0, {}))
+        if path in _cache:
+            _cache.move_to_end(path)
+        if size < offset:
+            # Journal was replaced (movie re-downloaded): start over
+            offset, entries = 0, {}
+        if size > offset:
+            entries = dict(entries)
+            try:
+                with open(path, "rb") as f:
+                    f.seek(offset)
+                    data = f.read(size - offset)
+            except OSError:
+                return entries
+            # A line still being appended is picked up on the next read
+            complete = data.rfind(b"\n") + 1
+            for line in data[:complete].decode(errors="replace").splitlines():
+                idx, _, value = line.partition(",")
+                try:
+                    if value == "-":
+                        entries.pop(int(idx), None)
+                    else:
+                        entries[int(idx)] = float(value)
+                except ValueError:
+                    continue
+            offset += complete
+            _cache[path] = (offset, entries)
+            while len(_cache) > MANIFEST_CACHE_ENTRIES:
+                _cache.popitem(last=False)
+        return entries
+
+
+def contiguous_durations(rendition_dir):
+    """Durations of the gap-free run of published segments from segment 0."""
+    entries = read_manifest(rendition_dir)
+    durations = []
+    while len(durations) in entries:
+        durations.append(entries[len(durations)])
+    return durations
@@ -0,0 +1,215 @@
+import bisect
+import logging
+import os
+import subprocess
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Containers whose packet index is complete as soon as the header (moov) is readable
+INDEXED_EXTENSIONS = (".mp4", ".m4v", ".mov")
+# Indexes of finished titles kept for passthrough cuts after their pipeline ended (JIT)
+FINISHED_INDEX_ENTRIES = int(os.getenv("FINISHED_INDEX_ENTRIES", "16"))
+
+
+class MediaByteIndex:
+    """
+    Presentation time -> byte offset map for a source file.
+    Built from the container's own keyframe index (MP4 sample tables,
+    Matroska Cues), or from ffprobe's packet list where there is none. Times past
+    the indexed region fall back to linear interpolation between the last
+    keyframe and the end of the file, padded by a safety margin.
+    """
+
+    def __init__(self, size, duration, keyframes=()):
+        self.size = size
+        self.duration = duration
+        points = sorted(set(keyframes))
+        self._times = [t for t, _ in points]
+        self._positions = [p for _, p in points]
+        self.complete = False
+        # The packet probe errored or timed out: probing again would not do better
+        self.failed = False
+
+    @property
+    def known_until(self):
+        if self.complete:
+            return self.duration
+        return self._times[-1] if self._times else 0.0
+
+    @classmethod
+    def probe(cls, path, size, duration, limit_bytes=None, timeout=60, index_on_disk=False):
+        """
+        Read keyframe positions for the video stream. For MP4 the whole index
+        lives in moov, and Matroska's in Cues once they are on disk (the file
+        is complete, or index_on_disk says the container walk found them
+        verified): both are read directly. Otherwise ffprobe lists packets
+        over the first limit_bytes (the verified prefix) so it never wades
+        into holes.
+        """
+        from .container import read_keyframes
+
+        full = os.path.splitext(path)[1].lower() in INDEXED_EXTENSIONS
+        if full or index_on_disk or limit_bytes is None or limit_bytes >= size:
+            try:
+                keyframes = read_keyframes(path)
+            except (OSError, ValueError) as e:
+                logger.info(f"No usable container index in {path}, listing packets instead: {e}")
+                keyframes = None
+            if keyframes:
+                index = cls(size, duration, keyframes)
+                index.complete = True
+                return index
+            # Fragmented or broken MP4: index it like any other container
+            full = False
+
+        cmd = [
+            'ffprobe', '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,pos,flags',
+            '-of', 'compact=p=0',
+        ]
+        if not full and limit_bytes is not None and size:
+            seconds = max(1.0, duration * limit_bytes / size * 0.95)
+            cmd.extend(['-read_intervals', f'%+{seconds:.1f}'])
+        cmd.append(path)
+
+        keyframes = []
+        failed = False
+        try:
+            output = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=timeout).stdout
+            for line in output.decode(errors='replace').splitlines():
+                fields = dict(part.split('=', 1) for part in line.split('|') if '=' in part)
+                if 'K' not in fields.get('flags', ''):
+                    continue
+                try:
+                    keyframes.append((float(fields['pts_time']), int(fields['pos'])))
+                except (KeyError, ValueError):
+                    continue
+        except Exception as e:
+            logger.warning(f"Keyframe index probe failed for {path}: {e}")
+            failed = True
+
+        index = cls(size, duration, keyframes)
+        index.failed = failed
+        return index
+
+    def _interpolate(self, t):
+        if self._times:
+            t0, p0 = self._times[-1], self._positions[-1]
+        else:
+            t0, p0 = 0.0, 0
+        if self.duration <= t0:
+            return self.size
+        return int(p0 + (t - t0) / (self.duration - t0) * (self.size - p0))
+
+    def byte_range(self, start_time, end_time):
+        """File bytes [start, end) needed to decode start_time..end_time."""
+        margin = max(self.size // 100, 4 * 1024 * 1024)
+
+        i = bisect.bisect_right(self._times, start_time) - 1
+        if self._times and start_time <= self.known_until and i >= 0:
+            start = self._positions[i]
+        else:
+            start = self._interpolate(start_time) - margin
+
+        j = bisect.bisect_left(self._times, end_time)
+        if end_time >= self.duration:
+            end = self.size
+        elif j < len(self._times) and end_time <= self.known_until:
+            # Include the following GOP start so the last frames are complete
+            end = self._positions[min(j + 1, len(self._positions) - 1)]
+        else:
+            end = self._interpolate(end_time) + margin
+
+        start = max(0, min(start, self.size))
+        end = max(start + 1, min(end, self.size))
+        return start, end
+
+    def covers(self, end_time):
+        """True when every keyframe up to end_time is known."""
+        return end_time >= self.duration or end_time <= self.known_until
+
+    def keyframe_span(self, start_time, end_time):
+        """
+        Cut points for stream-copying start_time..end_time: the last keyframe
+        at or before each boundary, so consecutive segments tile the file.
+        None when the index does not cover the window or no keyframe falls in it.
+        """
+        if not self.covers(end_time):
+            return None
+        if start_time <= 0:
+            start = 0.0
+        else:
+            i = bisect.bisect_right(self._times, start_time) - 1
+            if i < 0:
+                return None
+            start = self._times[i]
+        if end_time >= self.duration:
+            end = self.duration
+        else:
+            j = bisect.bisect_right(self._times, end_time) - 1
+            if j < 0:
+                return None
+            end = self._times[j]
+        if end <= start:
+            return None
+        return start, end
+
+
+_indexes = {}
+_finished = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def register_index(movie_id, index):
+    with _indexes_lock:
+        _indexes[movie_id] = index
+
+
+def get_index(movie_id):
+    """The running pipeline's index of the movie, else the kept index of the finished title."""
+    index = _indexes.get(movie_id)
+    if index is None:
+        with _indexes_lock:
+            index = _finished.get(movie_id)
+            if index is not None:
+                _finished.move_to_end(movie_id)
+    return index
+
+
+def _keep_finished(movie_id, index):
+    # Caller holds _indexes_lock
+    _finished[movie_id] = index
+    _finished.move_to_end(movie_id)
+    while len(_finished) > FINISHED_INDEX_ENTRIES:
+        _finished.popitem(last=False)
+
+
+def retire_index(movie_id):
+    """The pipeline is done with the movie: keep its index, if complete, among the finished titles'."""
+    with _indexes_lock:
+        index = _indexes.pop(movie_id, None)
+        _finished.pop(movie_id, None)
+        if index is not None and index.complete:
+            _keep_finished(movie_id, index)
+
+
+def finished_index(movie_id, path, duration):
+    """
+    Index of a fully downloaded title: the kept one, else built from the
+    file (once; a failed build is kept too, so it is not retried per request).
+    """
+    index = get_index(movie_id)
+    if index is None:
+        index = MediaByteIndex.probe(path, os.path.getsize(path), duration)
+        with _indexes_lock:
+            _keep_finished(movie_id, index)
+    return index
+
+
+def drop_index(movie_id):
+    with _indexes_lock:
+        _indexes.pop(movie_id, None)
+        _finished.pop(movie_id, None)
@@ -23,6 +23,7 @@ class MovieFile(models.Model):
 		default="PENDING",
 	)
 	download_progress = models.FloatField(default=0)
+	duration = models.FloatField(null=True, blank=True)
 	last_watched = models.DateTimeField(default=timezone.now)
 	created_at = models.DateTimeField(auto_now_add=True)
 	
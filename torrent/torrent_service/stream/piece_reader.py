@@ -0,0 +1,232 @@
+import logging
+import os
+import re
+import select
+import socket
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote
+
+logger = logging.getLogger(__name__)
+
+# Seconds a read waits for a missing piece before the connection is dropped
+PIECE_READ_TIMEOUT = float(os.getenv("PIECE_READ_TIMEOUT", "60"))
+# Seconds between checks that the reader of a blocked response is still connected
+CLIENT_POLL_INTERVAL = 1.0
+# Bytes of verified pieces kept in memory; neighbouring segments share their boundary pieces
+PIECE_CACHE_BYTES = int(os.getenv("PIECE_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+range_re = re.compile(r"bytes\s*=\s*(\d+)\s*-\s*(\d*)", re.I)
+window_re = re.compile(r"(\d+)-(\d+)")
+
+
+class PieceReader:
+    """
+    Verified piece data straight from libtorrent (read_piece + read_piece_alert).
+    read() blocks until the piece has passed its hash check; raising it in
+    the download queue is left to the caller, which owns that deadline.
+    The torrent supervisor feeds it piece_finished and read_piece alerts.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+
+    def read(self, handle, key, piece, timeout=PIECE_READ_TIMEOUT, abort=None):
+        """Piece bytes once verified. abort() is polled while waiting; a true result raises InterruptedError."""
+        wait = threading.TIMEOUT_MAX if timeout is None else timeout
+        deadline = time.monotonic() + min(wait, 10 ** 9)
+        with self._cond:
+            data = self._cache.get((key, piece))
+            if data is not None:
+                self._cache.move_to_end((key, piece))
+                return data
+            # Notified on piece_finished; the timeout also covers a missed alert
+            while not handle.have_piece(piece):
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    raise TimeoutError(f"piece {piece} not downloaded within {timeout}s")
+                if abort is not None:
+                    if abort():
+                        raise InterruptedError(f"read of piece {piece} abandoned")
+                    left = min(left, CLIENT_POLL_INTERVAL)
+                self._cond.wait(left)
+            request = self._pending.get((key, piece))
+            issue = request is None
+            if issue:
+                request = self._pending[(key, piece)] = {"done": threading.Event(), "data": None, "error": None}
+        try:
+            if issue:
+                handle.read_piece(piece)
+            if not request["done"].wait(wait):
+                raise TimeoutError(f"piece {piece} not read within {timeout}s")
+        except Exception:
+            # A lost alert (or a torrent re-added under the same info-hash) must not
+            # leave a request behind that every later read would wait on forever
+            with self._cond:
+                if self._pending.get((key, piece)) is request:
+                    del self._pending[(key, piece)]
+            raise
+        if request["error"]:
+            raise IOError(request["error"])
+        return request["data"]
+
+    def wait_for_range(self, source, start, end, timeout):
+        """Block until source bytes [start, end) are verified; False after timeout seconds."""
+        with self._cond:
+            return self._cond.wait_for(lambda: source.have_range(start, end), timeout)
+
+    def on_piece_finished(self):
+        with self._cond:
+            self._cond.notify_all()
+
+    def on_read_piece(self, key, alert):
+        error = alert.error.message() if alert.error.value() else None
+        data = None if error else bytes(alert.buffer)
+        with self._cond:
+            request = self._pending.pop((key, alert.piece), None)
+            if data is not None and (key, alert.piece) not in self._cache:
+                self._cache[(key, alert.piece)] = data
+                self._cached_bytes += len(data)
+                while self._cached_bytes > PIECE_CACHE_BYTES and len(self._cache) > 1:
+                    self._cached_bytes -= len(self._cache.popitem(last=False)[1])
+        if request is not None:
+            request["data"], request["error"] = data, error
+            request["done"].set()
+
+
+piece_reader = PieceReader()
+
+
+class _SourceHandler(BaseHTTPRequestHandler):
+    """Range requests over a torrent file, answered piece by piece as they verify."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def _client_gone(self):
+        """True once the reader hung up: its end of the socket reads as EOF."""
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and self.connection.recv(1, socket.MSG_PEEK) == b""
+        except OSError:
+            return True
+
+    def _serve(self, body):
+        path, _, query = self.path.partition("?")
+        entry = self.server.sources.get(unquote(path).lstrip("/").split("/", 1)[0])
+        if entry is None:
+            self.send_error(404)
+            return
+        key, source = entry
+        window = None
+        match = window_re.fullmatch(parse_qs(query).get("window", [""])[0])
+        if match:
+            window = int(match.group(1)), int(match.group(2))
+        size = source.size
+        start, end = 0, size - 1
+        match = range_re.match(self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), size - 1)
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.end_headers()
+            return
+
+        # Open-ended reads are cut short so nothing past the segment is waited for:
+        # inside the window at its end, elsewhere (container headers, index) at the
+        # last piece already on disk. ffmpeg asks again if it needs more.
+        urgent = window is None or window[0] <= start < window[1]
+        if window is not None and urgent:
+            end = min(end, window[1] - 1)
+        elif not urgent:
+            pieces = source.piece_range(start, end + 1)
+            last = pieces[0]
+            while last + 1 < pieces.stop and source.handle.have_piece(last + 1):
+                last += 1
+            end = min(end, (last + 1) * source.piece_length - source.offset - 1)
+
+        self.send_response(206 if match or end < size - 1 else 200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if match or end < size - 1:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if not body:
+            return
+
+        pos = start
+        raised = []
+        try:
+            for piece in source.piece_range(start, end + 1):
+                if urgent and not source.handle.have_piece(piece):
+                    source.handle.set_piece_deadline(piece, 0)
+                    raised.append(piece)
+                data = piece_reader.read(source.handle, key, piece, abort=self._client_gone)
+                piece_start = piece * source.piece_length - source.offset
+                chunk = data[max(0, pos - piece_start):end + 1 - piece_start]
+                self.wfile.write(chunk)
+                pos += len(chunk)
+        except (BrokenPipeError, ConnectionResetError, InterruptedError):
+            # ffmpeg read what it needed (or seeked) and hung up
+            pass
+        except (TimeoutError, IOError) as e:
+            # ffmpeg sees a short read and the segment is retried
+            logger.warning(f"Source read stopped at byte {pos} of {source.path}: {e}")
+        finally:
+            # Deadlines this response raised must not outlive it and keep steering the swarm
+            for piece in raised:
+                if not source.handle.have_piece(piece):
+                    source.handle.reset_piece_deadline(piece)
+
+
+class SourceServer:
+    """
+    Loopback HTTP server handing torrent files to ffmpeg. ffmpeg seeks with
+    Range requests and each read blocks only until the exact pieces it
+    needs are verified, instead of tripping over holes in the sparse file
+    on disk and failing with "Invalid data found".
+    """
+
+    def __init__(self):
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _SourceHandler)
+        self._server.daemon_threads = True
+        self._server.sources = {}
+        threading.Thread(target=self._server.serve_forever, name="source-server", daemon=True).start()
+
+    def url(self, key, source, window=None):
+        token = f"{key}-{source.file_index}"
+        self._server.sources[token] = (key, source)
+        host, port = self._server.server_address
+        url = f"http://{host}:{port}/{token}/{quote(os.path.basename(source.path))}"
+        return url if window is None else f"{url}?window={window[0]}-{window[1]}"
+
+
+_source_server = None
+_source_server_lock = threading.Lock()
+
+
+def source_url(key, source, window=None):
+    """
+    URL ffmpeg can read the torrent file from while it downloads. Reads
+    block on missing pieces only inside window, the [start, end) source
+    bytes of the segment being encoded.
+    """
+    global _source_server
+    with _source_server_lock:
+        if _source_server is None:
+            _source_server = SourceServer()
+    return _source_server.url(key, source, window)
@@ -0,0 +1,1067 @@
+import logging
+import os
+import threading
+import time
+
+import libtorrent as lt
+from django.conf import settings
+
+from .container import ContainerLayout
+from .ladder import (
+    active_renditions,
+    packaged_renditions,
+    SourceLadder,
+    set_source_ladder,
+    source_ladder,
+)
+from .manifest import PARTIAL_SUFFIX, contiguous_durations, read_manifest, retract_segment
+from .media_index import MediaByteIndex, register_index, get_index, drop_index, finished_index, retire_index
+from .metrics import metrics_registry, pipeline_phase_seconds, pipelines_finished
+from .models import MovieFile
+from .piece_reader import piece_reader, source_url
+from .progress import progress_writer
+from .scheduler import (
+    transcode_scheduler,
+    PRIORITY_FIRST_SEGMENT,
+    PRIORITY_PROGRESSIVE,
+    PRIORITY_BACKFILL,
+    PRIORITY_IDLE,
+    STARTUP_SEGMENTS,
+)
+from .services import VideoService, HlsStreamPackager, ALL_RENDITIONS, AUDIO_RENDITION, HLS_FORMAT
+from .snapshots import status_registry
+from .supervisor import (
+    ALERT_MASK,
+    RESUME_FLAGS,
+    RESUME_INTERVAL,
+    TorrentSupervisor,
+    info_hash_key,
+    load_resume_params,
+)
+from .torrent_file import TorrentFileView
+from .tracing import timelines
+from .trackers import tracker_registry
+from .utils import magnet_info_hash
+
+logger = logging.getLogger(__name__)
+
+# "segment": one ffmpeg per 10s segment; "stream": one long-lived ffmpeg per movie
+HLS_PACKAGER = os.getenv("HLS_PACKAGER", "segment")
+
+# Just-in-time mode: segments requested by players ahead of the pipeline
+JIT_LOOKAHEAD = int(os.getenv("JIT_LOOKAHEAD", "3"))
+
+# Upcoming segments whose pieces are kept at top priority
+PRIORITY_WINDOW = int(os.getenv("PRIORITY_WINDOW", "6"))
+# Minimum seconds between keyframe index refreshes for partially indexed containers
+INDEX_REFRESH_INTERVAL = 60
+# Same, while the passthrough rung waits for the index to reach the next segment
+INDEX_REFRESH_BLOCKED_INTERVAL = 10
+# Leading bytes of the file that must be verified before the source is probed
+HEADER_BYTES = int(os.getenv("HEADER_BYTES", str(4 * 1024 * 1024)))
+
+
+class TorrentSessionManager:
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(TorrentSessionManager, cls).__new__(cls)
+                cls._instance._initialize()
+            return cls._instance
+
+    def _initialize(self):
+        self.session = lt.session()
+        self.session.listen_on(6881, 6891)
+        params = {
+            'active_downloads': 10,
+            'alert_mask': ALERT_MASK,
+        }
+        self.session.apply_settings(params)
+        self.handles = {}
+        self.handle_locks = {}
+        self._cleanup_thread = threading.Thread(target=self._cleanup_loop, daemon=True)
+        self._cleanup_thread.start()
+
+    def _cleanup_loop(self):
+        while True:
+            try:
+                # Snapshot first: remove_torrent takes the lock itself
+                with self._lock:
+                    handles = list(self.handles.items())
+                for info_hash, handle in handles:
+                    if handle.is_valid() and handle.status().is_seeding:
+                        if handle.status().active_time > 3600:
+                            self.remove_torrent(info_hash)
+            except Exception as e:
+                logging.error(f"Error in cleanup loop: {str(e)}")
+            time.sleep(300)
+
+    def add_torrent(self, magnet_link, save_path):
+        """Add (or find) the torrent for a magnet. Returns its info-hash, the handle key."""
+        params = lt.parse_magnet_uri(magnet_link)
+        # Pick up where a previous process left off instead of re-checking every piece
+        params = load_resume_params(save_path, params) or params
+        params.save_path = save_path
+        # The healthiest few instead of every tracker the magnet ever carried
+        params.trackers = tracker_registry.best(extra=params.trackers)
+
+        with self._lock:
+            handle = self.session.add_torrent(params)
+            info_hash = info_hash_key(handle)
+            self.handles[info_hash] = handle
+            self.handle_locks.setdefault(info_hash, threading.Lock())
+            return info_hash
+
+    def get_handle(self, info_hash):
+        return self.handles.get(info_hash)
+
+    def get_handle_lock(self, info_hash):
+        return self.handle_locks.get(info_hash)
+
+    def remove_torrent(self, info_hash):
+        with self._lock:
+            if info_hash in self.handles:
+                handle = self.handles[info_hash]
+                if handle.is_valid():
+                    self.session.remove_torrent(handle)
+                del self.handles[info_hash]
+                del self.handle_locks[info_hash]
+
+
+# The libtorrent session and its supervisor exist only in the process that
+# runs the pipelines (torrentd, or the web process in embedded mode).
+torrent_manager = None
+torrent_supervisor = None
+_engine_lock = threading.Lock()
+
+
+def start_torrent_engine():
+    global torrent_manager, torrent_supervisor
+    with _engine_lock:
+        if torrent_manager is None:
+            torrent_manager = TorrentSessionManager()
+            torrent_supervisor = TorrentSupervisor(torrent_manager.session)
+    return torrent_manager, torrent_supervisor
+
+
+def _pipelines():
+    return torrent_supervisor.pipelines() if torrent_supervisor else []
+
+
+def _pipeline_states():
+    states = {}
+    for machine in _pipelines():
+        states[machine.state] = states.get(machine.state, 0) + 1
+    return [((state,), n) for state, n in states.items()]
+
+
+def _swarm_gauge(field, scale=1):
+    return lambda: [((str(m.video_id),), m.swarm[field] * scale) for m in _pipelines() if m.handle is not None]
+
+
+metrics_registry.gauge(
+    "hyperflix_active_torrents",
+    "Torrents in the libtorrent session",
+    collect=lambda: [((), len(torrent_manager.handles) if torrent_manager else 0)],
+)
+metrics_registry.gauge(
+    "hyperflix_pipelines",
+    "Running movie pipelines, by phase",
+    labels=("phase",),
+    collect=_pipeline_states,
+)
+metrics_registry.gauge(
+    "hyperflix_swarm_peers",
+    "Connected peers of the movie's torrent",
+    labels=("movie",),
+    collect=_swarm_gauge("peers"),
+)
+metrics_registry.gauge(
+    "hyperflix_swarm_seeds",
+    "Connected seeds of the movie's torrent",
+    labels=("movie",),
+    collect=_swarm_gauge("seeds"),
+)
+metrics_registry.gauge(
+    "hyperflix_download_rate_bytes",
+    "Payload download rate of the movie's torrent in bytes per second",
+    labels=("movie",),
+    collect=_swarm_gauge("down_kbps", 1000),
+)
+
+
+def discard_segment(movie_dir, segment_index, renditions=None):
+    """Withdraw a broken or half-written segment so it gets re-encoded."""
+    for res in renditions or ALL_RENDITIONS:
+        segment_path = os.path.join(movie_dir, res, f"segment_{segment_index:03d}.ts")
+        for path in (segment_path, segment_path + PARTIAL_SUFFIX):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if os.path.isdir(os.path.join(movie_dir, res)):
+            retract_segment(os.path.join(movie_dir, res), segment_index)
+
+
+def source_input(source, source_path, window=None):
+    """
+    What ffmpeg reads: verified piece data while the file downloads (waiting
+    only on pieces inside window), the file itself once complete.
+    """
+    if source is None or source.contiguous_bytes() >= source.size:
+        return source_path
+    return source_url(info_hash_key(source.handle), source, window)
+
+
+def convert_segment(service, source, source_path, movie_dir, movie_id, segment_index, renditions, duration=None):
+    """
+    Encode a segment's renditions, stream-copying the passthrough rendition
+    when the keyframe index covers the segment. The plan is made when the job
+    runs, so it benefits from index refreshes that happened while it queued.
+    Reads of pieces not downloaded yet block until they verify, within the
+    segment's byte range when the index or the duration can place it.
+    """
+    copy = None
+    waiting_copy = False
+    ladder = source_ladder(movie_id)
+    index = get_index(movie_id)
+    if ladder.copy and ladder.copy in renditions:
+        start_time = segment_index * service.segment_duration
+        cut = index.keyframe_span(start_time, start_time + service.segment_duration) if index is not None else None
+        if cut:
+            copy = (ladder.copy, cut[0], cut[1])
+        else:
+            # The copy rung is never encoded: copied segments are cut at keyframes and
+            # encoded ones at exact times, so mixing them would leave gaps and overlaps
+            # in its playlist. It waits for the index to cover this segment.
+            renditions = [res for res in renditions if res != ladder.copy]
+            waiting_copy = True
+    if not renditions:
+        return False
+    window = None
+    if source is not None and (index is not None or duration):
+        window = segment_byte_range(service, source, movie_id, segment_index, duration)
+    with timelines.span(movie_id, "encode", segment=segment_index, renditions=",".join(renditions)) as span:
+        span["copy"] = copy[0] if copy else None
+        span["ok"] = service.convert_all_segments(
+            source_input(source, source_path, window), movie_dir, segment_index, renditions, copy, ladder.audio
+        )
+    return span["ok"] and not waiting_copy
+
+
+def segment_byte_range(service, source, movie_id, segment_index, duration):
+    """
+    Source bytes segment N needs to decode: from the movie's keyframe index
+    when one has been built, else a linear guess padded by 1% of the file.
+    """
+    start_time = segment_index * service.segment_duration
+    end_time = start_time + service.segment_duration
+    index = get_index(movie_id)
+    if index is not None:
+        return index.byte_range(start_time, end_time)
+    margin = source.size // 100
+    start = int(start_time / duration * source.size) - margin
+    end = int(end_time / duration * source.size) + margin
+    return max(0, start), min(source.size, end)
+
+
+def request_jit_segment(movie, segment_index, res=None, wait=0):
+    """
+    Queue a high-priority transcode of one segment plus a lookahead window,
+    including the rendition `res` the player asked for even when it is shed
+    or not demanded yet. Source pieces are waited for here, outside the
+    ffmpeg slots: up to `wait` seconds for the requested segment, not at
+    all for the lookahead, which is queued only once on disk (its pieces
+    are raised to the front meanwhile). Returns the future of the requested
+    segment, or None when its pieces did not arrive in time.
+    """
+    service = VideoService()
+    movie_dir = os.path.join(settings.MEDIA_ROOT, "movies", str(movie.id))
+    source_path = os.path.join(settings.MEDIA_ROOT, movie.file_path)
+    total = service.expected_segments(movie.duration)
+    renditions = active_renditions(movie.id)
+    ladder = source_ladder(movie.id)
+    if res and res not in renditions and (res in ladder.renditions or (res == AUDIO_RENDITION and ladder.audio)):
+        order = ladder.renditions + [AUDIO_RENDITION]
+        renditions = sorted(renditions + [res], key=order.index)
+
+    source = None
+    handle = torrent_manager.get_handle(magnet_info_hash(movie.magnet_link)) if movie.magnet_link else None
+    if handle and handle.is_valid() and handle.has_metadata():
+        source = TorrentFileView.largest(handle)
+
+    # A finished title's pipeline is gone with its index: the copy rung is cut from the complete file's
+    complete = source is None or source.contiguous_bytes() >= source.size
+    if ladder.copy in renditions and complete and get_index(movie.id) is None and os.path.exists(source_path):
+        finished_index(movie.id, source_path, movie.duration)
+
+    window = list(enumerate(range(segment_index, min(total, segment_index + JIT_LOOKAHEAD + 1))))
+    ranges = {}
+    if source is not None:
+        # The whole window is raised before waiting, so the lookahead downloads meanwhile
+        for offset, idx in window:
+            ranges[idx] = segment_byte_range(service, source, movie.id, idx, movie.duration)
+            source.prioritize(*ranges[idx], deadline_ms=offset * service.segment_duration * 1000)
+
+    requested = None
+    for offset, idx in window:
+        # A job must not hold a slot while ffmpeg blocks on pieces that are not there yet
+        if source is not None and not source.have_range(*ranges[idx]):
+            if offset:
+                continue
+            if not piece_reader.wait_for_range(source, *ranges[idx], wait):
+                return None
+        future = transcode_scheduler.submit(
+            convert_segment,
+            service,
+            source,
+            source_path,
+            movie_dir,
+            movie.id,
+            idx,
+            renditions,
+            duration=movie.duration,
+            priority=PRIORITY_FIRST_SEGMENT if offset == 0 else PRIORITY_PROGRESSIVE,
+            key=(movie.id, idx, tuple(renditions)),
+            movie_id=movie.id,
+            kind="jit",
+        )
+        if requested is None:
+            requested = future
+    return requested
+
+
+class MoviePipeline:
+    """
+    Download/convert state machine for one movie:
+    metadata -> header -> probe -> converting -> finalizing.
+    Driven by the torrent supervisor's thread from libtorrent alerts plus a
+    once-a-second tick for timeouts. Probes and transcodes run on the
+    transcode scheduler and report back through the supervisor; only the
+    final packaging, which waits on the whole backfill, gets its own thread.
+    """
+
+    METADATA_TIMEOUT = 120
+    HEADER_TIMEOUT = 60
+
+    def __init__(self, video_id):
+        self.video_id = video_id
+        self.state = "starting"
+        self.state_since = time.time()
+        self.finished = threading.Event()
+        self.service = VideoService()
+        self.movie_file = None
+        self.movie_dir = None
+        self.info_hash = None
+        self.handle = None
+        self.source = None
+        self.downloaded_path = None
+        self.swarm = {"seeds": 0, "peers": 0, "down_kbps": 0.0}
+        self.download_complete = False
+        self.last_log = 0
+        self.last_resume_save = time.time()
+        self.probing = False
+        self.header_bytes = HEADER_BYTES
+        self.layout = None
+        self.layout_want = None
+        self.layout_prioritized = 0
+
+        self.video_duration = None
+        self.current_segment = 0
+        self.segment_inflight = False
+        self.waiting_for = None
+        self.retry_at = 0
+        self.packager = None
+        self.packager_future = None
+        self.index = None
+        self.index_refreshed_at = 0
+        self.index_refreshing = False
+        self.prioritized_until = 0
+        # Renditions new segments are encoded in, published for the master playlist
+        self.producing = None
+
+        # Renditions outside the primary encode (late demand, or all but the
+        # packager's in stream mode): segments below extra_done[res] are queued.
+        self.extra_done = {}
+        self.extra_futures = []
+
+    def start(self):
+        """Add the torrent and hand the movie to the supervisor. False if it is already running."""
+        if not torrent_supervisor.reserve(self.video_id, self):
+            return False
+        timelines.start(self.video_id)
+        try:
+            self.movie_file = MovieFile.objects.get(id=self.video_id)
+            progress_writer.transition(self.movie_file, "DOWNLOADING")
+
+            self.movie_dir = os.path.join(settings.MEDIA_ROOT, "movies", str(self.movie_file.id))
+            os.makedirs(self.movie_dir, exist_ok=True)
+            self.publish_status(info_hash=None, swarm=self.swarm, variants={})
+
+            logger.info(f"Starting torrent: {self.movie_file.magnet_link}")
+            self.info_hash = torrent_manager.add_torrent(self.movie_file.magnet_link, self.movie_dir)
+            self.publish_status(info_hash=self.info_hash)
+            self.handle = torrent_manager.get_handle(self.info_hash)
+
+            if not self.handle: raise Exception("No torrent handle")
+
+            self._enter("metadata")
+            torrent_supervisor.attach(self, self.handle)
+        except Exception as e:
+            self.fail(e)
+        return True
+
+    def _enter(self, state):
+        now = time.time()
+        if self.state != "starting":
+            pipeline_phase_seconds.observe(now - self.state_since, phase=self.state)
+        if state in ("done", "error"):
+            pipelines_finished.inc(outcome=state)
+        timelines.phase(self.video_id, None if state in ("done", "error") else state, now)
+        self.state = state
+        self.state_since = now
+
+    # Snapshot for the status/HEAD endpoints, refreshed as the pipeline moves
+    def publish_status(self, **fields):
+        status_registry.publish(
+            self.video_id,
+            status=self.movie_file.download_status,
+            progress=self.movie_file.download_progress,
+            **fields,
+        )
+
+    def publish_variants(self):
+        ladder = source_ladder(self.video_id)
+        for res in ladder.renditions + ([AUDIO_RENDITION] if ladder.audio else []):
+            rdir = os.path.join(self.movie_dir, res)
+            status_registry.publish_variant(
+                self.video_id,
+                res,
+                len(read_manifest(rdir)),
+                static_playlist=os.path.exists(os.path.join(rdir, 'index.m3u8')),
+            )
+
+    # -- Supervisor callbacks (supervisor thread, must not block) --
+
+    def on_attach(self):
+        if self.state == "metadata" and self.handle.has_metadata():
+            self.on_metadata()
+
+    def on_metadata(self):
+        if self.state != "metadata":
+            return
+        self.source = TorrentFileView.largest(self.handle)
+        self.downloaded_path = os.path.join(self.movie_dir, self.source.path)
+
+        # Save relative path
+        progress_writer.update(self.movie_file, file_path=os.path.relpath(self.downloaded_path, settings.MEDIA_ROOT))
+
+        self.handle.set_sequential_download(True)
+        # Find the container index (moov, Cues) wherever the muxer put it
+        self.layout = ContainerLayout(self.source, self.downloaded_path)
+        tail = self.layout.tail_hint()
+        if tail:
+            self.source.prioritize(*tail, deadline_ms=0)
+        self._await_header()
+
+    def on_piece(self, piece):
+        if self.layout and not self.layout.done:
+            self._scan_layout()
+        if self.state == "header":
+            self._check_header()
+        elif self.state == "converting" and (self.waiting_for is None or piece in self.waiting_for):
+            self._advance()
+
+    def on_finished(self):
+        self.download_complete = True
+        self.handle.save_resume_data(RESUME_FLAGS)
+        if self.state == "converting":
+            self._advance()
+
+    def on_status(self, st):
+        if self.state not in ("metadata", "header", "probe", "converting"):
+            return
+        seeds = getattr(st, 'num_seeds', 0)
+        peers = getattr(st, 'num_peers', 0)
+        down_kbps = (getattr(st, 'download_rate', 0) / 1000.0)
+        self.swarm = {"seeds": seeds, "peers": peers, "down_kbps": round(down_kbps, 1)}
+        if st.is_seeding or st.progress >= 1:
+            self.download_complete = True
+
+        now = time.time()
+        if self.state == "metadata":
+            # Swarm health is exported as metrics; this is for debugging a single title
+            if now - self.last_log >= 1:
+                logger.debug(
+                    f"[metadata-wait] movie={self.video_id} seeds={seeds} peers={peers} down={down_kbps:.1f} kB/s "
+                    f"waited={now - self.state_since:.0f}s"
+                )
+                self.last_log = now
+        else:
+            progress = st.progress * 100
+            progress_writer.update(self.movie_file, download_progress=progress)
+            # Periodic swarm stats to diagnose slowness (every ~2s)
+            if now - self.last_log >= 2:
+                logger.debug(
+                    f"[dl] movie={self.video_id} progress={progress:.2f}% seeds={seeds} peers={peers} down={down_kbps:.1f} kB/s"
+                )
+                self.last_log = now
+                self.publish_variants()
+        self.publish_status(swarm=self.swarm)
+
+        if self.state == "converting":
+            self._advance()
+
+    def on_tick(self, now):
+        if self.state in ("header", "probe", "converting", "finalizing") and now - self.last_resume_save >= RESUME_INTERVAL:
+            # Written by the supervisor when the save_resume_data_alert arrives
+            self.handle.save_resume_data(RESUME_FLAGS)
+            self.last_resume_save = now
+
+        if self.state == "metadata":
+            if now - self.state_since > self.METADATA_TIMEOUT:
+                logger.error(
+                    f"Metadata timeout for movie={self.video_id} seeds={self.swarm['seeds']} "
+                    f"peers={self.swarm['peers']} down={self.swarm['down_kbps']:.1f} kB/s"
+                )
+                raise Exception("Metadata timeout")
+            return
+        if self.state == "header":
+            if now - self.state_since > self.HEADER_TIMEOUT:
+                raise Exception("File header missing (download stuck?)")
+        elif self.state == "converting":
+            # Catches the stream packager's progress and segment retries
+            self._advance()
+
+    # -- Header and probing --
+
+    def _await_header(self):
+        """Fetch the first header_bytes of the file first; the probe runs once they are verified."""
+        self.source.prioritize(0, self.header_bytes, deadline_ms=0)
+        self._enter("header")
+        self._check_header()
+
+    def _check_header(self):
+        # From the piece bitmap: a sparse or preallocated file looks complete on disk
+        if self.source.have_range(0, self.header_bytes) and self._scan_layout():
+            self._enter("probe")
+            self._start_probe()
+
+    def _scan_layout(self):
+        """Advance the container walk, prioritizing what it needs. True once the index allows probing."""
+        want = self.layout.advance()
+        if want and want != self.layout_want:
+            self.source.prioritize(*want, deadline_ms=0)
+            self.layout_want = want
+        for start, end in self.layout.ranges[self.layout_prioritized:]:
+            logger.info(f"Container index for movie={self.video_id} at bytes {start}-{end} of {self.source.size}")
+            self.source.prioritize(start, end, deadline_ms=0)
+        self.layout_prioritized = len(self.layout.ranges)
+        return self.layout.ready()
+
+    def _start_probe(self):
+        if self.probing:
+            return
+        self.probing = True
+        future = transcode_scheduler.submit(
+            self._probe,
+            priority=PRIORITY_FIRST_SEGMENT,
+            key=(self.video_id, "probe"),
+            movie_id=self.video_id,
+            kind="probe",
+        )
+        future.add_done_callback(lambda f: torrent_supervisor.post(self._on_probed, f))
+
+    def _probe(self):
+        """Duration, keyframe index and ladder of the source (scheduler thread). None if unreadable."""
+        with timelines.span(self.video_id, "ffprobe", header_bytes=self.header_bytes) as span:
+            info = self.service.probe_source(self.downloaded_path)
+            duration = span["source_duration"] = info and info.get("duration")
+        if not duration:
+            return None
+        with timelines.span(self.video_id, "keyframe_index"):
+            index = MediaByteIndex.probe(
+                self.downloaded_path,
+                self.source.size,
+                duration,
+                self.source.contiguous_bytes(),
+                index_on_disk=self._index_on_disk(),
+            )
+        return duration, index, SourceLadder.from_source(info)
+
+    def _index_on_disk(self):
+        """The container walk found the Cues (or moov) and every byte of them is verified."""
+        return self.layout is not None and self.layout.index_on_disk()
+
+    def _on_probed(self, future):
+        self.probing = False
+        if self.state != "probe":
+            return
+        result = future.result()
+        if result is None:
+            # The header did not hold enough to read the source: wait for twice as much
+            if self.header_bytes >= self.source.size:
+                raise Exception("Source is unreadable")
+            self.header_bytes = min(self.header_bytes * 2, self.source.size)
+            logger.info(f"Probe failed for movie={self.video_id}, waiting for {self.header_bytes} header bytes")
+            self._await_header()
+            return
+        dur, index, ladder = result
+
+        self.video_duration = dur
+        progress_writer.transition(self.movie_file, "DL_AND_CONVERT", duration=dur)
+        self.publish_status()
+        logger.info(f"Header ready. Duration: {dur}s")
+
+        self.index = index
+        self.index_refreshed_at = time.time()
+        register_index(self.video_id, index)
+        ladder.save(self.movie_dir)
+        set_source_ladder(self.video_id, ladder)
+        self._check_passthrough()
+        logger.info(
+            f"Ladder for movie={self.video_id}: {','.join(ladder.renditions)} "
+            f"(passthrough: {ladder.copy or 'none'}, audio: {ladder.audio or 'muxed'})"
+        )
+        self._resume_from_disk()
+        # The stream packager starts from byte 0, so it is only used for a fresh start
+        if HLS_PACKAGER == "stream" and self.current_segment == 0 and self.service.can_stream_package(self.downloaded_path):
+            self.packager = HlsStreamPackager(
+                self.service, self.downloaded_path, self.movie_dir, self.source.contiguous_bytes, self.source.size,
+                renditions=packaged_renditions(self.video_id),
+                copy=ladder.copy,
+                audio=ladder.audio,
+            )
+            self.packager_future = transcode_scheduler.submit(
+                self.packager.run,
+                priority=PRIORITY_FIRST_SEGMENT,
+                key=(self.video_id, "stream"),
+                movie_id=self.video_id,
+                kind="stream",
+            )
+            self.packager_future.add_done_callback(lambda f: torrent_supervisor.post(self._advance))
+            logger.info(f"Incremental packaging started for movie={self.video_id}")
+
+        self._enter("converting")
+        self._advance()
+
+    def _resume_from_disk(self):
+        """After a restart, skip the segments already published and continue from the first missing one."""
+        done = {
+            res: len(contiguous_durations(os.path.join(self.movie_dir, res)))
+            for res in active_renditions(self.video_id)
+        }
+        first_missing = min(done.values(), default=0)
+        if not first_missing:
+            return
+        self.extra_done.update(done)
+        self.current_segment = first_missing
+        self.prioritized_until = first_missing
+        progress_writer.transition(self.movie_file, "PLAYABLE")
+        self.publish_status()
+        self.publish_variants()
+        logger.info(f"Resuming movie={self.video_id} from segment {first_missing} ({sum(done.values())} segments on disk)")
+
+    # -- Conversion --
+
+    def _advance(self):
+        if self.state != "converting":
+            return
+
+        if self.download_complete and not self.segment_inflight:
+            self._enter("finalizing")
+            threading.Thread(target=self._finalize, name=f"finalize-{self.video_id}", daemon=True).start()
+            return
+
+        # A. Incremental packager: follow its progress, fall back to segments if it dies
+        if self.packager:
+            self._follow_packager()
+        # B. Transcode Available Segments
+        else:
+            self._convert_next()
+
+    def _queue_extra(self, res, upto):
+        for idx in range(self.extra_done.get(res, 0), upto):
+            self.extra_futures.append(transcode_scheduler.submit(
+                convert_segment,
+                self.service,
+                self.source,
+                self.downloaded_path,
+                self.movie_dir,
+                self.video_id,
+                idx,
+                [res],
+                duration=self.video_duration,
+                priority=PRIORITY_PROGRESSIVE if idx >= upto - 1 else PRIORITY_BACKFILL,
+                key=(self.video_id, idx, (res,)),
+                movie_id=self.video_id,
+            ))
+        self.extra_done[res] = max(upto, self.extra_done.get(res, 0))
+
+    def _segment_ready(self, segment_index):
+        if segment_index == 0:
+            progress_writer.transition(self.movie_file, "PLAYABLE")
+            logger.info("First segment ready!")
+        self.publish_status()
+        self.publish_variants()
+
+    def _follow_packager(self):
+        done = self.packager.completed_segments()
+        if done > self.current_segment:
+            first = self.current_segment
+            self.current_segment = done
+            self._segment_ready(first)
+        for res in active_renditions(self.video_id):
+            if res not in self.packager.renditions:
+                self._queue_extra(res, self.current_segment)
+        if self.packager_future.done() and not self.packager_future.result():
+            logger.warning(f"Incremental packager stopped at segment {done}; falling back to per-segment mode")
+            discard_segment(self.movie_dir, done, self.packager.renditions)
+            self.packager = None
+            self.current_segment = done
+
+    def _convert_next(self):
+        service = self.service
+        if self.segment_inflight or time.time() < self.retry_at:
+            return
+        if self.current_segment >= service.expected_segments(self.video_duration):
+            return
+
+        # Extend the keyframe index as the verified prefix grows
+        segment_end_time = (self.current_segment + 1) * service.segment_duration
+        interval = INDEX_REFRESH_BLOCKED_INTERVAL if source_ladder(self.video_id).copy else INDEX_REFRESH_INTERVAL
+        if (
+            not self.index.complete
+            and not self.index.failed
+            and not self.index_refreshing
+            and not self.index.covers(segment_end_time)
+            and time.time() - self.index_refreshed_at >= interval
+        ):
+            self.index_refreshing = True
+            future = transcode_scheduler.submit(
+                MediaByteIndex.probe,
+                self.downloaded_path,
+                self.source.size,
+                self.video_duration,
+                self.source.contiguous_bytes(),
+                index_on_disk=self._index_on_disk(),
+                priority=PRIORITY_PROGRESSIVE,
+                key=(self.video_id, "index"),
+                movie_id=self.video_id,
+                kind="probe",
+            )
+            future.add_done_callback(lambda f: torrent_supervisor.post(self._on_index_refreshed, f))
+
+        # Keep the pieces of the next few segments at top priority
+        window_end = self.current_segment + PRIORITY_WINDOW
+        if self.prioritized_until < window_end:
+            for idx in range(max(self.prioritized_until, self.current_segment), window_end):
+                self.source.prioritize(*segment_byte_range(service, self.source, self.video_id, idx, self.video_duration))
+            self.prioritized_until = window_end
+
+        seg_start, seg_end = segment_byte_range(service, self.source, self.video_id, self.current_segment, self.video_duration)
+        if not self.source.have_range(seg_start, seg_end):
+            # Re-checked when one of these pieces finishes
+            self.waiting_for = self.source.piece_range(seg_start, seg_end)
+            return
+        self.waiting_for = None
+
+        segment_index = self.current_segment
+        renditions = active_renditions(self.video_id)
+        if renditions != self.producing:
+            if self.producing is not None:
+                logger.info(f"Ladder for movie={self.video_id} now {','.join(renditions)} from segment {segment_index}")
+            self.producing = renditions
+            self.publish_status(producing=renditions)
+        # Renditions that just gained demand also need their earlier segments
+        for res in renditions:
+            self._queue_extra(res, segment_index)
+        priority = PRIORITY_FIRST_SEGMENT if segment_index < STARTUP_SEGMENTS else PRIORITY_PROGRESSIVE
+        self.segment_inflight = True
+        future = transcode_scheduler.submit(
+            convert_segment,
+            service,
+            self.source,
+            self.downloaded_path,
+            self.movie_dir,
+            self.video_id,
+            segment_index,
+            renditions,
+            duration=self.video_duration,
+            priority=priority,
+            key=(self.video_id, segment_index, tuple(renditions)),
+            movie_id=self.video_id,
+        )
+        future.add_done_callback(
+            lambda f: torrent_supervisor.post(self._on_segment_done, segment_index, renditions, f)
+        )
+
+    def _on_segment_done(self, segment_index, renditions, future):
+        self.segment_inflight = False
+        if self.state != "converting":
+            return
+        if future.result():
+            for res in renditions:
+                self.extra_done[res] = segment_index + 1
+            self.current_segment = segment_index + 1
+            self._segment_ready(segment_index)
+        else:
+            self.retry_at = time.time() + 2
+        self._advance()
+
+    def _check_passthrough(self):
+        """
+        Drop passthrough for the whole title once a segment the index covers has
+        no keyframe to cut at (GOP longer than a segment): the copy rung could not
+        tile the timeline. Its copied segments are withdrawn and re-encoded.
+        """
+        ladder = source_ladder(self.video_id)
+        if not ladder.copy or self.index is None:
+            return
+        service = self.service
+        if self.index.failed:
+            # The index will not grow: segments it does not cover could never be cut
+            reason = "its keyframe index cannot be read"
+        else:
+            for idx in range(service.expected_segments(self.video_duration)):
+                start_time = idx * service.segment_duration
+                if not self.index.covers(start_time + service.segment_duration):
+                    return
+                if self.index.keyframe_span(start_time, start_time + service.segment_duration) is None:
+                    break
+            else:
+                return
+            reason = f"segment {idx} has no keyframe to cut at"
+        res = ladder.copy
+        logger.warning(f"Passthrough dropped for movie={self.video_id}: {reason}; encoding {res} instead of copying it")
+        ladder.copy = None
+        ladder.dims.pop(res, None)
+        ladder.bandwidth.pop(res, None)
+        ladder.save(self.movie_dir)
+        set_source_ladder(self.video_id, ladder)
+        for published in range(max(self.extra_done.get(res, 0), self.current_segment)):
+            discard_segment(self.movie_dir, published, [res])
+        self.extra_done[res] = 0
+
+    def _on_index_refreshed(self, future):
+        self.index_refreshing = False
+        self.index_refreshed_at = time.time()
+        if self.state != "converting":
+            return
+        index = future.result()
+        if index.failed:
+            # Keep what was indexed; the probe would only fail again
+            self.index.failed = True
+        else:
+            self.index = index
+            register_index(self.video_id, self.index)
+        self._check_passthrough()
+        self.prioritized_until = self.current_segment
+        self._advance()
+
+    # -- Finalization (own thread: waits on backfill and packaging) --
+
+    def _finalize(self):
+        try:
+            self._package()
+        except Exception as e:
+            self.fail(e)
+
+    def _backfill(self, indices, renditions, priority=PRIORITY_BACKFILL):
+        service = self.service
+        futures = [
+            transcode_scheduler.submit(
+                convert_segment,
+                service,
+                self.source,
+                self.downloaded_path,
+                self.movie_dir,
+                self.video_id,
+                idx,
+                renditions,
+                duration=self.video_duration,
+                priority=priority,
+                key=(self.video_id, idx, tuple(renditions)),
+                movie_id=self.video_id,
+            )
+            for idx in indices
+            if service.missing_renditions(self.movie_dir, idx, renditions)
+        ]
+        if not futures:
+            return
+        logger.info(f"Queueing {len(futures)} backfill segments ({','.join(renditions)}) for movie={self.video_id}")
+        with timelines.span(self.video_id, "backfill", segments=len(futures), renditions=",".join(renditions)):
+            for f in futures: f.result()
+
+    def _package(self):
+        service = self.service
+        video_id = self.video_id
+        movie_dir = self.movie_dir
+        video_duration = self.video_duration
+        packager = self.packager
+
+        if packager:
+            if self.packager_future.result():
+                self.current_segment = packager.completed_segments()
+                logger.info(f"Incremental packaging complete for movie={video_id}")
+            else:
+                self.current_segment = packager.completed_segments()
+                discard_segment(movie_dir, self.current_segment, packager.renditions)
+                logger.warning(f"Incremental packager failed at segment {self.current_segment} for movie={video_id}")
+
+        # The download is complete: index the whole file so passthrough can cut every segment
+        if self.index is not None and not self.index.complete:
+            with timelines.span(video_id, "keyframe_index", final=True):
+                self.index = MediaByteIndex.probe(self.downloaded_path, self.source.size, video_duration, self.source.size)
+            register_index(video_id, self.index)
+            self._check_passthrough()
+
+        # Renditions the title ships with; the rest of the ladder is filled in at idle
+        final_renditions = active_renditions(video_id)
+        idle_renditions = [r for r in source_ladder(video_id).renditions if r not in final_renditions]
+
+        for f in self.extra_futures: f.result()
+        if video_duration:
+            total_segs = service.expected_segments(video_duration)
+            self._backfill(range(total_segs), final_renditions)
+
+        # Finalize VOD playlists from the progressive segments; only re-encode what is missing or broken
+        try:
+            with timelines.span(video_id, "finalize_playlists") as span:
+                broken = service.finalize_playlists(movie_dir, video_duration, final_renditions) if video_duration else None
+                span["broken"] = len(broken) if broken is not None else None
+            if broken:
+                logger.warning(f"Re-encoding {len(broken)} missing/broken segments for movie={video_id}")
+                for idx in broken: discard_segment(movie_dir, idx, final_renditions)
+                self._backfill(broken, final_renditions)
+                with timelines.span(video_id, "finalize_playlists", retry=True):
+                    broken = service.finalize_playlists(movie_dir, video_duration, final_renditions)
+
+            if broken is None or broken:
+                logger.warning(f"Segment finalization failed; running full HLS packaging for movie={video_id}")
+                idle_renditions = []
+                with timelines.span(video_id, "hls_package") as span:
+                    out_ok = span["ok"] = transcode_scheduler.submit(
+                        service.transcode_to_hls,
+                        self.downloaded_path,
+                        movie_dir,
+                        segment_time=service.segment_duration,
+                        renditions=source_ladder(video_id).renditions,
+                        audio=source_ladder(video_id).audio,
+                        priority=PRIORITY_BACKFILL,
+                        key=(video_id, "package"),
+                        movie_id=video_id,
+                        kind="package",
+                    ).result()
+                if out_ok:
+                    logger.info(f"Final HLS packaging complete for movie={video_id}")
+                else:
+                    logger.warning(f"Final HLS packaging failed; continuing with progressive segments for movie={video_id}")
+            else:
+                logger.info(f"VOD playlists finalized from progressive segments for movie={video_id}")
+        except Exception as e:
+            logger.warning(f"HLS finalization exception: {e}")
+
+        if HLS_FORMAT == "cmaf":
+            self._package_cmaf(final_renditions, PRIORITY_BACKFILL)
+
+        progress_writer.transition(self.movie_file, "READY", download_progress=100)
+        self.publish_variants()
+        self.publish_status(swarm={"seeds": 0, "peers": 0, "down_kbps": 0.0})
+        logger.info(f"Processing complete for {video_id}")
+
+        self._idle_backfill(idle_renditions)
+        self._enter("done")
+        self._drop_status()
+        torrent_supervisor.detach(self)
+        self.finished.set()
+
+    def _drop_status(self):
+        """A finished pipeline's snapshot goes; the status endpoint reads the written row from then on."""
+        if self.movie_file:
+            progress_writer.flush([self.video_id])
+        status_registry.drop(self.video_id)
+
+    def _idle_backfill(self, idle_renditions):
+        """
+        Lazy ladder: fill in the renditions nobody asked for when the node is
+        idle. The keyframe index stays registered until then (the copy rung
+        is often one of them), and is kept among the finished titles' after.
+        """
+        service = self.service
+        video_id = self.video_id
+        if self.video_duration:
+            for res in idle_renditions:
+                try:
+                    self._backfill(range(service.expected_segments(self.video_duration)), [res], priority=PRIORITY_IDLE)
+                    if not service.finalize_playlists(self.movie_dir, self.video_duration, [res]):
+                        logger.info(f"Idle backfill finished {res} for movie={video_id}")
+                        if HLS_FORMAT == "cmaf":
+                            self._package_cmaf([res], PRIORITY_IDLE)
+                    self.publish_variants()
+                except Exception as e:
+                    logger.warning(f"Idle backfill of {res} failed for movie={video_id}: {e}")
+        retire_index(video_id)
+
+    def _package_cmaf(self, renditions, priority):
+        """Swap finished renditions over to single-file fMP4 (remux only)."""
+        with timelines.span(self.video_id, "cmaf_package", renditions=",".join(renditions)):
+            packaged = transcode_scheduler.submit(
+                self.service.package_cmaf,
+                self.movie_dir,
+                renditions,
+                priority=priority,
+                key=(self.video_id, "cmaf", tuple(renditions)),
+                movie_id=self.video_id,
+                kind="package",
+            ).result()
+        if packaged:
+            logger.info(f"CMAF renditions ready for movie={self.video_id}: {','.join(packaged)}")
+
+    def fail(self, e):
+        if self.state in ("error", "done"):
+            return
+        now = time.time()
+        timelines.record(self.video_id, "error", now, now, error=str(e), phase_failed=self.state)
+        self._enter("error")
+        drop_index(self.video_id)
+        if self.packager:
+            self.packager.stop()
+        # Log final swarm stats if available
+        if self.handle and self.handle.is_valid():
+            logger.error(
+                f"Thread Error: {e} | final swarm movie={self.video_id} seeds={self.swarm['seeds']} "
+                f"peers={self.swarm['peers']} down={self.swarm['down_kbps']:.1f} kB/s"
+            )
+        else:
+            logger.error(f"Thread Error: {e} | no valid torrent handle for movie={self.video_id}")
+        try:
+            if self.movie_file:
+                progress_writer.transition(self.movie_file, "ERROR")
+                # Ensure we remove any lingering torrent handle
+                try:
+                    if self.info_hash:
+                        torrent_manager.remove_torrent(self.info_hash)
+                        logger.info(f"Removed torrent handle for movie={self.movie_file.id} after error")
+                except Exception as re:
+                    logger.warning(f"Failed to remove torrent after error: {re}")
+        finally:
+            self._drop_status()
+            torrent_supervisor.detach(self)
+            self.finished.set()
+
+
+def process_video_thread(video_id, wait=True):
+    """
+    Download and convert a movie. The work is driven by the shared torrent
+    supervisor, so wait=False returns as soon as the torrent is added;
+    wait=True blocks until the title is READY or ERROR.
+    """
+    start_torrent_engine()
+    pipeline = MoviePipeline(video_id)
+    if pipeline.start() and wait:
+        pipeline.finished.wait()
+    return pipeline
@@ -0,0 +1,109 @@
+import logging
+import os
+import threading
+import time
+
+from django.db import close_old_connections
+
+from .models import MovieFile
+from .tracing import timelines
+
+logger = logging.getLogger(__name__)
+
+
+class ProgressWriter:
+    """
+    Coalesces MovieFile updates from every running pipeline.
+    Pipelines record changed fields here instead of calling save(); a
+    background thread flushes them every FLUSH_INTERVAL seconds with one
+    bulk_update per set of changed fields, so only those columns are
+    written and concurrent writes to other fields (last_watched) survive.
+    Status transitions wake the thread to flush their movie straight away.
+    Batches are taken and written under one lock, in order, so an older
+    batch can never land after a newer status, whichever thread flushes.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(ProgressWriter, cls).__new__(cls)
+                cls._instance._initialize()
+            return cls._instance
+
+    def _initialize(self):
+        self.interval = float(os.getenv("PROGRESS_FLUSH_INTERVAL", "5"))
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # Movies with a status transition waiting, and the event that wakes the writer for them
+        self._urgent = set()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="progress-writer", daemon=True)
+        self._thread.start()
+
+    def update(self, movie_file, **fields):
+        """Apply fields to the in-memory row and queue them for the next flush."""
+        for name, value in fields.items():
+            setattr(movie_file, name, value)
+        with self._pending_lock:
+            self._pending.setdefault(movie_file.id, {}).update(fields)
+
+    def transition(self, movie_file, download_status, **fields):
+        """Change the status and have it written (with anything else pending for the movie) now."""
+        self.update(movie_file, download_status=download_status, **fields)
+        with self._pending_lock:
+            self._urgent.add(movie_file.id)
+        self._wake.set()
+
+    def flush(self, movie_ids=None):
+        with self._flush_lock:
+            self._flush(movie_ids)
+
+    def _flush(self, movie_ids):
+        with self._pending_lock:
+            if movie_ids is None:
+                batch, self._pending = self._pending, {}
+            else:
+                batch = {mid: self._pending.pop(mid) for mid in movie_ids if mid in self._pending}
+        if not batch:
+            return
+
+        groups = {}
+        for movie_id, fields in batch.items():
+            groups.setdefault(tuple(sorted(fields)), []).append(MovieFile(id=movie_id, **fields))
+        started = time.time()
+        try:
+            for field_names, rows in groups.items():
+                MovieFile.objects.bulk_update(rows, list(field_names))
+            flushed = time.time()
+            for movie_id, fields in batch.items():
+                timelines.record(movie_id, "db_flush", started, flushed, fields=",".join(sorted(fields)), rows=len(batch))
+        except Exception as e:
+            logger.warning(f"Progress flush failed for {len(batch)} movies: {e}")
+            # Keep the values for the next attempt unless newer ones arrived meanwhile
+            with self._pending_lock:
+                for movie_id, fields in batch.items():
+                    self._pending[movie_id] = {**fields, **self._pending.get(movie_id, {})}
+
+    def _run(self):
+        next_flush = time.time() + self.interval
+        while True:
+            self._wake.wait(max(0, next_flush - time.time()))
+            # Cleared before taking the set, so a transition queued meanwhile wakes the next pass
+            self._wake.clear()
+            with self._pending_lock:
+                urgent, self._urgent = self._urgent, set()
+            try:
+                close_old_connections()
+                if time.time() >= next_flush:
+                    next_flush = time.time() + self.interval
+                    self.flush()
+                elif urgent:
+                    self.flush(urgent)
+            except Exception as e:
+                logger.error(f"Progress writer error: {e}")
+
+
+progress_writer = ProgressWriter()
@@ -0,0 +1,54 @@
+import fcntl
+import logging
+import os
+import threading
+
+from django.conf import settings
+
+from .models import MovieFile
+
+logger = logging.getLogger(__name__)
+
+# Statuses a pipeline leaves behind when the process dies mid-download
+INTERRUPTED_STATUSES = ("DOWNLOADING", "DL_AND_CONVERT", "PLAYABLE", "CONVERTING")
+RECOVERY_ENABLED = os.getenv("PIPELINE_RECOVERY", "1") == "1"
+RECOVERY_DELAY = float(os.getenv("PIPELINE_RECOVERY_DELAY", "5"))
+
+# Held for the life of the process that won the recovery lock
+_lock_file = None
+
+
+def recover_pipelines(engine):
+    """
+    Restart every pipeline a previous process left unfinished. Torrents are
+    re-added from their resume data and each pipeline continues from the
+    first segment missing on disk.
+    """
+    movies = MovieFile.objects.filter(download_status__in=INTERRUPTED_STATUSES).exclude(magnet_link="")
+    for movie in movies:
+        logger.info(f"Recovering interrupted pipeline for movie={movie.id} (was {movie.download_status})")
+        try:
+            if not engine.add(movie.id)["started"]:
+                logger.info(f"Pipeline for movie={movie.id} was already running")
+        except Exception as e:
+            logger.error(f"Recovery failed for movie={movie.id}: {e}")
+
+
+def schedule_recovery(engine):
+    """
+    Run recover_pipelines shortly after startup, in one process per node:
+    the first process to take the lock owns recovery.
+    """
+    global _lock_file
+    if not RECOVERY_ENABLED or _lock_file is not None:
+        return
+    try:
+        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+        lock_file = open(os.path.join(settings.MEDIA_ROOT, ".recovery.lock"), "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return
+    _lock_file = lock_file
+    timer = threading.Timer(RECOVERY_DELAY, recover_pipelines, args=(engine,))
+    timer.daemon = True
+    timer.start()
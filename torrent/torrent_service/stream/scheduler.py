@@ -0,0 +1,252 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+from .calibration import encoder_settings
+from .metrics import metrics_registry
+
+logger = logging.getLogger(__name__)
+
+# Lower value runs first.
+PRIORITY_FIRST_SEGMENT = 0   # startup segments for a viewer who is waiting
+PRIORITY_PROGRESSIVE = 10    # in-order segments while the download is running
+PRIORITY_BACKFILL = 20       # tail of finished downloads, final packaging
+PRIORITY_IDLE = 30           # optional work (extra renditions) done only when nothing else waits
+
+PRIORITY_NAMES = {
+    PRIORITY_FIRST_SEGMENT: "first_segment",
+    PRIORITY_PROGRESSIVE: "progressive",
+    PRIORITY_BACKFILL: "backfill",
+    PRIORITY_IDLE: "idle",
+}
+
+# How many leading segments of a title are treated as startup work
+STARTUP_SEGMENTS = 3
+
+
+def default_slots():
+    """Calibrated slot count, else one ffmpeg slot per FFMPEG_THREADS cores; never less than one."""
+    return encoder_settings()["slots"]
+
+
+class _Job:
+    def __init__(self, fn, args, kwargs, priority, key, movie_id, kind):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.key = key
+        self.movie_id = movie_id
+        self.kind = kind
+        self.future = Future()
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.thread = None
+
+
+class TranscodeScheduler:
+    """
+    Process-wide ffmpeg job queue with a fixed slot budget.
+    Every ffmpeg invocation goes through here, so the node runs at most
+    FFMPEG_SLOTS encoders no matter how many titles are active.
+    """
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls):
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = super(TranscodeScheduler, cls).__new__(cls)
+                cls._instance._initialize()
+            return cls._instance
+
+    def _initialize(self):
+        self.slots = int(os.getenv("FFMPEG_SLOTS", str(default_slots())))
+        self._cond = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        self._jobs = {}
+        self._running = set()
+        self._waits = deque(maxlen=500)
+        self._completed = 0
+        self._failed = 0
+        self._workers = set()
+        self._start_workers()
+        logger.info(f"Transcode scheduler started with {self.slots} ffmpeg slots")
+
+    def submit(self, fn, *args, priority=PRIORITY_PROGRESSIVE, key=None, movie_id=None, kind="segment", **kwargs):
+        """
+        Queue fn(*args, **kwargs) and return a Future.
+        Jobs sharing a key are deduplicated: the existing future is returned and,
+        if the new request is more urgent, the queued job is promoted.
+        """
+        with self._cond:
+            if key is not None and key in self._jobs:
+                job = self._jobs[key]
+                if job.started_at is None and priority < job.priority:
+                    job.priority = priority
+                    heapq.heappush(self._queue, (priority, next(self._seq), job))
+                    self._cond.notify()
+                return job.future
+
+            job = _Job(fn, args, kwargs, priority, key, movie_id, kind)
+            if key is not None:
+                self._jobs[key] = job
+            heapq.heappush(self._queue, (priority, next(self._seq), job))
+            self._cond.notify()
+            return job.future
+
+    def _start_workers(self):
+        # Caller holds the condition, or runs before any worker exists
+        for i in range(self.slots):
+            if i not in self._workers:
+                self._workers.add(i)
+                threading.Thread(target=self._worker_loop, args=(i,), name=f"ffmpeg-slot-{i}", daemon=True).start()
+
+    def resize(self, slots):
+        """Change the slot budget. Extra workers leave once their current job is done."""
+        slots = max(1, int(slots))
+        with self._cond:
+            if slots == self.slots:
+                return
+            logger.info(f"Transcode scheduler resized from {self.slots} to {slots} ffmpeg slots")
+            self.slots = slots
+            self._start_workers()
+            self._cond.notify_all()
+
+    def _next_job(self, slot):
+        with self._cond:
+            while True:
+                if slot >= self.slots:
+                    self._workers.discard(slot)
+                    return None
+                while self._queue:
+                    priority, _, job = heapq.heappop(self._queue)
+                    # Stale heap entry left behind by a promotion
+                    if job.started_at is not None or priority != job.priority:
+                        continue
+                    job.started_at = time.time()
+                    job.thread = threading.get_ident()
+                    self._running.add(job)
+                    self._waits.append((job.priority, job.started_at - job.enqueued_at))
+                    return job
+                self._cond.wait()
+
+    def _worker_loop(self, slot):
+        while True:
+            job = self._next_job(slot)
+            if job is None:
+                return
+            ok = False
+            try:
+                if job.future.set_running_or_notify_cancel():
+                    job.future.set_result(job.fn(*job.args, **job.kwargs))
+                    ok = True
+            except Exception as e:
+                logger.error(f"Scheduled {job.kind} job failed for movie={job.movie_id}: {e}")
+                job.future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._running.discard(job)
+                    if job.key is not None and self._jobs.get(job.key) is job:
+                        del self._jobs[job.key]
+                    if ok:
+                        self._completed += 1
+                    else:
+                        self._failed += 1
+
+    def has_headroom(self):
+        """True when nothing is waiting and at least one ffmpeg slot is free."""
+        with self._cond:
+            waiting = any(job.started_at is None for _, _, job in self._queue)
+            return not waiting and len(self._running) < self.slots
+
+    def threads_running(self, movie_id):
+        """Idents of the slot threads running one of the movie's jobs right now."""
+        with self._cond:
+            return {job.thread for job in self._running if job.movie_id == movie_id}
+
+    def queued_by_movie(self):
+        """Jobs waiting for a slot, per movie."""
+        with self._cond:
+            jobs = {id(job): job for priority, _, job in self._queue if job.started_at is None and priority == job.priority}
+        queued = {}
+        for job in jobs.values():
+            queued[job.movie_id] = queued.get(job.movie_id, 0) + 1
+        return queued
+
+    def stats(self):
+        """Queue depth, running jobs and recent wait times, for capacity planning."""
+        now = time.time()
+        with self._cond:
+            queued = {}
+            seen = set()
+            for priority, _, job in self._queue:
+                if job.started_at is not None or priority != job.priority or id(job) in seen:
+                    continue
+                seen.add(id(job))
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                queued[name] = queued.get(name, 0) + 1
+            running = [
+                {
+                    "movie_id": job.movie_id,
+                    "kind": job.kind,
+                    "priority": PRIORITY_NAMES.get(job.priority, str(job.priority)),
+                    "running_s": round(now - job.started_at, 1),
+                }
+                for job in self._running
+            ]
+            waits = {}
+            for priority, wait in self._waits:
+                waits.setdefault(PRIORITY_NAMES.get(priority, str(priority)), []).append(wait)
+            completed, failed = self._completed, self._failed
+
+        wait_stats = {}
+        for name, values in waits.items():
+            values.sort()
+            wait_stats[name] = {
+                "count": len(values),
+                "p50_s": round(values[len(values) // 2], 3),
+                "max_s": round(values[-1], 3),
+            }
+
+        return {
+            "slots": self.slots,
+            "queued": queued,
+            "queue_depth": sum(queued.values()),
+            "running": running,
+            "completed": completed,
+            "failed": failed,
+            "wait": wait_stats,
+        }
+
+
+transcode_scheduler = TranscodeScheduler()
+
+metrics_registry.gauge(
+    "hyperflix_transcode_slots",
+    "ffmpeg slots of this node",
+    collect=lambda: [((), transcode_scheduler.slots)],
+)
+metrics_registry.gauge(
+    "hyperflix_transcode_running",
+    "Transcode jobs holding a slot",
+    collect=lambda: [((), len(transcode_scheduler.stats()["running"]))],
+)
+metrics_registry.gauge(
+    "hyperflix_transcode_queued",
+    "Transcode jobs waiting for a slot, by priority",
+    labels=("priority",),
+    collect=lambda: [((name,), n) for name, n in transcode_scheduler.stats()["queued"].items()],
+)
+metrics_registry.gauge(
+    "hyperflix_segment_backlog",
+    "Transcode jobs waiting for a slot, per movie",
+    labels=("movie",),
+    collect=lambda: [((str(movie_id),), n) for movie_id, n in transcode_scheduler.queued_by_movie().items()],
+)
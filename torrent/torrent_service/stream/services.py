@@ -1,23 +1,111 @@
 import logging
 import os
-from typing import Optional, Union
-from django.http import StreamingHttpResponse, FileResponse
-import re, os
+import re
 import time
 from .models import MovieFile
 from django.conf import settings
 import requests, subprocess
+import threading
+import math
+import json
+import shutil
+from contextlib import contextmanager
 from concurrent.futures import ThreadPoolExecutor
-import concurrent.futures
+from .calibration import encoder_settings
+from .load import load_governor
+from .manifest import PARTIAL_SUFFIX, read_manifest, record_segment, retract_segment
+from .metrics import ffmpeg_failures, segment_encode_realtime, segment_encode_seconds
 
 logger = logging.getLogger(__name__)
 range_re = re.compile(r"bytes\s*=\s*(\d+)\s*-\s*(\d*)", re.I)
+segment_name_re = re.compile(r"segment_(\d+)\.ts")
+
+# ABR ladder: (folder, height, bitrate, bufsize)
+RENDITIONS = [
+    ("1080p", 1080, "5000k", "10000k"),
+    ("720p",  720,  "3000k", "6000k"),
+    ("480p",  480,  "1500k", "3000k"),
+    ("360p",  360,  "800k",  "1600k"),
+]
+RESOLUTIONS = [r[0] for r in RENDITIONS]
+
+# Shared HLS audio group: audio is packaged once, in its own folder, and
+# every video rendition references it from the master playlist.
+AUDIO_RENDITION = "audio"
+ALL_RENDITIONS = RESOLUTIONS + [AUDIO_RENDITION]
+
+# Containers ffmpeg can demux from a forward-only pipe
+STREAMABLE_EXTENSIONS = (".mkv", ".webm", ".avi", ".ts", ".m2ts", ".mpg", ".mpeg", ".flv")
+MP4_EXTENSIONS = (".mp4", ".m4v", ".mov")
+
+# "ts": finished renditions keep one .ts file per segment
+# "cmaf": they are remuxed into one fragmented MP4 plus an init segment,
+# listed with EXT-X-BYTERANGE and served by nginx straight from /media
+HLS_FORMAT = os.getenv("HLS_FORMAT", "ts")
+CMAF_FILE = "stream.m4s"
+CMAF_INIT = "init.mp4"
+# Seconds the .ts segments outlive their CMAF replacement, for players holding the old playlist
+CMAF_SEGMENT_GRACE = int(os.getenv("CMAF_SEGMENT_GRACE", "600"))
+
+
+def rendition_box(height):
+    """The 16:9 frame a rung fits its picture into."""
+    return height * 16 // 9 // 2 * 2, height
+
+
+def fit_rendition(width, height, rung):
+    """Output size of a width x height source in a rung: fitted into its box, never upscaled, even dimensions."""
+    box_w, box_h = rendition_box(rung)
+    scale = min(box_w / width, box_h / height, 1.0)
+    return int(width * scale) // 2 * 2, int(height * scale) // 2 * 2
+
+
+def ladder_filter(renditions):
+    """
+    Split the decoded video once and scale it for every rendition. Each
+    rendition is fitted into its 16:9 box, so a 1920x800 source stays
+    1920x800 in the 1080p rung instead of being stretched to 1080 lines.
+    Returns (filter, labels).
+    """
+    labels = [f"[v{height}]" for _, height, _, _ in renditions]
+    graph = [f"[0:v]split={len(renditions)}" + "".join(f"[s{height}]" for _, height, _, _ in renditions)]
+    for _, height, _, _ in renditions:
+        box_w, box_h = rendition_box(height)
+        graph.append(
+            f"[s{height}]scale=w='min({box_w},iw)':h='min({box_h},ih)':force_original_aspect_ratio=decrease"
+            f":force_divisible_by=2:flags=bicubic,format=yuv420p[v{height}]"
+        )
+    return ";".join(graph), labels
+
+
+_segment_locks = {}
+_segment_locks_guard = threading.Lock()
+
+
+@contextmanager
+def _segment_lock(output_dir, segment_index):
+    """Serialize encoders touching the same segment (pipeline, JIT and backfill can overlap)."""
+    key = (output_dir, segment_index)
+    with _segment_locks_guard:
+        entry = _segment_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _segment_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                _segment_locks.pop(key, None)
+
 
 class VideoService:
     def __init__(self):
         self.segment_duration = 10 
-        self.ffmpeg_threads = int(os.getenv("FFMPEG_THREADS", "2"))
-        self.ffmpeg_preset = os.getenv("FFMPEG_PRESET", "superfast")
+        # Environment, else this node's calibration (manage.py calibrate_encoder), else defaults
+        encoder = encoder_settings()
+        self.ffmpeg_threads = encoder["threads"]
+        self.ffmpeg_preset = encoder["preset"]
 
     def get_video_duration(self, file_path):
         try:
@@ -32,32 +120,114 @@ class VideoService:
         except Exception:
             return None
 
-    def convert_all_segments(self, source_path, output_dir, segment_index):
+    def video_encode_args(self, bitrate, bufsize, segment_time):
+        return [
+            '-c:v', 'libx264',
+            '-b:v', bitrate,
+            '-maxrate', bitrate,
+            '-bufsize', bufsize,
+            '-preset', self.ffmpeg_preset,
+            '-profile:v', 'high',    # Better compression efficiency (looks sharper)
+            '-level', '4.1',         # Broad compatibility
+            '-crf', '23',            # Quality target (helps static scenes look better)
+            '-force_key_frames', f'expr:gte(t,n_forced*{segment_time})',
+        ]
+
+    def audio_encode_args(self):
+        return ['-map', '0:a:0?', '-c:a', 'aac', '-b:a', '128k', '-ac', '2', '-ar', '44100']
+
+    def rendition_audio_args(self, audio):
+        """Audio for a video rendition: none when the shared audio group carries it."""
+        return ['-an'] if audio else self.audio_encode_args()
+
+    def audio_group_args(self, audio):
+        """Audio-only output for the shared group: stream copy for AAC sources, AAC encode otherwise."""
+        if audio == 'copy':
+            return ['-map', '0:a:0', '-vn', '-c:a', 'copy']
+        return ['-map', '0:a:0', '-vn', '-c:a', 'aac', '-b:a', '128k', '-ac', '2', '-ar', '44100']
+
+    def segment_path(self, output_dir, res, segment_index):
+        return os.path.join(output_dir, res, f"segment_{segment_index:03d}.ts")
+
+    def publish_segment(self, output_dir, res, segment_index, duration=None):
         """
-        CPU-Safe Transcoding (Includes 1080p).
-        Locked to 2 Cores + Ultrafast Preset to prevent System Freeze.
+        Rename a finished segment from its .part name into place and journal it,
+        so players never see a segment ffmpeg is still writing.
         """
+        final_path = self.segment_path(output_dir, res, segment_index)
+        os.replace(final_path + PARTIAL_SUFFIX, final_path)
+        if duration is None:
+            duration = self.probe_segment_duration(final_path) or float(self.segment_duration)
+        record_segment(os.path.join(output_dir, res), segment_index, duration)
+
+    def journal_playlist(self, rendition_dir):
+        """
+        Journal the segments a whole-file ffmpeg run listed in its playlist,
+        with their real durations, and withdraw older entries it did not
+        produce, so the journal describes the segments on disk.
+        """
+        produced = {}
+        duration = None
+        with open(os.path.join(rendition_dir, 'index.m3u8')) as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith("#EXTINF:"):
+                    duration = float(line[len("#EXTINF:"):].split(",", 1)[0])
+                elif line and not line.startswith("#") and duration is not None:
+                    match = segment_name_re.fullmatch(os.path.basename(line))
+                    if match:
+                        produced[int(match.group(1))] = duration
+                    duration = None
+        for idx in read_manifest(rendition_dir):
+            if idx not in produced:
+                retract_segment(rendition_dir, idx)
+        for idx, seg_duration in sorted(produced.items()):
+            record_segment(rendition_dir, idx, seg_duration)
+
+    def missing_renditions(self, output_dir, segment_index, renditions=None):
+        """Renditions (in ladder order) whose segment is absent or empty."""
+        wanted = renditions or RESOLUTIONS
+        missing = []
+        for res in ALL_RENDITIONS:
+            if res not in wanted or self.is_cmaf(output_dir, res):
+                continue
+            path = self.segment_path(output_dir, res, segment_index)
+            if not (os.path.exists(path) and os.path.getsize(path) > 0):
+                missing.append(res)
+        return missing
+
+    def convert_all_segments(self, source_path, output_dir, segment_index, renditions=None, copy=None, audio=None):
+        """
+        Encode one segment's renditions in a single ffmpeg, with the preset
+        and thread count from encoder_settings() (the node's calibration).
+        Only the requested renditions that are not on disk yet are encoded.
+        copy=(rendition, start, end) stream-copies that rendition between two
+        source keyframes instead of encoding it. audio="aac"/"copy" strips
+        audio from the video renditions and writes it once to the audio folder.
+        """
+        with _segment_lock(output_dir, segment_index):
+            return self._convert_segment(source_path, output_dir, segment_index, renditions, copy, audio)
+
+    def _convert_segment(self, source_path, output_dir, segment_index, renditions, copy, audio):
         start_time = segment_index * self.segment_duration
-        
-        res_dirs = {}
-        resolutions = ["1080p", "720p", "480p", "360p"]
-        
-        for res in resolutions:
-            path = os.path.join(output_dir, res)
-            os.makedirs(path, exist_ok=True)
-            res_dirs[res] = os.path.join(path, f"segment_{segment_index:03d}.ts")
 
-        if all(os.path.exists(p) and os.path.getsize(p) > 0 for p in res_dirs.values()):
+        missing = self.missing_renditions(output_dir, segment_index, renditions)
+        if not missing:
             return True
+        for res in missing:
+            os.makedirs(os.path.join(output_dir, res), exist_ok=True)
 
-        # Split input into 4 streams (1080, 720, 480, 360)
-        filter_complex = (
-            "[0:v]split=4[v1][v2][v3][v4];"
-            "[v1]scale=-2:1080:flags=bicubic,format=yuv420p[1080out];"
-            "[v2]scale=-2:720:flags=bicubic,format=yuv420p[720out];"
-            "[v3]scale=-2:480:flags=bicubic,format=yuv420p[480out];"
-            "[v4]scale=-2:360:flags=bicubic,format=yuv420p[360out]"
-        )
+        if copy and copy[0] in missing:
+            copy_res, copy_start, copy_end = copy
+            copy_path = self.segment_path(output_dir, copy_res, segment_index) + PARTIAL_SUFFIX
+            if not self._copy_segment(source_path, copy_path, copy_start, copy_end, audio):
+                return False
+            self.publish_segment(output_dir, copy_res, segment_index, copy_end - copy_start)
+            missing.remove(copy_res)
+            if not missing:
+                return True
+
+        ladder = [r for r in RENDITIONS if r[0] in missing]
 
         cmd = [
             'ffmpeg', '-hide_banner', '-loglevel', 'error',
@@ -65,52 +235,518 @@ class VideoService:
             '-ss', str(start_time),
             '-t', str(self.segment_duration),
             '-i', source_path,
-            '-filter_complex', filter_complex,
         ]
 
-        # 3. Stream Configuration
-        configs = [
-            ("1080p", "[1080out]", "5000k", "10000k"),
-            ("720p",  "[720out]",  "3000k", "6000k"),
-            ("480p",  "[480out]",  "1500k", "3000k"),
-            ("360p",  "[360out]",  "800k",  "1600k"),
-        ]
+        outputs = []
+        if ladder:
+            # Split input into one stream per requested rendition
+            filter_complex, labels = ladder_filter(ladder)
+            cmd.extend(['-filter_complex', filter_complex])
+            for (res_name, _, bitrate, bufsize), map_label in zip(ladder, labels):
+                outputs.append((
+                    res_name,
+                    ['-map', map_label]
+                    + self.video_encode_args(bitrate, bufsize, self.segment_duration)
+                    + self.rendition_audio_args(audio),
+                ))
+        if audio and AUDIO_RENDITION in missing:
+            outputs.append((AUDIO_RENDITION, self.audio_group_args(audio)))
 
-        for res_name, map_label, bitrate, bufsize in configs:
+        for res_name, stream_args in outputs:
+            cmd.extend(stream_args)
             cmd.extend([
-                '-map', map_label,
-                '-c:v', 'libx264',
-                '-b:v', bitrate,
-                '-maxrate', bitrate,
-                '-bufsize', bufsize,
-                
-                '-preset', self.ffmpeg_preset,
-                '-profile:v', 'high',    # Better compression efficiency (looks sharper)
-                '-level', '4.1',         # Broad compatibility
-                '-crf', '23',            # Quality target (helps static scenes look better)
-                # Audio
-                '-map', '0:a:0?', '-c:a', 'aac', '-b:a', '128k', '-ac', '2', '-ar', '44100',
-                
                 # HLS Glue
-                '-force_key_frames', f'expr:gte(t,n_forced*{self.segment_duration})',
                 '-output_ts_offset', str(start_time),
                 '-muxdelay', '0',
                 
                 '-f', 'mpegts', '-y',
-                res_dirs[res_name]
+                self.segment_path(output_dir, res_name, segment_index) + PARTIAL_SUFFIX
             ])
 
+        if not outputs:
+            return True
+        started = time.time()
+        if not self._run_ffmpeg(cmd):
+            return False
+        elapsed = time.time() - started
+        segment_encode_seconds.observe(elapsed)
+        if elapsed > 0:
+            realtime = self.segment_duration / elapsed
+            segment_encode_realtime.observe(realtime)
+            load_governor.record_encode(realtime, [height for _, height, _, _ in ladder])
+        for res_name, _ in outputs:
+            self.publish_segment(output_dir, res_name, segment_index)
+        return True
+
+    def _copy_segment(self, source_path, output_path, start, end, audio=None):
+        """Passthrough: remux the source video between two keyframes, audio re-encoded to AAC."""
+        cmd = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-ss', f'{start:.6f}',
+            '-i', source_path,
+            '-t', f'{end - start:.6f}',
+            '-map', '0:v:0', '-c:v', 'copy',
+        ]
+        cmd.extend(self.rendition_audio_args(audio))
+        cmd.extend([
+            '-output_ts_offset', f'{start:.6f}',
+            '-muxdelay', '0',
+            '-f', 'mpegts', '-y',
+            output_path
+        ])
+        return self._run_ffmpeg(cmd)
+
+    def _run_ffmpeg(self, cmd):
         try:
             subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
             return True
         except subprocess.CalledProcessError as e:
             err = e.stderr.decode()
             if "invalid as first byte" in err or "Invalid data found" in err:
+                # Source bytes not there (yet): the segment is retried
+                ffmpeg_failures.inc(cause="invalid_data")
                 return False
             
+            ffmpeg_failures.inc(cause="encode")
             logger.error(f"FFmpeg CPU Error: {err}")
             return False
 
+    def probe_source(self, file_path):
+        """
+        Codec, profile, level, size and bitrate of the first video stream
+        (None if unreadable); info["audio"] describes the first audio stream
+        and info["duration"] is the container's length in seconds.
+        """
+        try:
+            cmd = [
+                'ffprobe', '-v', 'error',
+                '-show_entries',
+                'stream=codec_type,codec_name,profile,level,width,height,pix_fmt,bit_rate,channels:format=bit_rate,duration',
+                '-of', 'json',
+                file_path
+            ]
+            data = json.loads(subprocess.check_output(cmd, timeout=10).decode())
+            streams = data.get('streams') or []
+            video = [st for st in streams if st.get('codec_type') == 'video']
+            audio = [st for st in streams if st.get('codec_type') == 'audio']
+            if not video:
+                return None
+            info = dict(video[0])
+            info['audio'] = audio[0] if audio else None
+            try:
+                info['duration'] = float((data.get('format') or {}).get('duration'))
+            except (TypeError, ValueError):
+                info['duration'] = None
+            if not str(info.get('bit_rate') or '').isdigit():
+                # Matroska rarely carries a per-stream bitrate; the container's is close enough
+                info['bit_rate'] = (data.get('format') or {}).get('bit_rate')
+            return info
+        except Exception:
+            return None
+
+    def expected_segments(self, duration):
+        return max(1, math.ceil(round(duration / self.segment_duration, 3)))
+
+    def probe_segment_duration(self, segment_path):
+        """Real duration of a finished .ts segment, or None if it is unreadable."""
+        try:
+            if os.path.getsize(segment_path) == 0:
+                return None
+            cmd = [
+                'ffprobe', '-v', 'error',
+                '-show_entries', 'format=duration',
+                '-of', 'default=noprint_wrappers=1:nokey=1',
+                segment_path
+            ]
+            output = subprocess.check_output(cmd, timeout=10).decode().strip()
+            duration = float(output)
+            return duration if duration > 0 else None
+        except Exception:
+            return None
+
+    def finalize_playlists(self, output_dir, duration, renditions=None):
+        """
+        Build VOD index.m3u8 files from the segments already on disk,
+        using each segment's journaled (or probed) duration instead of
+        re-encoding the film.
+        Returns the indices of missing or broken segments; playlists are only
+        written when that list is empty.
+        """
+        expected = self.expected_segments(duration)
+        broken = set()
+        playlists = {}
+
+        with ThreadPoolExecutor(max_workers=4) as probes:
+            for res in renditions or RESOLUTIONS:
+                if self.is_cmaf(output_dir, res):
+                    continue
+                res_dir = os.path.join(output_dir, res)
+                journal = read_manifest(res_dir)
+                names = [f"segment_{idx:03d}.ts" for idx in range(expected)]
+                paths = [os.path.join(res_dir, name) for name in names]
+                durations = list(probes.map(
+                    lambda item: journal.get(item[0]) or self.probe_segment_duration(item[1]),
+                    enumerate(paths),
+                ))
+
+                # The ladder can legitimately end one segment early when the
+                # film length is a near-exact multiple of the segment duration.
+                if durations[-1] is None and not os.path.exists(paths[-1]) and expected > 1:
+                    covered = sum(d for d in durations[:-1] if d)
+                    if covered >= duration - self.segment_duration / 2:
+                        names, durations = names[:-1], durations[:-1]
+
+                for idx, seg_duration in enumerate(durations):
+                    if seg_duration is None:
+                        broken.add(idx)
+                playlists[res] = list(zip(names, durations))
+
+        if broken:
+            return sorted(broken)
+
+        for res, entries in playlists.items():
+            target = max(math.ceil(d) for _, d in entries)
+            lines = [
+                "#EXTM3U",
+                "#EXT-X-VERSION:3",
+                f"#EXT-X-TARGETDURATION:{target}",
+                "#EXT-X-MEDIA-SEQUENCE:0",
+                "#EXT-X-PLAYLIST-TYPE:VOD",
+                "#EXT-X-INDEPENDENT-SEGMENTS",
+            ]
+            for name, seg_duration in entries:
+                lines.append(f"#EXTINF:{seg_duration:.3f},")
+                lines.append(name)
+            lines.append("#EXT-X-ENDLIST")
+
+            playlist_path = os.path.join(output_dir, res, "index.m3u8")
+            tmp_path = playlist_path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, playlist_path)
+
+        return []
+
+    def is_cmaf(self, output_dir, res):
+        return os.path.exists(os.path.join(output_dir, res, CMAF_FILE))
+
+    def package_cmaf(self, output_dir, renditions):
+        """
+        Remux each rendition's finished .ts segments (as listed by its VOD
+        playlist) into CMAF_FILE + CMAF_INIT with an EXT-X-BYTERANGE playlist.
+        No re-encode. The playlist is swapped in last; the segments are
+        removed after CMAF_SEGMENT_GRACE. Returns the renditions packaged.
+        """
+        packaged = []
+        for res in renditions:
+            res_dir = os.path.join(output_dir, res)
+            playlist_path = os.path.join(res_dir, 'index.m3u8')
+            if self.is_cmaf(output_dir, res) or not os.path.exists(playlist_path):
+                continue
+            with open(playlist_path) as f:
+                names = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+            if not names:
+                continue
+
+            work_dir = os.path.join(res_dir, 'cmaf' + PARTIAL_SUFFIX)
+            shutil.rmtree(work_dir, ignore_errors=True)
+            os.makedirs(work_dir)
+            cmd = [
+                'ffmpeg', '-hide_banner', '-loglevel', 'error',
+                # Segments carry continuous timestamps, so plain byte concatenation is a valid stream
+                '-i', 'concat:' + '|'.join(os.path.join(res_dir, name) for name in names),
+                '-map', '0', '-c', 'copy',
+                '-f', 'hls',
+                '-hls_time', str(self.segment_duration),
+                '-hls_playlist_type', 'vod',
+                '-hls_segment_type', 'fmp4',
+                '-hls_flags', 'single_file+independent_segments',
+                '-hls_fmp4_init_filename', CMAF_INIT,
+                '-hls_segment_filename', os.path.join(work_dir, CMAF_FILE),
+                os.path.join(work_dir, 'index.m3u8'),
+            ]
+            try:
+                subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=600)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+                err = getattr(e, 'stderr', None)
+                ffmpeg_failures.inc(cause="timeout" if isinstance(e, subprocess.TimeoutExpired) else "cmaf")
+                logger.error(f"CMAF packaging of {res_dir} failed: {err.decode() if err else e}")
+                shutil.rmtree(work_dir, ignore_errors=True)
+                continue
+
+            os.replace(os.path.join(work_dir, CMAF_INIT), os.path.join(res_dir, CMAF_INIT))
+            os.replace(os.path.join(work_dir, CMAF_FILE), os.path.join(res_dir, CMAF_FILE))
+            os.replace(os.path.join(work_dir, 'index.m3u8'), playlist_path)
+            shutil.rmtree(work_dir, ignore_errors=True)
+            packaged.append(res)
+
+            segments = [os.path.join(res_dir, name) for name in names]
+            timer = threading.Timer(CMAF_SEGMENT_GRACE, self._remove_files, args=(segments,))
+            timer.daemon = True
+            timer.start()
+        return packaged
+
+    def _remove_files(self, paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def can_stream_package(self, source_path):
+        """
+        True when the source can be demuxed front to back from a pipe.
+        MP4 only qualifies when its moov atom precedes the media data.
+        """
+        ext = os.path.splitext(source_path)[1].lower()
+        if ext in STREAMABLE_EXTENSIONS:
+            return True
+        if ext not in MP4_EXTENSIONS:
+            return False
+        try:
+            with open(source_path, 'rb') as f:
+                pos = 0
+                for _ in range(16):
+                    f.seek(pos)
+                    head = f.read(16)
+                    if len(head) < 8:
+                        return False
+                    size = int.from_bytes(head[:4], 'big')
+                    box = head[4:8]
+                    if size == 1 and len(head) >= 16:
+                        size = int.from_bytes(head[8:16], 'big')
+                    if box == b'moov':
+                        return True
+                    if box == b'mdat' or size < 8:
+                        return False
+                    pos += size
+        except OSError:
+            pass
+        return False
+
+    def _ensure_dir(self, path: str):
+        try:
+            os.makedirs(path, exist_ok=True)
+        except Exception:
+            pass
+
+    def transcode_to_hls(self, source_path: str, output_dir: str, segment_time: int = 10, renditions=None, audio=None) -> bool:
+        """
+        Industry-standard HLS ABR packaging in a single pass.
+        Generates resolution-specific playlists and segments with aligned keyframes.
+        Output structure:
+            output_dir/
+              1080p/index.m3u8, segment_%03d.ts
+              720p/index.m3u8,  segment_%03d.ts
+              480p/index.m3u8,  segment_%03d.ts
+              360p/index.m3u8,  segment_%03d.ts
+              audio/index.m3u8, segment_%03d.ts   (shared audio group, when audio is set)
+        """
+        try:
+            ladder = [r for r in RENDITIONS if r[0] in (renditions or RESOLUTIONS)]
+            folders = [r[0] for r in ladder] + ([AUDIO_RENDITION] if audio else [])
+            self._ensure_dir(output_dir)
+            for res in folders:
+                self._ensure_dir(os.path.join(output_dir, res))
+
+            # If all variant playlists exist, assume done
+            if all(os.path.exists(os.path.join(output_dir, r, "index.m3u8")) for r in folders):
+                return True
+
+            filter_complex, labels = ladder_filter(ladder)
+
+            cmd = [
+                'ffmpeg', '-hide_banner', '-loglevel', 'error',
+                '-threads', str(self.ffmpeg_threads),
+                '-i', source_path,
+                '-filter_complex', filter_complex,
+            ]
+
+            # Variant configs: bitrate aligned, keyframe alignment enforced
+            outputs = [
+                (folder, ['-map', vlabel] + self.video_encode_args(bitrate, bufsize, segment_time) + self.rendition_audio_args(audio))
+                for (folder, _, bitrate, bufsize), vlabel in zip(ladder, labels)
+            ]
+            if audio:
+                outputs.append((AUDIO_RENDITION, self.audio_group_args(audio)))
+
+            for folder, stream_args in outputs:
+                variant_out_dir = os.path.join(output_dir, folder)
+                playlist_path = os.path.join(variant_out_dir, 'index.m3u8')
+                segment_pattern = os.path.join(variant_out_dir, 'segment_%03d.ts')
+
+                cmd.extend(stream_args)
+                cmd.extend([
+                    '-f', 'hls',
+                    '-hls_time', str(segment_time),
+                    '-hls_playlist_type', 'vod',
+                    # temp_file: segments already being served are replaced atomically
+                    '-hls_flags', 'independent_segments+temp_file',
+                    '-hls_segment_filename', segment_pattern,
+                    playlist_path
+                ])
+
+            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            for folder, _ in outputs:
+                self.journal_playlist(os.path.join(output_dir, folder))
+            return True
+        except subprocess.CalledProcessError as e:
+            err = e.stderr.decode() if e.stderr else str(e)
+            ffmpeg_failures.inc(cause="package")
+            logger.error(f"HLS packaging failed: {err}")
+            return False
+        except Exception as e:
+            logger.error(f"Unexpected HLS packaging error: {e}")
+            return False
+
+
+class HlsStreamPackager:
+    """
+    Incremental packaging: one long-lived ffmpeg per movie.
+    The growing download is fed to ffmpeg's stdin, but only up to the bytes
+    libtorrent has verified, so ffmpeg simply blocks when it catches up with
+    the download instead of failing on "Invalid data found". The segment
+    muxer writes segment_NNN.ts.part for every rendition as data arrives;
+    segments are published once the muxer lists them as finished.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+    SEGMENT_LIST = "segments.csv"
+
+    def __init__(self, service, source_path, output_dir, available_bytes, total_bytes, renditions=None, copy=None, audio=None):
+        self.service = service
+        self.renditions = renditions or RESOLUTIONS
+        self.copy = copy if copy in self.renditions else None
+        self.audio = audio if AUDIO_RENDITION in self.renditions else None
+        self.source_path = source_path
+        self.output_dir = output_dir
+        self.available_bytes = available_bytes
+        self.total_bytes = total_bytes
+        self.fed_bytes = 0
+        self._process = None
+        self._stopped = threading.Event()
+        self._published = {res: 0 for res in self.renditions}
+        self._publish_lock = threading.Lock()
+
+    def _build_command(self):
+        ladder = [r for r in RENDITIONS if r[0] in self.renditions and r[0] != self.copy]
+        seg = self.service.segment_duration
+        cmd = [
+            'ffmpeg', '-hide_banner', '-loglevel', 'error',
+            '-threads', str(self.service.ffmpeg_threads),
+            '-i', 'pipe:0',
+        ]
+        outputs = []
+        if ladder:
+            filter_complex, labels = ladder_filter(ladder)
+            cmd.extend(['-filter_complex', filter_complex])
+            for (res_name, _, bitrate, bufsize), map_label in zip(ladder, labels):
+                outputs.append((
+                    res_name,
+                    ['-map', map_label]
+                    + self.service.video_encode_args(bitrate, bufsize, seg)
+                    + self.service.rendition_audio_args(self.audio),
+                ))
+        if self.copy:
+            # Passthrough: the segment muxer cuts the copied stream on its own keyframes
+            outputs.insert(0, (self.copy, ['-map', '0:v:0', '-c:v', 'copy'] + self.service.rendition_audio_args(self.audio)))
+        if self.audio:
+            outputs.append((AUDIO_RENDITION, self.service.audio_group_args(self.audio)))
+
+        for res_name, stream_args in outputs:
+            res_dir = os.path.join(self.output_dir, res_name)
+            os.makedirs(res_dir, exist_ok=True)
+            cmd.extend(stream_args)
+            cmd.extend([
+                '-muxdelay', '0',
+                '-f', 'segment',
+                '-segment_time', str(seg),
+                '-segment_format', 'mpegts',
+                '-segment_list', os.path.join(res_dir, self.SEGMENT_LIST),
+                '-segment_list_type', 'csv',
+                '-y',
+                os.path.join(res_dir, 'segment_%03d.ts' + PARTIAL_SUFFIX),
+            ])
+        return cmd
+
+    def _feed(self):
+        """Copy verified bytes of the source into ffmpeg, pausing at the download frontier."""
+        try:
+            with open(self.source_path, 'rb') as src:
+                while not self._stopped.is_set() and self.fed_bytes < self.total_bytes:
+                    ready = min(self.available_bytes(), self.total_bytes)
+                    if ready <= self.fed_bytes:
+                        time.sleep(0.5)
+                        continue
+                    src.seek(self.fed_bytes)
+                    chunk = src.read(min(self.CHUNK_SIZE, ready - self.fed_bytes))
+                    if not chunk:
+                        time.sleep(0.5)
+                        continue
+                    self._process.stdin.write(chunk)
+                    self.fed_bytes += len(chunk)
+        except (BrokenPipeError, ValueError):
+            pass
+        except OSError as e:
+            logger.error(f"Stream packager feed error for {self.source_path}: {e}")
+        finally:
+            try:
+                self._process.stdin.close()
+            except Exception:
+                pass
+
+    def run(self):
+        """Blocks until ffmpeg has packaged the whole source. Returns True on success."""
+        self._process = subprocess.Popen(
+            self._build_command(),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        feeder = threading.Thread(target=self._feed, daemon=True)
+        feeder.start()
+        # Not communicate(): it would close stdin under the feeder
+        err = self._process.stderr.read()
+        self._process.wait()
+        feeder.join(timeout=5)
+        self.completed_segments()
+        if self._process.returncode != 0:
+            if not self._stopped.is_set():
+                ffmpeg_failures.inc(cause="stream_packager")
+                logger.error(f"Stream packager ffmpeg failed: {err.decode(errors='replace')}")
+            return False
+        return not self._stopped.is_set()
+
+    def stop(self):
+        self._stopped.set()
+        if self._process and self._process.poll() is None:
+            self._process.kill()
+
+    def completed_segments(self):
+        """
+        Publish the segments the muxers have listed as finished and return
+        how many are available in every rendition.
+        """
+        with self._publish_lock:
+            for res_name in self.renditions:
+                try:
+                    with open(os.path.join(self.output_dir, res_name, self.SEGMENT_LIST)) as f:
+                        listed = [line.strip().split(',') for line in f if line.strip()]
+                except OSError:
+                    continue
+                for parts in listed[self._published[res_name]:]:
+                    idx = self._published[res_name]
+                    try:
+                        duration = float(parts[2]) - float(parts[1])
+                    except (IndexError, ValueError):
+                        duration = None
+                    try:
+                        self.service.publish_segment(self.output_dir, res_name, idx, duration)
+                    except OSError:
+                        break
+                    self._published[res_name] = idx + 1
+            return min(self._published.values()) if self._published else 0
+
 # ++++++++++++++++++++++++++++++++++++++++++
 
 
@@ -360,84 +996,6 @@ class SubtitleService:
                 except:
                     pass
 
-    def _ensure_dir(self, path: str):
-        try:
-            os.makedirs(path, exist_ok=True)
-        except Exception:
-            pass
-
-    def transcode_to_hls(self, source_path: str, output_dir: str, segment_time: int = 10) -> bool:
-        """
-        Industry-standard HLS ABR packaging in a single pass.
-        Generates resolution-specific playlists and segments with aligned keyframes.
-        Output structure:
-            output_dir/
-              1080p/index.m3u8, segment_%03d.ts
-              720p/index.m3u8,  segment_%03d.ts
-              480p/index.m3u8,  segment_%03d.ts
-              360p/index.m3u8,  segment_%03d.ts
-        """
-        try:
-            self._ensure_dir(output_dir)
-            for res in ("1080p", "720p", "480p", "360p"):
-                self._ensure_dir(os.path.join(output_dir, res))
-
-            # If all variant playlists exist, assume done
-            if all(os.path.exists(os.path.join(output_dir, r, "index.m3u8")) for r in ("1080p","720p","480p","360p")):
-                return True
-
-            filter_complex = (
-                "[0:v]split=4[v1][v2][v3][v4];"
-                "[v1]scale=-2:1080:flags=bicubic,format=yuv420p[v1080];"
-                "[v2]scale=-2:720:flags=bicubic,format=yuv420p[v720];"
-                "[v3]scale=-2:480:flags=bicubic,format=yuv420p[v480];"
-                "[v4]scale=-2:360:flags=bicubic,format=yuv420p[v360]"
-            )
-
-            cmd = [
-                'ffmpeg', '-hide_banner', '-loglevel', 'error',
-                '-threads', str(self.ffmpeg_threads),
-                '-i', source_path,
-                '-filter_complex', filter_complex,
-            ]
-
-            # Variant configs: bitrate aligned, keyframe alignment enforced
-            configs = [
-                ("v1080", "1080p", "5000k", "10000k"),
-                ("v720",  "720p",  "3000k", "6000k"),
-                ("v480",  "480p",  "1500k", "3000k"),
-                ("v360",  "360p",  "800k",  "1600k"),
-            ]
-
-            for vlabel, folder, bitrate, bufsize in configs:
-                variant_out_dir = os.path.join(output_dir, folder)
-                playlist_path = os.path.join(variant_out_dir, 'index.m3u8')
-                segment_pattern = os.path.join(variant_out_dir, 'segment_%03d.ts')
-
-                cmd.extend([
-                    '-map', f'[{vlabel}]', '-map', '0:a:0?',
-                    '-c:v', 'libx264', '-b:v', bitrate, '-maxrate', bitrate, '-bufsize', bufsize,
-                    '-preset', self.ffmpeg_preset, '-profile:v', 'high', '-level', '4.1', '-crf', '23',
-                    '-force_key_frames', f'expr:gte(t,n_forced*{segment_time})',
-                    '-c:a', 'aac', '-b:a', '128k', '-ac', '2', '-ar', '44100',
-                    '-f', 'hls',
-                    '-hls_time', str(segment_time),
-                    '-hls_playlist_type', 'vod',
-                    '-hls_flags', 'independent_segments',
-                    '-hls_segment_filename', segment_pattern,
-                    playlist_path
-                ])
-
-            subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-            return True
-        except subprocess.CalledProcessError as e:
-            err = e.stderr.decode() if e.stderr else str(e)
-            logger.error(f"HLS packaging failed: {err}")
-            return False
-        except Exception as e:
-            logger.error(f"Unexpected HLS packaging error: {e}")
-            return False
-
     def _download_single_subtitle(self, task):
         """
         Download a single subtitle file
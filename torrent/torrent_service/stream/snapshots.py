@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+class StatusRegistry:
+    """
+    Latest pipeline state per movie (status, progress, swarm stats, segment
+    counts per rendition). process_video_thread publishes into it as things
+    change; the status and HEAD endpoints answer from it without touching the
+    database, libtorrent or the filesystem. Snapshots are replaced rather
+    than mutated, so readers never need the lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshots = {}
+
+    def publish(self, movie_id, **fields):
+        with self._lock:
+            snapshot = dict(self._snapshots.get(int(movie_id), {}))
+            snapshot.update(fields)
+            snapshot["updated_at"] = time.time()
+            self._snapshots[int(movie_id)] = snapshot
+
+    def publish_variant(self, movie_id, res, segments, static_playlist=False):
+        with self._lock:
+            snapshot = dict(self._snapshots.get(int(movie_id), {}))
+            variants = dict(snapshot.get("variants", {}))
+            variants[res] = {"static_playlist": static_playlist, "segments": segments}
+            snapshot["variants"] = variants
+            snapshot["updated_at"] = time.time()
+            self._snapshots[int(movie_id)] = snapshot
+
+    def get(self, movie_id):
+        try:
+            return self._snapshots.get(int(movie_id))
+        except (TypeError, ValueError):
+            return None
+
+    def drop(self, movie_id):
+        with self._lock:
+            self._snapshots.pop(int(movie_id), None)
+
+
+status_registry = StatusRegistry()
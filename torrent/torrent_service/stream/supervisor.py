@@ -0,0 +1,216 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import libtorrent as lt
+
+from .piece_reader import piece_reader
+from .trackers import tracker_registry
+
+logger = logging.getLogger(__name__)
+
+# Alerts the supervisor needs from the session
+ALERT_MASK = (
+    lt.alert.category_t.status_notification
+    | lt.alert.category_t.error_notification
+    | lt.alert.category_t.storage_notification
+    | lt.alert.category_t.piece_progress_notification
+    | lt.alert.category_t.tracker_notification
+)
+
+
+# Fast-resume file kept in each torrent's save path
+RESUME_FILE = ".fastresume"
+# Resume data is requested this often for every active torrent
+RESUME_INTERVAL = int(os.getenv("RESUME_INTERVAL", "60"))
+RESUME_FLAGS = lt.torrent_handle.save_info_dict | lt.torrent_handle.only_if_modified
+
+
+def write_resume_data(alert):
+    """Persist a save_resume_data_alert next to the download it describes."""
+    params = alert.params
+    path = os.path.join(params.save_path, RESUME_FILE)
+    with open(path + ".tmp", "wb") as f:
+        f.write(bytes(lt.write_resume_data_buf(params)))
+    os.replace(path + ".tmp", path)
+
+
+def load_resume_params(save_path, magnet_params):
+    """add_torrent_params from the save path's resume file, if it belongs to the same torrent."""
+    try:
+        with open(os.path.join(save_path, RESUME_FILE), "rb") as f:
+            params = lt.read_resume_data(f.read())
+    except Exception:
+        return None
+    if _params_key(params) != _params_key(magnet_params):
+        return None
+    return params
+
+
+def _params_key(params):
+    hashes = params.info_hashes
+    return str(hashes.v1 if hashes.has_v1() else hashes.v2)
+
+
+def info_hash_key(handle):
+    """Stable hex key for a torrent: the v1 info-hash, or v2 for v2-only torrents."""
+    try:
+        hashes = handle.info_hashes()
+        return str(hashes.v1 if hashes.has_v1() else hashes.v2)
+    except AttributeError:
+        # libtorrent 1.2
+        return str(handle.info_hash())
+
+
+def tracker_url(alert):
+    try:
+        return alert.tracker_url()
+    except AttributeError:
+        # libtorrent 1.2
+        return alert.url
+
+
+class TorrentSupervisor:
+    """
+    One thread for every download in the session. It drains libtorrent's
+    alert queue and dispatches to the per-movie state machine owning the
+    torrent, so a segment check runs the moment its pieces land instead of
+    on a per-movie polling tick.
+
+    A machine implements on_attach(), on_metadata(), on_piece(index),
+    on_finished(), on_status(status), on_tick(now) and fail(exc). All of
+    them run on the supervisor thread and must not block; background work
+    reports back with post().
+    """
+
+    WAIT_MS = 100
+    TICK_SECONDS = 1.0
+
+    def __init__(self, session):
+        self.session = session
+        self._lock = threading.Lock()
+        self._machines = {}
+        self._by_movie = {}
+        self._events = deque()
+        self._alerts = 0
+        self._thread = threading.Thread(target=self._run, name="torrent-supervisor", daemon=True)
+        self._thread.start()
+
+    def reserve(self, movie_id, machine):
+        """Claim a movie for a machine; False when another one is already running it."""
+        with self._lock:
+            if movie_id in self._by_movie:
+                return False
+            self._by_movie[movie_id] = machine
+            return True
+
+    def attach(self, machine, handle):
+        """Route the handle's alerts to the machine from now on."""
+        with self._lock:
+            self._machines[info_hash_key(handle)] = machine
+        self.post(machine.on_attach)
+
+    def detach(self, machine):
+        with self._lock:
+            for key in [k for k, m in self._machines.items() if m is machine]:
+                del self._machines[key]
+            if self._by_movie.get(machine.video_id) is machine:
+                del self._by_movie[machine.video_id]
+
+    def is_active(self, movie_id):
+        return movie_id in self._by_movie
+
+    def post(self, fn, *args):
+        """Run fn(*args) on the supervisor thread (thread-safe)."""
+        self._events.append((fn, args))
+
+    def pipelines(self):
+        """Machines currently running, one per movie."""
+        with self._lock:
+            return list(self._by_movie.values())
+
+    def stats(self):
+        with self._lock:
+            return {"active_pipelines": len(self._by_movie), "alerts_handled": self._alerts}
+
+    def _call(self, machine, fn, *args):
+        try:
+            fn(*args)
+        except Exception as e:
+            try:
+                machine.fail(e)
+            except Exception as fail_error:
+                logger.error(f"Pipeline failure handler raised for movie={machine.video_id}: {fail_error}")
+
+    def _machine_for(self, handle):
+        try:
+            return self._machines.get(info_hash_key(handle))
+        except Exception:
+            return None
+
+    def _dispatch(self, alert):
+        if isinstance(alert, lt.save_resume_data_alert):
+            try:
+                write_resume_data(alert)
+            except Exception as e:
+                logger.warning(f"Could not write resume data: {e}")
+            return
+        if isinstance(alert, (lt.tracker_reply_alert, lt.tracker_error_alert)):
+            tracker_registry.record(tracker_url(alert), isinstance(alert, lt.tracker_reply_alert))
+            return
+        if isinstance(alert, lt.read_piece_alert):
+            piece_reader.on_read_piece(info_hash_key(alert.handle), alert)
+            return
+        if isinstance(alert, lt.state_update_alert):
+            for status in alert.status:
+                machine = self._machine_for(status.handle)
+                if machine:
+                    self._call(machine, machine.on_status, status)
+            return
+
+        if not isinstance(alert, (lt.metadata_received_alert, lt.piece_finished_alert, lt.torrent_finished_alert)):
+            return
+        if isinstance(alert, lt.piece_finished_alert):
+            piece_reader.on_piece_finished()
+        machine = self._machine_for(alert.handle)
+        if machine is None:
+            return
+        if isinstance(alert, lt.piece_finished_alert):
+            self._call(machine, machine.on_piece, alert.piece_index)
+        elif isinstance(alert, lt.metadata_received_alert):
+            self._call(machine, machine.on_metadata)
+        else:
+            self._call(machine, machine.on_finished)
+
+    def _run(self):
+        last_tick = 0
+        while True:
+            try:
+                self.session.wait_for_alert(self.WAIT_MS)
+                alerts = self.session.pop_alerts()
+                self._alerts += len(alerts)
+                for alert in alerts:
+                    self._dispatch(alert)
+
+                while self._events:
+                    fn, args = self._events.popleft()
+                    machine = getattr(fn, "__self__", None)
+                    if machine is not None and hasattr(machine, "fail"):
+                        self._call(machine, fn, *args)
+                    else:
+                        fn(*args)
+
+                now = time.time()
+                if now - last_tick >= self.TICK_SECONDS:
+                    last_tick = now
+                    # Answered by a state_update_alert on the next wait
+                    self.session.post_torrent_updates()
+                    with self._lock:
+                        machines = list(self._by_movie.values())
+                    for machine in machines:
+                        self._call(machine, machine.on_tick, now)
+            except Exception as e:
+                logger.error(f"Torrent supervisor error: {e}")
+                time.sleep(self.WAIT_MS / 1000.0)
@@ -1,3 +1,903 @@
-from django.test import TestCase
+import base64
+import http.client
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from unittest import mock
+from urllib.parse import urlsplit
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+from rest_framework.test import APIRequestFactory
+
+from . import calibration, ladder, trackers
+from .container import ContainerLayout, read_keyframes
+from .engine import LocalEngine
+from .ladder import SourceLadder, active_renditions, base_renditions, rendition_demand, set_source_ladder
+from .load import LoadGovernor, rendition_cost
+from .manifest import PARTIAL_SUFFIX, contiguous_durations, manifest_path, read_manifest, record_segment, retract_segment
+from .media_index import MediaByteIndex, drop_index, finished_index, get_index, register_index
+from .metrics import MetricsRegistry
+from .models import MovieFile
+from .piece_reader import PieceReader, SourceServer
+from .pipeline import MoviePipeline, request_jit_segment
+from .progress import ProgressWriter
+from .scheduler import PRIORITY_FIRST_SEGMENT, PRIORITY_IDLE, PRIORITY_PROGRESSIVE, TranscodeScheduler
+from .services import AUDIO_RENDITION, RESOLUTIONS, VideoService
+from .snapshots import status_registry
+from .torrent_file import TorrentFileView
+from .torrentd import TorrentDaemon, TorrentdClient, TorrentdError, TorrentdUnavailable
+from .trackers import TrackerRegistry
+from .utils import magnet_info_hash
+from .views import VideoViewSet
+
+
+def mp4_box(box_type, body):
+    return struct.pack(">I4s", 8 + len(body), box_type) + body
+
+
+def mp4_full_box(box_type, body, version=0):
+    return mp4_box(box_type, bytes([version, 0, 0, 0]) + body)
+
+
+def mp4_table(box_type, fmt, rows):
+    return mp4_full_box(box_type, struct.pack(">I", len(rows)) + b"".join(struct.pack(fmt, *row) for row in rows))
+
+
+def synthetic_moov():
+    """
+    One video track of 6 samples in 2 chunks (at 1000 and 5000), sync
+    samples 1 and 4, 40 ms per frame, composition offsets cancelled by the
+    edit list.
+    """
+    stbl = mp4_box(
+        b"stbl",
+        mp4_table(b"stts", ">II", [(6, 40)])
+        + mp4_table(b"ctts", ">Ii", [(6, 80)])
+        + mp4_table(b"stss", ">I", [(1,), (4,)])
+        + mp4_table(b"stsc", ">III", [(1, 3, 1)])
+        + mp4_full_box(b"stsz", struct.pack(">II6I", 0, 6, 10, 20, 30, 40, 50, 60))
+        + mp4_table(b"stco", ">I", [(1000,), (5000,)]),
+    )
+    mdia = mp4_box(
+        b"mdia",
+        mp4_full_box(b"mdhd", struct.pack(">IIII", 0, 0, 1000, 240) + bytes(4))
+        + mp4_full_box(b"hdlr", bytes(4) + b"vide" + bytes(12))
+        + mp4_box(b"minf", stbl),
+    )
+    edts = mp4_box(b"edts", mp4_table(b"elst", ">IiI", [(240, 80, 0x10000)]))
+    return mp4_box(b"moov", mp4_box(b"trak", edts + mdia))
+
+
+def ebml(element_id, body):
+    size = bytes([0x80 | len(body)]) if len(body) < 127 else bytes([0x40 | (len(body) >> 8), len(body) & 0xFF])
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, "big") + size + body
+
+
+def ebml_uint(element_id, value, length=2):
+    return ebml(element_id, value.to_bytes(length, "big"))
+
+
+def synthetic_mkv():
+    """
+    Matroska file whose Cues follow the first cluster, found through the
+    SeekHead. Track 2 is the video; the cue on audio track 1 is ignored.
+    Returns the bytes and where the Cues element starts.
+    """
+    info = ebml(0x1549A966, ebml_uint(0x2AD7B1, 1000000, 3))
+    tracks = ebml(0x1654AE6B, ebml(0xAE, ebml_uint(0xD7, 1, 1) + ebml_uint(0x83, 2, 1)) + ebml(0xAE, ebml_uint(0xD7, 2, 1) + ebml_uint(0x83, 1, 1)))
+    cues = ebml(
+        0x1C53BB6B,
+        ebml(0xBB, ebml_uint(0xB3, 0) + ebml(0xB7, ebml_uint(0xF7, 2, 1) + ebml_uint(0xF1, 100)))
+        + ebml(0xBB, ebml_uint(0xB3, 1000) + ebml(0xB7, ebml_uint(0xF7, 1, 1) + ebml_uint(0xF1, 500)))
+        + ebml(0xBB, ebml_uint(0xB3, 2000) + ebml(0xB7, ebml_uint(0xF7, 2, 1) + ebml_uint(0xF1, 900))),
+    )
+    body = info + tracks + ebml(0x1F43B675, bytes(50))
+
+    def seek_head(cues_at):
+        return ebml(0x114D9B74, ebml(0x4DBB, ebml(0x53AB, (0x1C53BB6B).to_bytes(4, "big")) + ebml_uint(0x53AC, cues_at)))
+
+    seek = seek_head(len(seek_head(0)) + len(body))
+    segment = seek + body + cues
+    # 8-byte segment size, as muxers write it
+    header = ebml(0x1A45DFA3, ebml(0x4282, b"matroska")) + (0x18538067).to_bytes(4, "big") + b"\x01" + len(segment).to_bytes(7, "big")
+    return header + segment, len(header) + len(seek) + len(body)
+
+
+class FakeSource:
+    """A torrent file view whose pieces are all verified, or only those below `verified` and outside `hole`."""
+
+    piece_length = 16
+
+    def __init__(self, size, verified=None, hole=None):
+        self.size = size
+        self.verified = size if verified is None else verified
+        self.hole = hole
+
+    def have_range(self, start, end):
+        if self.hole and start < self.hole[1] and end > self.hole[0]:
+            return False
+        return end <= self.verified
+
+
+def run_now(fn, *args, priority=None, key=None, movie_id=None, kind=None, **kwargs):
+    """Stand-in for TranscodeScheduler.submit that runs the job on the calling thread."""
+    future = Future()
+    future.set_result(fn(*args, **kwargs))
+    return future
+
+
+class TempDirMixin:
+    def make_dir(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        return path
+
+    def make_file(self, name, data):
+        path = os.path.join(self.make_dir(), name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+
+class TranscodeSchedulerTests(SimpleTestCase):
+    def setUp(self):
+        # A private instance without slot threads: the tests take jobs with _next_job()
+        with mock.patch.object(TranscodeScheduler, "_start_workers"):
+            self.scheduler = object.__new__(TranscodeScheduler)
+            self.scheduler._initialize()
+
+    def test_same_key_returns_the_queued_future(self):
+        first = self.scheduler.submit(print, key=(1, 0), movie_id=1)
+        second = self.scheduler.submit(print, key=(1, 0), movie_id=1)
+        self.assertIs(first, second)
+        self.assertEqual(self.scheduler.stats()["queue_depth"], 1)
+
+    def test_more_urgent_duplicate_promotes_the_job(self):
+        idle = self.scheduler.submit(print, priority=PRIORITY_IDLE, key=(1, 5), movie_id=1)
+        self.scheduler.submit(print, priority=PRIORITY_PROGRESSIVE, key=(2, 0), movie_id=2)
+        self.scheduler.submit(print, priority=PRIORITY_FIRST_SEGMENT, key=(1, 5), movie_id=1)
+
+        job = self.scheduler._next_job(0)
+        self.assertIs(job.future, idle)
+        self.assertEqual(job.priority, PRIORITY_FIRST_SEGMENT)
+        self.assertEqual(self.scheduler._next_job(0).movie_id, 2)
+
+    def test_stale_heap_entry_is_skipped(self):
+        self.scheduler.submit(print, priority=PRIORITY_IDLE, key=(1, 5), movie_id=1)
+        self.scheduler.submit(print, priority=PRIORITY_FIRST_SEGMENT, key=(1, 5), movie_id=1)
+        self.scheduler._next_job(0)
+
+        # The idle entry of the promoted job is still in the heap, but is not a queued job
+        self.assertEqual(len(self.scheduler._queue), 1)
+        self.assertEqual(self.scheduler.stats()["queue_depth"], 0)
+        self.assertEqual(self.scheduler.queued_by_movie(), {})
+
+        # Queued behind the stale entry, which is popped and dropped on the way
+        self.scheduler.submit(print, priority=PRIORITY_IDLE, key=(3, 0), movie_id=3)
+        self.assertEqual(self.scheduler._next_job(0).movie_id, 3)
+        self.assertEqual(self.scheduler._queue, [])
+
+    def test_slots_above_the_budget_retire(self):
+        self.scheduler.slots = 2
+        self.scheduler._workers = {0, 1}
+        self.scheduler.resize(1)
+        self.assertIsNone(self.scheduler._next_job(1))
+        self.assertEqual(self.scheduler._workers, {0})
+
+
+class ManifestTests(TempDirMixin, SimpleTestCase):
+    def test_journal_lists_published_segments(self):
+        rendition_dir = self.make_dir()
+        record_segment(rendition_dir, 0, 10.0)
+        record_segment(rendition_dir, 2, 9.5)
+        self.assertEqual(read_manifest(rendition_dir), {0: 10.0, 2: 9.5})
+        self.assertEqual(contiguous_durations(rendition_dir), [10.0])
+
+        record_segment(rendition_dir, 1, 10.01)
+        self.assertEqual(contiguous_durations(rendition_dir), [10.0, 10.01, 9.5])
+
+    def test_retracted_segment_is_withdrawn(self):
+        rendition_dir = self.make_dir()
+        record_segment(rendition_dir, 0, 10.0)
+        record_segment(rendition_dir, 1, 10.0)
+        retract_segment(rendition_dir, 1)
+        self.assertEqual(read_manifest(rendition_dir), {0: 10.0})
+
+        record_segment(rendition_dir, 1, 8.0)
+        self.assertEqual(read_manifest(rendition_dir), {0: 10.0, 1: 8.0})
+
+    def test_line_being_written_is_not_read(self):
+        rendition_dir = self.make_dir()
+        record_segment(rendition_dir, 0, 10.0)
+        with open(manifest_path(rendition_dir), "a") as f:
+            f.write("1,9.")
+        self.assertEqual(read_manifest(rendition_dir), {0: 10.0})
+
+        with open(manifest_path(rendition_dir), "a") as f:
+            f.write("5\n")
+        self.assertEqual(read_manifest(rendition_dir), {0: 10.0, 1: 9.5})
+
+    def test_replaced_journal_is_read_from_the_start(self):
+        rendition_dir = self.make_dir()
+        record_segment(rendition_dir, 0, 10.0)
+        record_segment(rendition_dir, 1, 10.0)
+        read_manifest(rendition_dir)
+        os.remove(manifest_path(rendition_dir))
+        record_segment(rendition_dir, 0, 7.0)
+        self.assertEqual(read_manifest(rendition_dir), {0: 7.0})
+
+    def test_publish_renames_the_partial_segment_and_journals_it(self):
+        output_dir = self.make_dir()
+        service = VideoService()
+        final_path = service.segment_path(output_dir, "720p", 3)
+        os.makedirs(os.path.dirname(final_path))
+        with open(final_path + PARTIAL_SUFFIX, "wb") as f:
+            f.write(b"\x47" * 188)
+        self.assertEqual(read_manifest(os.path.join(output_dir, "720p")), {})
+
+        service.publish_segment(output_dir, "720p", 3, duration=9.6)
+        self.assertFalse(os.path.exists(final_path + PARTIAL_SUFFIX))
+        self.assertEqual(os.path.getsize(final_path), 188)
+        self.assertEqual(read_manifest(os.path.join(output_dir, "720p")), {3: 9.6})
+
+    def test_whole_file_packaging_journals_its_segments(self):
+        output_dir = self.make_dir()
+        rendition_dir = os.path.join(output_dir, "720p")
+        os.makedirs(rendition_dir)
+        # Left by the progressive pass; the fallback run cut the film differently
+        record_segment(rendition_dir, 0, 10.0)
+        record_segment(rendition_dir, 3, 10.0)
+
+        def ffmpeg(cmd, **kwargs):
+            with open(os.path.join(rendition_dir, "index.m3u8"), "w") as f:
+                f.write("#EXTM3U\n#EXTINF:10.010,\nsegment_000.ts\n#EXTINF:10.000,\nsegment_001.ts\n#EXTINF:4.2,\nsegment_002.ts\n#EXT-X-ENDLIST\n")
+
+        with mock.patch("stream.services.subprocess.run", side_effect=ffmpeg):
+            self.assertTrue(VideoService().transcode_to_hls("movie.mkv", output_dir, renditions=["720p"]))
+        self.assertEqual(read_manifest(rendition_dir), {0: 10.01, 1: 10.0, 2: 4.2})
+
+
+class ContainerLayoutTests(TempDirMixin, SimpleTestCase):
+    def test_mp4_index_after_the_media_is_located(self):
+        moov = synthetic_moov()
+        data = mp4_box(b"ftyp", b"isom" * 2) + mp4_box(b"mdat", bytes(200)) + moov
+        path = self.make_file("movie.mp4", data)
+
+        layout = ContainerLayout(FakeSource(len(data)), path)
+        self.assertTrue(layout.blocking)
+        self.assertIsNone(layout.advance())
+        self.assertEqual(layout.ranges, [(len(data) - len(moov), len(data))])
+        self.assertTrue(layout.ready())
+
+    def test_mp4_walk_waits_for_the_next_box_header(self):
+        data = mp4_box(b"ftyp", b"isom" * 2) + mp4_box(b"mdat", bytes(200)) + synthetic_moov()
+        path = self.make_file("movie.mp4", data)
+
+        layout = ContainerLayout(FakeSource(len(data), verified=100), path)
+        self.assertEqual(layout.advance(), (224, 240))
+        self.assertFalse(layout.ready())
+
+    def test_mkv_cues_found_through_the_seek_head(self):
+        data, cues_at = synthetic_mkv()
+        path = self.make_file("movie.mkv", data)
+
+        layout = ContainerLayout(FakeSource(len(data)), path)
+        self.assertFalse(layout.blocking)
+        self.assertIsNone(layout.advance())
+        self.assertEqual(layout.ranges, [(cues_at, len(data))])
+
+    def test_mkv_cues_indexed_once_verified_ahead_of_the_media(self):
+        data, cues_at = synthetic_mkv()
+        path = self.make_file("movie.mkv", data)
+        # The cluster before the Cues is still downloading
+        source = FakeSource(len(data), hole=(cues_at - 50, cues_at))
+
+        layout = ContainerLayout(source, path)
+        self.assertIsNone(layout.advance())
+        self.assertTrue(layout.index_on_disk())
+        with mock.patch("stream.media_index.subprocess.run") as ffprobe:
+            index = MediaByteIndex.probe(path, len(data), 3.0, cues_at - 50, index_on_disk=True)
+        ffprobe.assert_not_called()
+        self.assertTrue(index.complete)
+        self.assertEqual(index.keyframe_span(0.0, 2.0), (0.0, 2.0))
+
+    def test_not_a_container_gives_up_without_blocking(self):
+        path = self.make_file("movie.mp4", b"\x00\x00\x00\x04junk" + bytes(64))
+        layout = ContainerLayout(FakeSource(72), path)
+        self.assertIsNone(layout.advance())
+        self.assertEqual(layout.ranges, [])
+        self.assertTrue(layout.ready())
+
+    def test_mp4_keyframes_from_the_sample_tables(self):
+        path = self.make_file("movie.mp4", mp4_box(b"ftyp", b"isom" * 2) + synthetic_moov())
+        self.assertEqual(read_keyframes(path), [(0.0, 1000), (0.12, 5000)])
+
+    def test_mkv_keyframes_from_the_video_cues(self):
+        data, _ = synthetic_mkv()
+        path = self.make_file("movie.mkv", data)
+        segment_data = data.index(b"\x11\x4d\x9b\x74")
+        self.assertEqual(read_keyframes(path), [(0.0, segment_data + 100), (2.0, segment_data + 900)])
+
+    def test_unreadable_index_raises(self):
+        path = self.make_file("movie.mp4", mp4_box(b"ftyp", b"isom" * 2) + mp4_box(b"mdat", bytes(16)))
+        with self.assertRaises(ValueError):
+            read_keyframes(path)
+        self.assertIsNone(read_keyframes(self.make_file("movie.avi", b"RIFF")))
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter_with_escaped_labels(self):
+        counter = self.registry.counter("failures_total", "Failures", labels=("cause",))
+        counter.inc(cause='quote " back\\slash\nnewline')
+        counter.inc(2, cause="timeout")
+        self.assertEqual(self.registry.render(), (
+            "# HELP failures_total Failures\n"
+            "# TYPE failures_total counter\n"
+            'failures_total{cause="quote \\" back\\\\slash\\nnewline"} 1\n'
+            'failures_total{cause="timeout"} 2\n'
+        ))
+
+    def test_wrong_labels_are_rejected(self):
+        counter = self.registry.counter("failures_total", "Failures", labels=("cause",))
+        with self.assertRaises(ValueError):
+            counter.inc(reason="timeout")
+        with self.assertRaises(ValueError):
+            self.registry.gauge("failures_total", "Duplicate")
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.histogram("encode_seconds", "Encode time", buckets=(5, 1))
+        for value in (0.5, 3, 30):
+            histogram.observe(value)
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'encode_seconds_bucket{le="1"} 1',
+            'encode_seconds_bucket{le="5"} 2',
+            'encode_seconds_bucket{le="+Inf"} 3',
+            "encode_seconds_sum 33.5",
+            "encode_seconds_count 3",
+        ])
+
+    def test_gauge_collected_at_scrape_time(self):
+        values = {"a": 1}
+        self.registry.gauge("queued", "Queued jobs", labels=("movie",), collect=lambda: [((k,), v) for k, v in values.items()])
+        values["b"] = 2.5
+        self.assertEqual(self.registry.render().splitlines()[2:], ['queued{movie="a"} 1', 'queued{movie="b"} 2.5'])
+
+
+@mock.patch("stream.load.cpu_load", return_value=0.0)
+@mock.patch("stream.load.LOAD_STEP_INTERVAL", 0)
+@mock.patch("stream.load.LOAD_ADAPTIVE", True)
+class LoadGovernorTests(SimpleTestCase):
+    FULL = [1080, 720, 480, 360]
+
+    def setUp(self):
+        self.governor = LoadGovernor()
+        self.full_cost = sum(rendition_cost(h) for h in self.FULL)
+        self.shed_cost = self.full_cost - rendition_cost(1080)
+
+    def encode(self, factor_of_full, heights, times=1):
+        """Encodes whose throughput would run the full ladder at factor_of_full x realtime."""
+        cost = sum(rendition_cost(h) for h in heights)
+        for _ in range(times):
+            self.governor.record_encode(factor_of_full * self.full_cost / cost, heights)
+
+    def test_steps_down_then_up_with_hysteresis(self, *mocks):
+        self.governor.allowed(RESOLUTIONS, movie_id=1)
+        self.encode(1.0, self.FULL)
+        self.assertEqual(self.governor.shed, 1)
+        self.assertEqual(self.governor.allowed(RESOLUTIONS, movie_id=1), RESOLUTIONS[1:])
+
+        # Between the thresholds: the fuller ladder is not predicted fast enough to return
+        self.encode(1.3, self.FULL[1:], times=20)
+        self.assertEqual(self.governor.shed, 1)
+
+        self.encode(2.0, self.FULL[1:], times=20)
+        self.assertEqual(self.governor.shed, 0)
+        self.assertEqual(self.governor.allowed(RESOLUTIONS, movie_id=1), RESOLUTIONS)
+
+    def test_step_skips_rungs_no_title_encodes(self, *mocks):
+        ladder = RESOLUTIONS[1:]
+        self.governor.allowed(ladder, movie_id=1)
+        self.encode(0.3, self.FULL[1:])
+        # Dropping 1080p would not remove any work from a 720p source
+        self.assertEqual(self.governor.shed, 2)
+        self.assertEqual(self.governor.allowed(ladder, movie_id=1), RESOLUTIONS[2:])
+
+    def test_copied_rung_is_kept_and_free(self, *mocks):
+        self.governor.allowed(RESOLUTIONS, keep="1080p", movie_id=1)
+        self.encode(0.2 * self.shed_cost / self.full_cost, self.FULL[1:])
+        self.assertEqual(self.governor.allowed(RESOLUTIONS, keep="1080p", movie_id=1), ["1080p"] + RESOLUTIONS[2:])
+
+    def test_no_decision_without_an_active_ladder(self, *mocks):
+        self.encode(0.5, self.FULL)
+        self.assertEqual(self.governor.shed, 0)
+
+
+@mock.patch("stream.pipeline.HLS_FORMAT", "ts")
+@mock.patch("stream.pipeline.transcode_scheduler.submit", side_effect=run_now)
+class PassthroughIndexTests(TempDirMixin, SimpleTestCase):
+    MOVIE_ID = 910001
+
+    def setUp(self):
+        self.addCleanup(drop_index, self.MOVIE_ID)
+        set_source_ladder(self.MOVIE_ID, SourceLadder(["1080p", "720p"], copy="1080p"))
+        self.index = MediaByteIndex(1000, 20.0, [(0.0, 0), (10.0, 500)])
+        self.index.complete = True
+
+    def finished_pipeline(self):
+        service = mock.Mock(segment_duration=10)
+        service.expected_segments.return_value = 2
+        service.missing_renditions.return_value = ["1080p"]
+        service.convert_all_segments.return_value = True
+        service.finalize_playlists.return_value = []
+        pipeline = object.__new__(MoviePipeline)
+        pipeline.video_id = self.MOVIE_ID
+        pipeline.service = service
+        pipeline.source = None
+        pipeline.downloaded_path = "/nonexistent/movie.mkv"
+        pipeline.movie_dir = self.make_dir()
+        pipeline.video_duration = 20.0
+        return pipeline
+
+    @mock.patch.object(MoviePipeline, "publish_variants")
+    def test_lazy_copy_rung_is_cut_after_ready(self, *mocks):
+        register_index(self.MOVIE_ID, self.index)
+        pipeline = self.finished_pipeline()
+
+        pipeline._idle_backfill(["1080p"])
+
+        copies = [c.args[4] for c in pipeline.service.convert_all_segments.call_args_list]
+        self.assertEqual(copies, [("1080p", 0.0, 10.0), ("1080p", 10.0, 20.0)])
+        # Kept for JIT requests once the pipeline is gone
+        self.assertIs(get_index(self.MOVIE_ID), self.index)
+
+    def test_finished_title_index_is_built_from_the_file(self, *mocks):
+        data, _ = synthetic_mkv()
+        path = self.make_file("movie.mkv", data)
+        index = finished_index(self.MOVIE_ID, path, 4.0)
+        self.assertTrue(index.complete)
+        self.assertEqual(index.keyframe_span(0, 2), (0.0, 2.0))
+        self.assertIs(finished_index(self.MOVIE_ID, path, 4.0), index)
+
+
+@mock.patch("stream.ladder.LADDER_MODE", "lazy")
+@mock.patch("stream.pipeline.transcode_scheduler.submit")
+class JitSegmentTests(SimpleTestCase):
+    MOVIE_ID = 910002
+
+    def setUp(self):
+        set_source_ladder(self.MOVIE_ID, SourceLadder(["1080p", "720p", "480p"]))
+        self.movie = MovieFile(
+            id=self.MOVIE_ID, duration=25.0, file_path="downloads/movie.mkv",
+            magnet_link="magnet:?xt=urn:btih:" + "ab" * 20,
+        )
+        patcher = mock.patch("stream.pipeline.torrent_manager")
+        self.torrent_manager = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_requested_rendition_is_encoded_first_with_a_lookahead(self, submit):
+        self.torrent_manager.get_handle.return_value = None
+        future = request_jit_segment(self.movie, 0, res="1080p")
+
+        self.assertIs(future, submit.return_value)
+        calls = submit.call_args_list
+        self.assertEqual([c.args[6] for c in calls], [0, 1, 2])
+        # Base rung plus the one the player asked for, even though nobody demanded it before
+        self.assertEqual(calls[0].args[7], ["1080p", "480p"])
+        self.assertEqual(calls[0].kwargs["priority"], PRIORITY_FIRST_SEGMENT)
+        self.assertEqual(calls[1].kwargs["priority"], PRIORITY_PROGRESSIVE)
+
+    @mock.patch("stream.pipeline.piece_reader.wait_for_range", return_value=False)
+    @mock.patch("stream.pipeline.TorrentFileView.largest")
+    def test_missing_pieces_are_waited_for_outside_the_slots(self, largest, wait_for_range, submit):
+        source = largest.return_value
+        source.size = 10 ** 6
+        source.contiguous_bytes.return_value = 0
+        source.have_range.return_value = False
+
+        self.assertIsNone(request_jit_segment(self.movie, 1, res="720p", wait=3))
+        wait_for_range.assert_called_once()
+        self.assertEqual(wait_for_range.call_args.args[3], 3)
+        submit.assert_not_called()
+        # Every segment of the window still gets its pieces raised
+        self.assertEqual(source.prioritize.call_count, 2)
+
+
+@mock.patch("stream.views.HLS_JIT", True)
+@mock.patch("stream.views.get_engine")
+class JitPlaylistTests(TempDirMixin, SimpleTestCase):
+    MOVIE_ID = 910003
+
+    def setUp(self):
+        self.media_root = self.make_dir()
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        set_source_ladder(self.MOVIE_ID, SourceLadder(["1080p", "720p", "480p"], copy="1080p"))
+        self.movie_dir = os.path.join(self.media_root, "movies", str(self.MOVIE_ID))
+        record_segment(self.make_rendition("480p"), 0, 10.0)
+        movie = MovieFile(id=self.MOVIE_ID, duration=25.0, file_path="downloads/movie.mkv", download_status="DOWNLOADING")
+        patcher = mock.patch("stream.views.get_object_or_404", return_value=movie)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_rendition(self, res):
+        path = os.path.join(self.movie_dir, res)
+        os.makedirs(path)
+        return path
+
+    def playlist(self, **params):
+        request = APIRequestFactory().get(f"/api/video/{self.MOVIE_ID}/playlist/", params)
+        return VideoViewSet.as_view({"get": "playlist"})(request, pk=self.MOVIE_ID)
+
+    def test_master_offers_encoded_rungs_on_demand_but_not_the_copy(self, get_engine):
+        get_engine.return_value.stats.return_value = {"headroom": True}
+        get_engine.return_value.status.return_value = {"snapshot": None}
+        content = self.playlist().content.decode()
+        self.assertIn("res=720p", content)
+        self.assertIn("res=480p", content)
+        self.assertNotIn("res=1080p", content)
+
+    def test_encoded_rung_gets_the_full_playlist(self, get_engine):
+        content = self.playlist(res="720p").content.decode()
+        self.assertEqual(content.count("#EXTINF:"), 3)
+        self.assertIn("#EXTINF:5.000,", content)
+
+    def test_copy_rung_is_served_from_its_journal_only(self, get_engine):
+        self.assertEqual(self.playlist(res="1080p").status_code, 404)
+
+        record_segment(self.make_rendition("1080p"), 0, 8.342)
+        content = self.playlist(res="1080p").content.decode()
+        self.assertEqual(content.count("#EXTINF:"), 1)
+        self.assertIn("#EXTINF:8.342,", content)
+
+
+class FakePieceHandle:
+    """A torrent handle over in-memory bytes; read_piece answers like the supervisor's alert."""
+
+    def __init__(self, reader, key, data, piece_length, have):
+        self.reader, self.key, self.data, self.piece_length = reader, key, data, piece_length
+        self.have = set(have)
+        self.deadlines = {}
+
+    def have_piece(self, piece):
+        return piece in self.have
+
+    def set_piece_deadline(self, piece, deadline):
+        self.deadlines[piece] = deadline
+
+    def reset_piece_deadline(self, piece):
+        self.deadlines.pop(piece, None)
+
+    def read_piece(self, piece):
+        error = mock.Mock(value=mock.Mock(return_value=0))
+        buffer = self.data[piece * self.piece_length:(piece + 1) * self.piece_length]
+        self.reader.on_read_piece(self.key, mock.Mock(piece=piece, buffer=buffer, error=error))
+
+
+class PieceSource:
+    piece_length = 16
+    offset = 0
+    file_index = 0
+    path = "movie.mkv"
+    piece_range = TorrentFileView.piece_range
+
+    def __init__(self, handle, size):
+        self.handle, self.size = handle, size
+        self.num_pieces = -(-size // self.piece_length)
+
+
+class SourceServerTests(SimpleTestCase):
+    KEY = "feed"
+
+    def setUp(self):
+        self.reader = PieceReader()
+        patcher = mock.patch("stream.piece_reader.piece_reader", self.reader)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = SourceServer()
+        self.addCleanup(self.server._server.shutdown)
+        self.data = bytes(range(160))
+
+    def serve(self, have, window):
+        handle = FakePieceHandle(self.reader, self.KEY, self.data, PieceSource.piece_length, have)
+        url = urlsplit(self.server.url(self.KEY, PieceSource(handle, len(self.data)), window))
+        return handle, url
+
+    def get(self, url, start):
+        conn = http.client.HTTPConnection(url.hostname, url.port, timeout=5)
+        self.addCleanup(conn.close)
+        conn.request("GET", f"{url.path}?{url.query}", headers={"Range": f"bytes={start}-"})
+        return conn.getresponse()
+
+    def test_open_ended_read_stops_at_the_segment_window(self):
+        handle, url = self.serve(range(10), (20, 60))
+        response = self.get(url, 24)
+        self.assertEqual(response.getheader("Content-Range"), "bytes 24-59/160")
+        self.assertEqual(response.read(), self.data[24:60])
+
+    def test_read_outside_the_window_serves_only_pieces_on_disk(self):
+        handle, url = self.serve({0, 1, 2, 5}, (64, 96))
+        response = self.get(url, 4)
+        self.assertEqual(response.read(), self.data[4:48])
+        self.assertEqual(handle.deadlines, {})
+
+    @mock.patch("stream.piece_reader.CLIENT_POLL_INTERVAL", 0.05)
+    def test_hang_up_stops_the_read_and_clears_its_deadlines(self):
+        handle, url = self.serve({1}, (16, 64))
+        with socket.create_connection((url.hostname, url.port), timeout=5) as conn:
+            conn.sendall(f"GET {url.path}?{url.query} HTTP/1.1\r\nHost: x\r\nRange: bytes=16-\r\n\r\n".encode())
+            self.assertTrue(self.eventually(lambda: handle.deadlines == {2: 0}))
+        self.assertTrue(self.eventually(lambda: handle.deadlines == {}))
+
+    def eventually(self, predicate, timeout=5):
+        stop = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > stop:
+                return False
+            time.sleep(0.02)
+        return True
+
+
+@mock.patch("stream.views.get_engine")
+class StatusTests(TempDirMixin, SimpleTestCase):
+    MOVIE_ID = 910004
+
+    def setUp(self):
+        self.addCleanup(status_registry.drop, self.MOVIE_ID)
+        status_registry.publish(self.MOVIE_ID, status="DOWNLOADING", info_hash="ab" * 20)
+
+    @mock.patch("stream.pipeline.torrent_supervisor")
+    def test_failed_pipeline_drops_its_snapshot(self, *mocks):
+        pipeline = object.__new__(MoviePipeline)
+        pipeline.video_id = self.MOVIE_ID
+        pipeline.state, pipeline.state_since = "download", time.time()
+        pipeline.packager = pipeline.handle = pipeline.movie_file = None
+        pipeline.finished = threading.Event()
+
+        pipeline.fail(Exception("tracker unreachable"))
+        self.assertIsNone(status_registry.get(self.MOVIE_ID))
+        self.assertTrue(pipeline.finished.is_set())
+
+    @mock.patch("stream.pipeline.torrent_manager")
+    def test_removed_torrent_drops_its_snapshot(self, torrent_manager, get_engine):
+        engine = LocalEngine()
+        engine._movies["ab" * 20] = self.MOVIE_ID
+        engine.remove("ab" * 20)
+        torrent_manager.remove_torrent.assert_called_once_with("ab" * 20)
+        self.assertIsNone(status_registry.get(self.MOVIE_ID))
+
+    def test_status_without_snapshot_lists_the_source_ladder(self, get_engine):
+        get_engine.return_value.status.return_value = {"snapshot": None}
+        set_source_ladder(self.MOVIE_ID, SourceLadder(["720p", "360p"], audio="aac"))
+        movie = MovieFile(id=self.MOVIE_ID, download_status="READY", download_progress=100)
+        with override_settings(MEDIA_ROOT=self.make_dir()), mock.patch("stream.views.get_object_or_404", return_value=movie):
+            request = APIRequestFactory().get(f"/api/video/{self.MOVIE_ID}/status/")
+            response = VideoViewSet.as_view({"get": "status"})(request, pk=self.MOVIE_ID)
+        self.assertEqual(sorted(response.data["variants"]), ["360p", "720p", AUDIO_RENDITION])
+
+
+class CalibrationTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        path = os.path.join(self.make_dir(), "calibration.json")
+        patcher = mock.patch.dict(os.environ, {"ENCODER_CALIBRATION_FILE": path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, calibration, "_cached", None)
+
+    @mock.patch("stream.calibration.os.cpu_count", return_value=8)
+    def test_saved_slots_are_the_encoders_measured_at_once(self, cpu_count):
+        # Eight single-thread encoders fall behind; four with two threads each hold
+        factors = {(1, 8): 0.9, (2, 4): 1.5}
+        with mock.patch("stream.calibration.measure", side_effect=lambda preset, threads, streams, seconds: factors.get((threads, streams), 0.0)) as measure:
+            result = calibration.calibrate(log=lambda line: None)
+        self.assertEqual((result["threads"], result["slots"]), (2, 4))
+        self.assertEqual({c.args[2] for c in measure.call_args_list}, {8, 4})
+        self.assertEqual(calibration.encoder_settings()["slots"], 4)
+
+
+class TorrentdTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        self.engine = mock.Mock()
+        path = os.path.join(self.make_dir(), "torrentd.sock")
+        self.daemon = TorrentDaemon(self.engine, path)
+        threading.Thread(target=self.daemon.serve_forever, daemon=True).start()
+        self.addCleanup(self.daemon.server_close)
+        self.addCleanup(self.daemon.shutdown)
+        self.client = TorrentdClient(path)
+
+    def test_calls_reach_the_engine_and_answer_its_result(self):
+        self.engine.status.return_value = {"active": True, "snapshot": {"status": "DOWNLOADING"}}
+        self.assertEqual(self.client.status(movie_id="7"), {"active": True, "snapshot": {"status": "DOWNLOADING"}})
+        self.engine.status.assert_called_once_with(movie_id=7, info_hash=None)
+
+    def test_engine_errors_come_back_as_torrentd_errors(self):
+        self.engine.remove.side_effect = KeyError("ab" * 20)
+        with self.assertRaises(TorrentdError):
+            self.client.remove("ab" * 20)
+        with self.assertRaisesMessage(TorrentdError, "unknown op"):
+            self.client.call("shutdown")
+
+    def test_unreachable_daemon(self):
+        with self.assertRaises(TorrentdUnavailable):
+            TorrentdClient(os.path.join(self.make_dir(), "missing.sock")).ping()
+
+    def test_demand_is_forwarded_once_per_resend_interval(self):
+        self.engine.demand.return_value = True
+        self.assertTrue(self.client.demand(7, "720p"))
+        self.assertIsNone(self.client.demand("7", "720p"))
+        self.assertTrue(self.client.demand(7, "480p"))
+        self.assertEqual(self.engine.demand.call_count, 2)
+
+
+class MagnetInfoHashTests(SimpleTestCase):
+    HEX = "c12fe1c06bba254a9dc9f519b335aa7c1367a88a"
+
+    def test_v1_hash_in_hex_or_base32(self):
+        self.assertEqual(magnet_info_hash(f"magnet:?xt=urn:btih:{self.HEX.upper()}&dn=Movie"), self.HEX)
+        base32 = base64.b32encode(bytes.fromhex(self.HEX)).decode()
+        self.assertEqual(magnet_info_hash(f"magnet:?dn=Movie&xt=urn:btih:{base32}"), self.HEX)
+
+    def test_v2_only_magnet_uses_the_sha256_multihash(self):
+        digest = "ab" * 32
+        self.assertEqual(magnet_info_hash(f"magnet:?xt=urn:btmh:1220{digest.upper()}"), digest)
+        # Hybrid torrents are keyed by their v1 hash
+        self.assertEqual(magnet_info_hash(f"magnet:?xt=urn:btmh:1220{digest}&xt=urn:btih:{self.HEX}"), self.HEX)
+
+    def test_magnet_without_an_info_hash(self):
+        with self.assertRaises(ValueError):
+            magnet_info_hash("magnet:?dn=Movie")
+
+
+@mock.patch("stream.views.get_engine")
+class RenditionValidationTests(SimpleTestCase):
+    def get(self, action, **params):
+        request = APIRequestFactory().get(f"/api/video/1/{action}/", params)
+        return VideoViewSet.as_view({"get": action})(request, pk=1)
+
+    def test_unknown_rendition_is_refused_before_any_demand(self, get_engine):
+        with mock.patch("stream.views.get_object_or_404", return_value=MovieFile(id=1)):
+            self.assertEqual(self.get("playlist", res="4320p").status_code, 404)
+        self.assertEqual(self.get("stream_ts", file="segment_000.ts", res="../1080p").status_code, 400)
+        get_engine.return_value.demand.assert_not_called()
+
+
+@mock.patch.object(TrackerRegistry, "_refresh_if_stale")
+class TrackerRegistryTests(TempDirMixin, SimpleTestCase):
+    GOOD = "udp://good.example:6969/announce"
+    BAD = "udp://bad.example:6969/announce"
+
+    def setUp(self):
+        settings_override = override_settings(MEDIA_ROOT=self.make_dir())
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_trackers_ranked_by_announce_results(self, refresh):
+        registry = TrackerRegistry()
+        registry.record(self.BAD, ok=False)
+        for _ in range(3):
+            registry.record(self.GOOD, ok=True)
+        best = registry.best(limit=30, extra=[self.BAD, self.GOOD])
+        self.assertEqual(best[0], self.GOOD)
+        # Below every tracker never heard from (0.5)
+        self.assertEqual(best[-1], self.BAD)
+
+    def test_dead_tracker_is_skipped_until_retried(self, refresh):
+        registry = TrackerRegistry()
+        for _ in range(trackers.DEAD_STREAK):
+            registry.record(self.BAD, ok=False)
+        self.assertNotIn(self.BAD, registry.best(limit=30, extra=[self.BAD]))
+        with mock.patch("stream.trackers.time.time", return_value=time.time() + trackers.DEAD_RETRY):
+            self.assertIn(self.BAD, registry.best(limit=30, extra=[self.BAD]))
+
+    def test_other_processes_read_the_saved_scores(self, refresh):
+        writer = TrackerRegistry()
+        for _ in range(trackers.DEAD_STREAK):
+            writer.record(self.BAD, ok=False)
+        writer.save_health()
+        self.assertNotIn(self.BAD, TrackerRegistry().best(limit=30, extra=[self.BAD]))
+
+    def test_disabled_registry_keeps_to_the_magnets_trackers(self, refresh):
+        registry = TrackerRegistry()
+        registry.enabled = False
+        self.assertEqual(registry.best(extra=[self.GOOD]), [self.GOOD])
+        refresh.assert_not_called()
+
+
+@mock.patch("stream.ladder.LADDER_MODE", "lazy")
+@mock.patch("stream.ladder.load_governor.allowed", side_effect=lambda video, keep=None, movie_id=None: video)
+class RenditionDemandTests(SimpleTestCase):
+    MOVIE_ID = 910005
+
+    def setUp(self):
+        set_source_ladder(self.MOVIE_ID, SourceLadder(["1080p", "720p", "480p", "360p"]))
+        self.addCleanup(rendition_demand.forget, self.MOVIE_ID)
+
+    def test_lazy_ladder_starts_from_the_base_rung(self, allowed):
+        self.assertEqual(base_renditions(self.MOVIE_ID), ["480p"])
+        self.assertEqual(active_renditions(self.MOVIE_ID), ["480p"])
+
+    def test_demanded_rungs_join_in_ladder_order(self, allowed):
+        rendition_demand.record(self.MOVIE_ID, "1080p")
+        rendition_demand.record(self.MOVIE_ID, AUDIO_RENDITION)
+        self.assertEqual(active_renditions(self.MOVIE_ID), ["1080p", "480p"])
+
+    def test_demand_expires(self, allowed):
+        rendition_demand.record(self.MOVIE_ID, "720p")
+        with mock.patch("stream.ladder.time.time", return_value=time.time() + ladder.DEMAND_TTL + 1):
+            self.assertEqual(rendition_demand.demanded(self.MOVIE_ID), set())
+
+
+class SourceLadderTests(TempDirMixin, SimpleTestCase):
+    H264 = {"codec_name": "h264", "profile": "High", "pix_fmt": "yuv420p", "level": 40}
+
+    def test_widescreen_h264_source_is_copied_at_the_top_rung(self):
+        info = {**self.H264, "width": 1920, "height": 800, "bit_rate": "4000000", "audio": {"codec_name": "aac", "channels": 2}}
+        ladder = SourceLadder.from_source(info)
+        self.assertEqual(ladder.renditions, RESOLUTIONS)
+        self.assertEqual(ladder.copy, "1080p")
+        self.assertEqual(ladder.bandwidth, {"1080p": 4400000})
+        self.assertEqual(ladder.dims["1080p"], "1920x800")
+        self.assertEqual(ladder.dims["720p"], "1280x532")
+        self.assertEqual(ladder.audio, "copy")
+
+    def test_rungs_above_the_source_are_dropped(self):
+        ladder = SourceLadder.from_source({"codec_name": "hevc", "width": 1280, "height": 720})
+        self.assertEqual(ladder.renditions, ["720p", "480p", "360p"])
+        self.assertIsNone(ladder.copy)
+        self.assertIsNone(ladder.audio)
+
+    def test_saved_ladder_loads_back(self):
+        movie_dir = self.make_dir()
+        SourceLadder.from_source({**self.H264, "width": 1280, "height": 720}).save(movie_dir)
+        ladder = SourceLadder.load(movie_dir)
+        self.assertEqual((ladder.renditions, ladder.copy), (["720p", "480p", "360p"], "720p"))
+        self.assertIsNone(SourceLadder.load(self.make_dir()))
+
+
+@mock.patch("stream.progress.MovieFile.objects.bulk_update")
+class ProgressWriterTests(SimpleTestCase):
+    def setUp(self):
+        # A private writer whose flushes the test drives, without the background thread
+        with mock.patch("stream.progress.threading.Thread"):
+            self.writer = object.__new__(ProgressWriter)
+            self.writer._initialize()
+        self.movie = MovieFile(id=910006, download_progress=0)
+
+    def test_updates_are_coalesced_into_one_write_per_field_set(self, bulk_update):
+        other = MovieFile(id=910007)
+        self.writer.update(self.movie, download_progress=10)
+        self.writer.update(self.movie, download_progress=20)
+        self.writer.update(other, download_progress=5)
+        self.writer.update(other, file_path="downloads/other.mkv")
+        self.assertEqual(self.movie.download_progress, 20)
+
+        self.writer.flush()
+        writes = {tuple(c.args[1]): [(row.id, row.download_progress) for row in c.args[0]] for c in bulk_update.call_args_list}
+        self.assertEqual(writes, {("download_progress",): [(910006, 20)], ("download_progress", "file_path"): [(910007, 5)]})
+        self.writer.flush()
+        self.assertEqual(bulk_update.call_count, 2)
+
+    def test_transition_wakes_the_writer_for_its_movie(self, bulk_update):
+        self.writer.update(MovieFile(id=910007), download_progress=5)
+        self.writer.transition(self.movie, "READY", download_progress=100)
+        self.assertTrue(self.writer._wake.is_set())
+        self.assertEqual(self.writer._urgent, {910006})
+
+        self.writer.flush(self.writer._urgent)
+        self.assertEqual([row.id for row in bulk_update.call_args.args[0]], [910006])
+        self.assertIn(910007, self.writer._pending)
+
+    def test_failed_write_is_retried_without_overriding_newer_values(self, bulk_update):
+        self.writer.update(self.movie, download_progress=30, download_status="DOWNLOADING")
+        bulk_update.side_effect = OSError("database is gone")
+        self.writer.flush()
+        self.writer.update(self.movie, download_progress=40)
+        self.assertEqual(self.writer._pending[910006], {"download_progress": 40, "download_status": "DOWNLOADING"})
@@ -0,0 +1,69 @@
+import threading
+
+
+class TorrentFileView:
+    """
+    Byte-level view of a single file inside a torrent.
+    Translates file offsets into piece indices and answers availability
+    questions from the handle's piece bitmap.
+    """
+
+    def __init__(self, handle, file_index):
+        info = handle.get_torrent_info()
+        files = info.files()
+        self.handle = handle
+        self.file_index = file_index
+        self.path = files.file_path(file_index)
+        self.offset = files.file_offset(file_index)
+        self.size = files.file_size(file_index)
+        self.piece_length = info.piece_length()
+        self.num_pieces = info.num_pieces()
+        self._lock = threading.Lock()
+        self._contiguous_piece = self.first_piece
+
+    @classmethod
+    def largest(cls, handle):
+        """View of the biggest file in the torrent (the movie itself)."""
+        files = handle.get_torrent_info().files()
+        index = max(range(files.num_files()), key=files.file_size)
+        return cls(handle, index)
+
+    @property
+    def first_piece(self):
+        return self.offset // self.piece_length
+
+    @property
+    def last_piece(self):
+        return (self.offset + max(self.size, 1) - 1) // self.piece_length
+
+    def piece_range(self, start, end):
+        """Pieces covering file bytes [start, end)."""
+        start = max(0, min(start, self.size))
+        end = max(start + 1, min(end, self.size))
+        first = (self.offset + start) // self.piece_length
+        last = (self.offset + end - 1) // self.piece_length
+        return range(first, min(last, self.num_pieces - 1) + 1)
+
+    def have_range(self, start, end):
+        return all(self.handle.have_piece(p) for p in self.piece_range(start, end))
+
+    def contiguous_bytes(self):
+        """Number of bytes from the start of the file that are verified on disk."""
+        with self._lock:
+            piece = self._contiguous_piece
+            while piece <= self.last_piece and self.handle.have_piece(piece):
+                piece += 1
+            self._contiguous_piece = piece
+        if piece > self.last_piece:
+            return self.size
+        return max(0, piece * self.piece_length - self.offset)
+
+    def prioritize(self, start, end, priority=7, deadline_ms=None):
+        """Raise priority (and optionally set a deadline) on the pieces covering [start, end)."""
+        for i, piece in enumerate(self.piece_range(start, end)):
+            if self.handle.have_piece(piece):
+                continue
+            self.handle.piece_priority(piece, priority)
+            if deadline_ms is not None:
+                # Stagger deadlines so the front of the range arrives first
+                self.handle.set_piece_deadline(piece, deadline_ms + i * 50)
@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+# Operations the daemon answers; each maps to the LocalEngine method of the same name
+OPS = ("add", "status", "prioritize", "remove", "demand", "stats", "metrics", "timeline", "profile", "ping")
+
+
+class TorrentdError(Exception):
+    """The daemon answered with an error."""
+
+
+class TorrentdUnavailable(TorrentdError):
+    """The daemon could not be reached."""
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    """One JSON request per line, one JSON reply per line."""
+
+    def handle(self):
+        try:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    reply = {"ok": True, "result": self.server.dispatch(request)}
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+                self.wfile.write(json.dumps(reply).encode() + b"\n")
+        finally:
+            close_old_connections()
+
+
+class TorrentDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix socket front of the process that owns the libtorrent session and
+    every pipeline. Web workers talk to it through TorrentdClient.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, engine, path):
+        self.engine = engine
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, _RequestHandler)
+        os.chmod(path, 0o660)
+
+    def dispatch(self, request):
+        op = request.pop("op", None)
+        if op not in OPS:
+            raise ValueError(f"unknown op {op!r}")
+        return getattr(self.engine, op)(**request)
+
+
+class TorrentdClient:
+    """Engine API for web workers, forwarded to the daemon over its Unix socket."""
+
+    TIMEOUT = 5
+    # Demand for a rendition is forwarded at most this often per movie
+    DEMAND_RESEND = 60
+
+    def __init__(self, path):
+        self.path = path
+        self._demand_sent = {}
+        self._demand_lock = threading.Lock()
+
+    def call(self, op, timeout=None, **args):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(timeout or self.TIMEOUT)
+                sock.connect(self.path)
+                sock.sendall(json.dumps({"op": op, **args}).encode() + b"\n")
+                data = b""
+                while not data.endswith(b"\n"):
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        break
+                    data += chunk
+        except OSError as e:
+            raise TorrentdUnavailable(f"torrentd unreachable at {self.path}: {e}")
+        if not data:
+            raise TorrentdUnavailable("torrentd closed the connection")
+        reply = json.loads(data)
+        if not reply.get("ok"):
+            raise TorrentdError(reply.get("error"))
+        return reply.get("result")
+
+    def add(self, movie_id):
+        return self.call("add", movie_id=int(movie_id))
+
+    def status(self, movie_id=None, info_hash=None):
+        movie_id = int(movie_id) if movie_id is not None else None
+        return self.call("status", movie_id=movie_id, info_hash=info_hash)
+
+    def prioritize(self, movie_id, segment, wait, res=None):
+        # Held by the daemon until the segment is ready or wait expires
+        return self.call(
+            "prioritize", timeout=wait + self.TIMEOUT, movie_id=int(movie_id), segment=segment, wait=wait, res=res
+        )
+
+    def remove(self, info_hash):
+        return self.call("remove", info_hash=info_hash)
+
+    def demand(self, movie_id, res):
+        key = (int(movie_id), res)
+        now = time.time()
+        with self._demand_lock:
+            if now - self._demand_sent.get(key, 0) < self.DEMAND_RESEND:
+                return None
+            self._demand_sent[key] = now
+        try:
+            return self.call("demand", movie_id=int(movie_id), res=res)
+        except TorrentdError as e:
+            logger.warning(f"Could not forward rendition demand: {e}")
+            return None
+
+    def stats(self):
+        return self.call("stats")
+
+    def metrics(self):
+        return self.call("metrics")
+
+    def timeline(self, movie_id=None):
+        movie_id = int(movie_id) if movie_id is not None else None
+        return self.call("timeline", movie_id=movie_id)
+
+    def profile(self, seconds, movie_id=None):
+        movie_id = int(movie_id) if movie_id is not None else None
+        # The daemon samples for the whole duration before it answers
+        return self.call("profile", timeout=seconds + self.TIMEOUT, seconds=seconds, movie_id=movie_id)
+
+    def ping(self):
+        return self.call("ping")
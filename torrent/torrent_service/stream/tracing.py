@@ -0,0 +1,156 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+# Movies whose timeline is kept; the oldest run is dropped first
+TIMELINE_HISTORY = int(os.getenv("TIMELINE_HISTORY", "50"))
+# Spans kept per timeline (a two-hour film has ~720 segments per encode pass)
+TIMELINE_MAX_SPANS = int(os.getenv("TIMELINE_MAX_SPANS", "5000"))
+
+# Opt-in: the sampling profiler walks every thread's stack 100 times a second
+PIPELINE_PROFILER = os.getenv("PIPELINE_PROFILER", "0") == "1"
+PROFILE_INTERVAL = 0.01
+PROFILE_MAX_SECONDS = 60
+
+
+class Timeline:
+    """Spans of one pipeline run, as offsets in seconds from its start."""
+
+    def __init__(self, movie_id):
+        self.movie_id = movie_id
+        self.started_at = time.time()
+        self.spans = deque(maxlen=TIMELINE_MAX_SPANS)
+        self.recorded = 0
+        self.phase = None
+        self.phase_since = None
+
+    def add(self, name, start, end, attrs):
+        self.spans.append({
+            "name": name,
+            "start": round(start - self.started_at, 3),
+            "duration": round(end - start, 3),
+            **attrs,
+        })
+        self.recorded += 1
+
+    def summary(self):
+        now = time.time()
+        return {
+            "movie_id": self.movie_id,
+            "started_at": self.started_at,
+            "elapsed": round(now - self.started_at, 3),
+            "phase": self.phase,
+            "phase_elapsed": round(now - self.phase_since, 3) if self.phase_since else None,
+            "spans": self.recorded,
+        }
+
+    def to_dict(self):
+        return {
+            **self.summary(),
+            "dropped": self.recorded - len(self.spans),
+            "spans": list(self.spans),
+        }
+
+
+class TimelineRecorder:
+    """
+    Per-movie timelines of the last TIMELINE_HISTORY pipeline runs: one span
+    per pipeline phase, segment encode, finalization step and database
+    flush. Served by the debug API (/api/video/<id>/timeline/) to see where
+    a slow start spent its time.
+    """
+
+    def __init__(self, history=TIMELINE_HISTORY):
+        self.history = history
+        self._lock = threading.Lock()
+        self._timelines = OrderedDict()
+
+    def start(self, movie_id):
+        """Begin a fresh timeline for a new pipeline run, replacing the previous one."""
+        with self._lock:
+            self._timelines.pop(movie_id, None)
+            self._timelines[movie_id] = Timeline(movie_id)
+            while len(self._timelines) > self.history:
+                self._timelines.popitem(last=False)
+
+    def _timeline(self, movie_id):
+        # Work outside a pipeline run (JIT segments of a finished title) joins its last timeline
+        timeline = self._timelines.get(movie_id)
+        if timeline is None:
+            timeline = self._timelines[movie_id] = Timeline(movie_id)
+            while len(self._timelines) > self.history:
+                self._timelines.popitem(last=False)
+        return timeline
+
+    def record(self, movie_id, name, start, end, **attrs):
+        with self._lock:
+            self._timeline(movie_id).add(name, start, end, attrs)
+
+    def phase(self, movie_id, phase, at=None):
+        """Close the current phase span and open the next one (None for a terminal state)."""
+        at = at or time.time()
+        with self._lock:
+            timeline = self._timeline(movie_id)
+            if timeline.phase is not None:
+                timeline.add(timeline.phase, timeline.phase_since, at, {"phase": True})
+            timeline.phase = phase
+            timeline.phase_since = at if phase else None
+
+    @contextmanager
+    def span(self, movie_id, name, **attrs):
+        """Record the enclosed block; attributes set on the yielded dict are kept with the span."""
+        started = time.time()
+        try:
+            yield attrs
+        except Exception as e:
+            attrs["error"] = str(e)
+            raise
+        finally:
+            self.record(movie_id, name, started, time.time(), **attrs)
+
+    def get(self, movie_id):
+        with self._lock:
+            timeline = self._timelines.get(movie_id)
+            return timeline.to_dict() if timeline else None
+
+    def recent(self):
+        """Summaries of every kept timeline, newest first."""
+        with self._lock:
+            return [timeline.summary() for timeline in reversed(self._timelines.values())]
+
+
+timelines = TimelineRecorder()
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)})"
+
+
+def sample_stacks(seconds, thread_filter=None, interval=PROFILE_INTERVAL):
+    """
+    Sample the Python stacks of this process' threads every `interval`
+    seconds and return them in the collapsed format flamegraph.pl and
+    speedscope read: one "thread;outer;...;inner count" line per distinct
+    stack. thread_filter(ident, name) selects the threads to sample.
+    """
+    me = threading.get_ident()
+    counts = {}
+    deadline = time.time() + min(seconds, PROFILE_MAX_SECONDS)
+    while time.time() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            name = names.get(ident, str(ident))
+            if ident == me or (thread_filter and not thread_filter(ident, name)):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_label(frame))
+                frame = frame.f_back
+            key = ";".join([name] + stack[::-1])
+            counts[key] = counts.get(key, 0) + 1
+        time.sleep(interval)
+    return "".join(f"{stack} {n}\n" for stack, n in sorted(counts.items()))
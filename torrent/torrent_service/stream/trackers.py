@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TRACKER_SOURCES = [
+    "https://raw.githubusercontent.com/XIU2/TrackersListCollection/refs/heads/master/best.txt",
+    "https://raw.githubusercontent.com/ngosang/trackerslist/refs/heads/master/trackers_best.txt",
+]
+
+# Known-good trackers, used until the first refresh and whenever the lists are unreachable
+FALLBACK_TRACKERS = [
+    "udp://tracker.opentrackr.org:1337/announce",
+    "udp://open.demonii.com:1337/announce",
+    "udp://open.stealth.si:80/announce",
+    "udp://tracker.torrent.eu.org:451/announce",
+    "udp://tracker.skyts.net:6969/announce",
+    "udp://tracker.dump.cl:6969/announce",
+    "udp://ns-1.x-fins.com:6969/announce",
+    "udp://explodie.org:6969/announce",
+    "udp://exodus.desync.com:6969/announce",
+    "http://www.torrentsnipe.info:2701/announce",
+    "http://tracker810.xyz:11450/announce",
+    "http://tracker.xiaoduola.xyz:6969/announce",
+    "http://tracker.sbsub.com:2710/announce",
+    "http://tracker.corpscorp.online:80/announce",
+    "http://tracker.bz:80/announce",
+    "http://share.hkg-fansub.info:80/announce.php",
+    "http://seeders-paradise.org:80/announce",
+    "http://home.yxgz.club:6969/announce",
+    "http://finbytes.org:80/announce.php",
+    "http://buny.uk:6969/announce",
+]
+
+# Seconds before the downloaded lists are fetched again
+TRACKER_CACHE_TTL = int(os.getenv("TRACKER_CACHE_TTL", "21600"))
+# Trackers attached to each torrent
+TRACKER_LIMIT = int(os.getenv("TRACKER_LIMIT", "20"))
+FETCH_TIMEOUT = 10
+
+# A tracker failing this many announces in a row is skipped for DEAD_RETRY seconds
+DEAD_STREAK = 5
+DEAD_RETRY = 3600
+# Health scores are written out at most this often
+HEALTH_SAVE_INTERVAL = 60
+
+
+class TrackerRegistry:
+    """
+    Tracker list cached on disk and ranked by announce results.
+
+    The downloaded list lives in MEDIA_ROOT/.trackers.json and is refreshed
+    in a background thread once it is older than TRACKER_CACHE_TTL, so no
+    request waits on GitHub. The process that owns the torrents records
+    every tracker reply and error; the scores go to .tracker_health.json,
+    where every other process picks them up. best() returns the top
+    TRACKER_LIMIT trackers that are not currently considered dead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trackers = []
+        self._fetched_at = 0
+        self._list_mtime = 0
+        self._health = {}
+        self._health_mtime = 0
+        self._health_dirty = False
+        self._health_saved_at = time.time()
+        # Set in the process that records announce results: the only writer of the scores
+        self._scoring = False
+        self._refreshing = False
+        # Cleared for offline runs (benchmarks): no lists, no fetches, only the magnet's own trackers
+        self.enabled = True
+
+    @property
+    def list_path(self):
+        return os.path.join(settings.MEDIA_ROOT, ".trackers.json")
+
+    @property
+    def health_path(self):
+        return os.path.join(settings.MEDIA_ROOT, ".tracker_health.json")
+
+    def best(self, limit=TRACKER_LIMIT, extra=()):
+        """Top trackers by health; extra (e.g. a magnet's own trackers) are ranked alongside."""
+        if not self.enabled:
+            return list(extra)[:limit]
+        self._reload()
+        self._refresh_if_stale()
+        now = time.time()
+        with self._lock:
+            candidates = list(dict.fromkeys([*extra, *FALLBACK_TRACKERS, *self._trackers]))
+            health = self._health
+        alive = [url for url in candidates if not self._is_dead(health.get(url), now)]
+        order = {url: i for i, url in enumerate(candidates)}
+        alive.sort(key=lambda url: (-self._score(health.get(url)), order[url]))
+        return alive[:limit]
+
+    def record(self, url, ok):
+        """Count one announce result for a tracker."""
+        if not url:
+            return
+        now = time.time()
+        with self._lock:
+            self._scoring = True
+            entry = dict(self._health.get(url, {"ok": 0, "fail": 0, "streak": 0, "last": 0}))
+            if ok:
+                entry["ok"] += 1
+                entry["streak"] = 0
+            else:
+                entry["fail"] += 1
+                entry["streak"] += 1
+            entry["last"] = now
+            self._health = {**self._health, url: entry}
+            self._health_dirty = True
+            due = now - self._health_saved_at >= HEALTH_SAVE_INTERVAL
+        if due:
+            self.save_health()
+
+    def save_health(self):
+        with self._lock:
+            if not self._health_dirty:
+                return
+            health = self._health
+            self._health_dirty = False
+            self._health_saved_at = time.time()
+        try:
+            self._write(self.health_path, health)
+            self._health_mtime = os.path.getmtime(self.health_path)
+        except OSError as e:
+            logger.warning(f"Could not save tracker health: {e}")
+
+    def refresh(self):
+        """Fetch the public lists and cache them; keeps the previous list on failure."""
+        trackers = []
+        for url in TRACKER_SOURCES:
+            try:
+                response = requests.get(url, timeout=FETCH_TIMEOUT)
+                if response.status_code == 200:
+                    trackers.extend(line.strip() for line in response.text.splitlines() if line.strip())
+            except Exception as e:
+                logger.warning(f"Error fetching trackers from {url}: {e}")
+
+        now = time.time()
+        with self._lock:
+            if trackers:
+                self._trackers = list(dict.fromkeys(trackers))
+            self._fetched_at = now
+            state = {"fetched_at": now, "trackers": self._trackers}
+        try:
+            self._write(self.list_path, state)
+            self._list_mtime = os.path.getmtime(self.list_path)
+        except OSError as e:
+            logger.warning(f"Could not cache tracker list: {e}")
+        logger.info(f"Tracker list refreshed: {len(state['trackers'])} trackers")
+
+    def _refresh_if_stale(self):
+        with self._lock:
+            if self._refreshing or time.time() - self._fetched_at < TRACKER_CACHE_TTL:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="tracker-refresh", daemon=True).start()
+
+    def _reload(self):
+        """Pick up the list and scores other processes wrote since the last look."""
+        list_state = self._read_if_changed(self.list_path, self._list_mtime)
+        if list_state is not None:
+            mtime, state = list_state
+            with self._lock:
+                self._list_mtime = mtime
+                self._trackers = state.get("trackers", [])
+                self._fetched_at = state.get("fetched_at", 0)
+
+        if self._scoring:
+            return
+        health_state = self._read_if_changed(self.health_path, self._health_mtime)
+        if health_state is not None:
+            mtime, health = health_state
+            with self._lock:
+                self._health_mtime = mtime
+                self._health = health
+
+    def _read_if_changed(self, path, seen_mtime):
+        try:
+            mtime = os.path.getmtime(path)
+            if mtime <= seen_mtime:
+                return None
+            with open(path) as f:
+                return mtime, json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def _score(entry):
+        """Share of successful announces, 0.5 for a tracker never heard from."""
+        if not entry:
+            return 0.5
+        return (entry["ok"] + 1) / (entry["ok"] + entry["fail"] + 2)
+
+    @staticmethod
+    def _is_dead(entry, now):
+        return bool(entry) and entry["streak"] >= DEAD_STREAK and now - entry["last"] < DEAD_RETRY
+
+
+tracker_registry = TrackerRegistry()
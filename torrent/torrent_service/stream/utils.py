@@ -1,53 +1,34 @@
-import requests
-from urllib.parse import quote_plus
+import base64
+from urllib.parse import parse_qs, quote_plus, urlsplit
+
+from .trackers import tracker_registry
+
 
 def get_trackers():
-    trackers = set()
-    try:
-        response = requests.get(
-            "https://raw.githubusercontent.com/XIU2/TrackersListCollection/refs/heads/master/best.txt"
-        )
-        if response.status_code == 200:
-            trackers.update(response.text.strip().split('\n'))
-    except Exception as e:
-        logging.error(f"Error getting first trackers {e}")
-    
-    try:
-        response = requests.get(
-            "https://raw.githubusercontent.com/ngosang/trackerslist/refs/heads/master/trackers_best.txt"
-        )
-        if response.status_code == 200:
-            trackers.update(response.text.strip().split('\n'))
-    except Exception as e:
-        logging.error(f"Error getting second trackers {e}")
-    
-    tmp_trackers = [
-        "udp://tracker.opentrackr.org:1337/announce",
-        "udp://open.demonii.com:1337/announce",
-        "udp://open.stealth.si:80/announce",
-        "udp://tracker.torrent.eu.org:451/announce",
-        "udp://tracker.skyts.net:6969/announce",
-        "udp://tracker.dump.cl:6969/announce",
-        "udp://ns-1.x-fins.com:6969/announce",
-        "udp://explodie.org:6969/announce",
-        "udp://exodus.desync.com:6969/announce",
-        "http://www.torrentsnipe.info:2701/announce",
-        "http://tracker810.xyz:11450/announce",
-        "http://tracker.xiaoduola.xyz:6969/announce",
-        "http://tracker.sbsub.com:2710/announce",
-        "http://tracker.corpscorp.online:80/announce",
-        "http://tracker.bz:80/announce",
-        "http://share.hkg-fansub.info:80/announce.php",
-        "http://seeders-paradise.org:80/announce",
-        "http://home.yxgz.club:6969/announce",
-        "http://finbytes.org:80/announce.php",
-        "http://buny.uk:6969/announce",
-    ]
-    if not trackers:
-        trackers.update(fallback_trackers)
-    return list(trackers)
+    """Best trackers from the cached, health-ranked registry (never blocks on the network)."""
+    return tracker_registry.best()
 
 def make_magnet_link(magnet_link):
     trackers = get_trackers()
     result = "&".join(f"tr={quote_plus(tracker)}" for tracker in trackers)
-    return f"{magnet_link}&{result}"
\ No newline at end of file
+    return f"{magnet_link}&{result}"
+
+
+def magnet_info_hash(magnet_link):
+    """
+    Info-hash key of a magnet, identical in every process (unlike hash()):
+    the v1 hash in hex, or the v2 one for v2-only magnets, as libtorrent
+    formats them. Parsed here so the web workers never load libtorrent.
+    """
+    v2 = None
+    for xt in parse_qs(urlsplit(magnet_link).query).get("xt", []):
+        urn, _, value = xt.rpartition(":")
+        if urn.lower() == "urn:btih":
+            # 40 hex digits, or 32 base32 ones in older magnets
+            return base64.b32decode(value.upper()).hex() if len(value) == 32 else value.lower()
+        if urn.lower() == "urn:btmh" and value.lower().startswith("1220"):
+            # Multihash: 0x12 is sha2-256, 0x20 its 32-byte length
+            v2 = value[4:].lower()
+    if v2 is None:
+        raise ValueError("magnet link has no info-hash")
+    return v2
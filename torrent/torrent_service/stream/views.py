@@ -2,277 +2,37 @@
 from rest_framework import viewsets, status, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from .services import VideoService
+from .services import VideoService, ALL_RENDITIONS, AUDIO_RENDITION
+from .manifest import contiguous_durations, read_manifest
+from .engine import get_engine
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .tracing import PROFILE_MAX_SECONDS
+from .torrentd import TorrentdError
 import re
-import os, sys
-from django.utils import timezone
-import threading
-import libtorrent as lt
+import os
+import math
 import logging
-import time
 from django.shortcuts import get_object_or_404
 from .models import MovieFile
-from rest_framework.pagination import PageNumberPagination
 from .services import SubtitleService
-from .utils import get_trackers, make_magnet_link
+from .utils import make_magnet_link, magnet_info_hash
 from django.conf import settings
 from django.http import Http404, HttpResponse
 from urllib.parse import quote
-from concurrent.futures import ThreadPoolExecutor
+from .ladder import source_ladder
 range_re = re.compile(r"bytes\s*=\s*(\d+)\s*-\s*(\d*)", re.I)
 
 logger = logging.getLogger(__name__)
 
-class TorrentSessionManager:
-    _instance = None
-    _lock = threading.Lock()
-
-    def __new__(cls):
-        with cls._lock:
-            if cls._instance is None:
-                cls._instance = super(TorrentSessionManager, cls).__new__(cls)
-                cls._instance._initialize()
-            return cls._instance
-
-    def _initialize(self):
-        self.session = lt.session()
-        self.session.listen_on(6881, 6891)
-        params = {
-            'active_downloads': 10
-        }
-        self.session.apply_settings(params)
-        self.handles = {}
-        self.handle_locks = {}
-        self._cleanup_thread = threading.Thread(target=self._cleanup_loop, daemon=True)
-        self._cleanup_thread.start()
-
-    def _cleanup_loop(self):
-        while True:
-            try:
-                with self._lock:
-                    for handle_id, handle in list(self.handles.items()):
-                        if handle.is_valid() and handle.status().is_seeding:
-                            if handle.status().active_time > 3600:
-                                self.remove_torrent(handle_id)
-            except Exception as e:
-                logging.error(f"Error in cleanup loop: {str(e)}")
-            time.sleep(300)
-
-    def add_torrent(self, magnet_link, save_path):
-        params = lt.parse_magnet_uri(magnet_link)
-        params.save_path = save_path
-
-        with self._lock:
-            handle = self.session.add_torrent(params)
-            handle_id = str(hash(magnet_link))
-            self.handles[handle_id] = handle
-            self.handle_locks[handle_id] = threading.Lock()
-            return handle_id
-
-    def get_handle(self, handle_id):
-        return self.handles.get(handle_id)
-
-    def get_handle_lock(self, handle_id):
-        return self.handle_locks.get(handle_id)
-
-    def remove_torrent(self, handle_id):
-        with self._lock:
-            if handle_id in self.handles:
-                handle = self.handles[handle_id]
-                if handle.is_valid():
-                    self.session.remove_torrent(handle)
-                del self.handles[handle_id]
-                del self.handle_locks[handle_id]
-
-torrent_manager = TorrentSessionManager()
-
-def wait_for_header(file_path, timeout=60):
-    """Waits until file has non-zero data at the start"""
-    start = time.time()
-    while time.time() - start < timeout:
-        if os.path.exists(file_path) and os.path.getsize(file_path) > 1024:
-            try:
-                with open(file_path, 'rb') as f:
-                    if any(b != 0 for b in f.read(1024)): return True
-            except: pass
-        time.sleep(1)
-    return False
-
-def process_video_thread(video_id):
-    movie_file = None
-    try:
-        movie_file = MovieFile.objects.get(id=video_id)
-        movie_file.download_status = "DOWNLOADING"
-        movie_file.save()
-
-        movies_root = os.path.join(settings.MEDIA_ROOT, "movies")
-        movie_dir = os.path.join(movies_root, str(movie_file.id))
-        os.makedirs(movie_dir, exist_ok=True)
-
-        logger.info(f"Starting torrent: {movie_file.magnet_link}")
-        handle_id = torrent_manager.add_torrent(movie_file.magnet_link, movie_dir)
-        handle = torrent_manager.get_handle(handle_id)
-        
-        if not handle: raise Exception("No torrent handle")
-
-        # 2. WAIT FOR METADATA
-        attempts = 0
-        last_log = 0
-        last_stats = {}
-        while not handle.has_metadata():
-            status = handle.status()
-            seeds = getattr(status, 'num_seeds', 0)
-            peers = getattr(status, 'num_peers', 0)
-            down_kbps = (getattr(status, 'download_rate', 0) / 1000.0)
-            last_stats = {"seeds": seeds, "peers": peers, "down_kbps": down_kbps}
-
-            # Log once per second to observe swarm health
-            now = time.time()
-            if now - last_log >= 1:
-                logger.info(
-                    f"[metadata-wait] movie={movie_file.id} seeds={seeds} peers={peers} down={down_kbps:.1f} kB/s attempt={attempts}"
-                )
-                last_log = now
-
-            if attempts > 120:
-                logger.error(
-                    f"Metadata timeout for movie={movie_file.id} seeds={seeds} peers={peers} down={down_kbps:.1f} kB/s"
-                )
-                raise Exception("Metadata timeout")
-            time.sleep(1)
-            attempts += 1
-
-        info = handle.get_torrent_info()
-        largest = max(info.files(), key=lambda f: f.size)
-        file_path_in_torrent = largest.path
-        downloaded_path = os.path.join(movie_dir, file_path_in_torrent)
-        
-        # Save relative path
-        movie_file.file_path = os.path.relpath(downloaded_path, settings.MEDIA_ROOT)
-        movie_file.save()
-
-        handle.set_sequential_download(True)
-        
-        try:
-            for i in range(min(20, info.num_pieces())): handle.piece_priority(i, 7)
-        except: pass
-
-        # 3. WAIT FOR HEADER (CRITICAL)
-        if not wait_for_header(downloaded_path):
-            raise Exception("File header missing (download stuck?)")
-
-        service = VideoService()
-        conversion_started = False
-        current_segment = 0
-        video_duration = None
-
-        dl_last_log = 0
-        while True:
-            status = handle.status()
-            progress = status.progress * 100
-            movie_file.download_progress = progress
-            # Periodic swarm stats to diagnose slowness (every ~2s)
-            now = time.time()
-            if now - dl_last_log >= 2:
-                seeds = getattr(status, 'num_seeds', 0)
-                peers = getattr(status, 'num_peers', 0)
-                down_kbps = (getattr(status, 'download_rate', 0) / 1000.0)
-                logger.info(
-                    f"[dl] movie={movie_file.id} progress={progress:.2f}% seeds={seeds} peers={peers} down={down_kbps:.1f} kB/s"
-                )
-                dl_last_log = now
-            
-            if not conversion_started:
-                dur = service.get_video_duration(downloaded_path)
-                if dur:
-                    video_duration = dur
-                    conversion_started = True
-                    movie_file.download_status = "DL_AND_CONVERT"
-                    logger.info(f"Header ready. Duration: {dur}s")
-
-            # B. Transcode Available Segments
-            if conversion_started and video_duration:
-                segment_end_time = (current_segment + 1) * service.segment_duration
-                required_progress = (segment_end_time / video_duration) * 100
-                
-                # Buffer 5% to avoid "Invalid Data" crashes
-                if progress >= (required_progress + 5) or status.is_seeding:
-                    success = service.convert_all_segments(
-                        downloaded_path, 
-                        movie_dir, 
-                        current_segment
-                    )
-
-                    if success:
-                        if current_segment == 0:
-                            movie_file.download_status = "PLAYABLE"
-                            logger.info("First segment ready!")
-                        
-                        current_segment += 1
-                        movie_file.save()
-                    else:
-                        time.sleep(2)
-
-            if status.is_seeding or progress >= 100:
-                break
-            
-            time.sleep(1)
-            if int(time.time()) % 5 == 0: movie_file.save()
-
-        if video_duration:
-            total_segs = int(video_duration / service.segment_duration) + 1
-            remaining = list(range(current_segment, total_segs))
-            
-            if remaining:
-                logger.info(f"Batch processing {len(remaining)} segments with 4 threads...")
-                with ThreadPoolExecutor(max_workers=4) as executor:
-                    futures = [
-                        executor.submit(service.convert_all_segments, downloaded_path, movie_dir, idx)
-                        for idx in remaining
-                    ]
-                    for f in futures: f.result()
-
-        # After progressive segments, produce finalized ABR playlists (industry-standard)
-        try:
-            service = VideoService()
-            out_ok = service.transcode_to_hls(downloaded_path, movie_dir, segment_time=10)
-            if out_ok:
-                logger.info(f"Final HLS packaging complete for movie={video_id}")
-            else:
-                logger.warning(f"Final HLS packaging failed; continuing with progressive segments for movie={video_id}")
-        except Exception as e:
-            logger.warning(f"HLS packaging exception: {e}")
+# Just-in-time mode: advertise the full film and transcode segments on request
+HLS_JIT = os.getenv("HLS_JIT", "0") == "1"
+JIT_WAIT_SECONDS = float(os.getenv("JIT_WAIT_SECONDS", "15"))
 
-        movie_file.download_status = "READY"
-        movie_file.save()
-        logger.info(f"Processing complete for {video_id}")
+segment_re = re.compile(r"^segment_(\d+)\.ts$")
+cmaf_map_re = re.compile(r'URI="([^"/]+)"')
 
-    except Exception as e:
-        # Log final swarm stats if available
-        try:
-            if 'handle' in locals() and handle and handle.is_valid():
-                st = handle.status()
-                seeds = getattr(st, 'num_seeds', 0)
-                peers = getattr(st, 'num_peers', 0)
-                down_kbps = (getattr(st, 'download_rate', 0) / 1000.0)
-                logger.error(
-                    f"Thread Error: {e} | final swarm movie={video_id} seeds={seeds} peers={peers} down={down_kbps:.1f} kB/s"
-                )
-            else:
-                logger.error(f"Thread Error: {e} | no valid torrent handle for movie={video_id}")
-        except Exception:
-            logger.error(f"Thread Error: {e}")
-        if movie_file:
-            movie_file.download_status = "ERROR"
-            movie_file.save()
-            # Ensure we remove any lingering torrent handle
-            try:
-                handle_id = str(hash(movie_file.magnet_link)) if movie_file.magnet_link else None
-                if handle_id:
-                    torrent_manager.remove_torrent(handle_id)
-                    logger.info(f"Removed torrent handle for movie={movie_file.id} after error")
-            except Exception as re:
-                logger.warning(f"Failed to remove torrent after error: {re}")
+# Advertised bitrate of the shared AAC audio group, added to each video rendition
+AUDIO_BANDWIDTH = 128000
 
 class VideoViewSet(viewsets.ViewSet):
     """
@@ -288,9 +48,19 @@ class VideoViewSet(viewsets.ViewSet):
         - ?res=1080p: Returns MEDIA playlist (list of segments).
         """
 
-        movie = get_object_or_404(MovieFile, pk=pk)
         resolution = request.query_params.get('res')
 
+        # HEAD readiness probe answered from the pipeline's snapshot when the engine has one
+        if not resolution and request.method == 'HEAD':
+            snapshot = self._engine_snapshot(pk)
+            if snapshot is not None:
+                if snapshot.get('status') == 'ERROR':
+                    return HttpResponse(status=410)  # Gone
+                if any(v['segments'] > 0 or v['static_playlist'] for v in snapshot.get('variants', {}).values()):
+                    return HttpResponse(status=200)
+                return HttpResponse(status=404)
+
+        movie = get_object_or_404(MovieFile, pk=pk)
         base_dir = os.path.join(settings.MEDIA_ROOT, 'movies', str(pk))
 
         if not os.path.exists(base_dir):
@@ -305,50 +75,105 @@ class VideoViewSet(viewsets.ViewSet):
                 # If movie is in ERROR, signal to client
                 if movie.download_status == 'ERROR':
                     return HttpResponse(status=410)  # Gone
-                for r in ("1080p", "720p", "480p", "360p"):
+                for r in ALL_RENDITIONS:
                     rdir = os.path.join(base_dir, r)
-                    if os.path.isdir(rdir):
-                        try:
-                            if any(name.startswith("segment_") and name.endswith(".ts") for name in os.listdir(rdir)):
-                                return HttpResponse(status=200)
-                        except Exception:
-                            pass
+                    if os.path.exists(os.path.join(rdir, 'index.m3u8')) or read_manifest(rdir):
+                        return HttpResponse(status=200)
                 return HttpResponse(status=404)
 
-            return self._generate_master_playlist(pk, base_dir)
+            return self._generate_master_playlist(pk, base_dir, movie)
         else:
+            if resolution not in ALL_RENDITIONS:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            get_engine().demand(pk, resolution)
             return self._generate_media_playlist(pk, base_dir, resolution, movie)
 
-    def _generate_master_playlist(self, pk, base_dir):
+    def _engine_snapshot(self, pk):
+        """Latest pipeline snapshot from the torrent engine, or None when it has none (or is down)."""
+        try:
+            movie_id = int(pk)
+        except (TypeError, ValueError):
+            return None
+        try:
+            return get_engine().status(movie_id=movie_id)["snapshot"]
+        except TorrentdError:
+            return None
+
+    def _headroom(self):
+        try:
+            return get_engine().stats()["headroom"]
+        except TorrentdError:
+            return False
+
+    def _contiguous_segments(self, rdir):
+        """Number of published segments from segment_000 onwards without a gap."""
+        return len(contiguous_durations(rdir))
+
+    def _generate_master_playlist(self, pk, base_dir, movie):
         """
         Scans for resolution folders (1080p, 720p, etc) in /media/movies/{id}/
+        Only renditions that can keep up are advertised: finished ones, ones
+        being produced alongside the leading rendition, and (in JIT mode, when
+        the node has spare ffmpeg slots) ones that can be encoded on request.
+        The stream-copied rung is never on request: its segments are cut at
+        keyframes the index may not cover yet. Rungs the pipeline dropped
+        under load are left out until they are produced again.
         """
-        resolutions = ["1080p", "720p", "480p", "360p"]
-        found_res = []
+        lag_allowance = 2
+        complete = []
+        frontier = {}
+        ladder = source_ladder(pk)
 
-        for r in resolutions:
+        for r in ladder.renditions:
             rdir = os.path.join(base_dir, r)
             if not os.path.isdir(rdir):
                 continue
-            static_pl = os.path.join(rdir, 'index.m3u8')
-            has_static = os.path.exists(static_pl)
-            has_segments = False
-            try:
-                has_segments = any(name.startswith('segment_') and name.endswith('.ts') for name in os.listdir(rdir))
-            except Exception:
-                has_segments = False
-            if has_static or has_segments:
-                found_res.append(r)
-        
-        if not found_res:
+            if os.path.exists(os.path.join(rdir, 'index.m3u8')):
+                complete.append(r)
+            else:
+                frontier[r] = self._contiguous_segments(rdir)
+
+        if not complete and not any(frontier.values()):
              return Response({"status": "pending"}, status=status.HTTP_404_NOT_FOUND)
 
+        leading = max(frontier.values(), default=0)
+        on_demand = HLS_JIT and movie.duration and self._headroom()
+        producing = None
+        if frontier:
+            producing = (self._engine_snapshot(pk) or {}).get('producing')
+        found_res = [
+            r for r in ladder.renditions
+            if r in complete
+            or (
+                r in frontier and frontier[r] > 0 and frontier[r] >= leading - lag_allowance
+                and (not producing or r in producing)
+            )
+            or (on_demand and r != ladder.copy)
+        ]
+
         content = ["#EXTM3U", "#EXT-X-VERSION:3"]
-        
+
+        # Shared audio group: every video rendition references the same audio playlist
+        audio_group = ""
+        if ladder.audio:
+            adir = os.path.join(base_dir, AUDIO_RENDITION)
+            if (
+                os.path.exists(os.path.join(adir, 'index.m3u8'))
+                or self._contiguous_segments(adir) > 0
+                or on_demand
+            ):
+                audio_group = ',AUDIO="aud"'
+                content.append(
+                    '#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="Default",DEFAULT=YES,AUTOSELECT=YES,'
+                    f'URI="/api/video/{pk}/playlist/?res={AUDIO_RENDITION}"'
+                )
+
         for res in found_res:
-            bw = self._get_bandwidth(res)
-            res_dim = self._get_res_dim(res)
-            content.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bw},RESOLUTION={res_dim},NAME="{res}"')
+            bw = ladder.bandwidth.get(res) or self._get_bandwidth(res)
+            if audio_group:
+                bw += AUDIO_BANDWIDTH
+            res_dim = ladder.dims.get(res) or self._get_res_dim(res)
+            content.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bw},RESOLUTION={res_dim},NAME="{res}"{audio_group}')
             content.append(f'/api/video/{pk}/playlist/?res={res}')
 
         return HttpResponse("\n".join(content), content_type="application/vnd.apple.mpegurl")
@@ -358,7 +183,12 @@ class VideoViewSet(viewsets.ViewSet):
         Generates segment list for a specific resolution folder.
         """
         target_dir = os.path.join(base_dir, resolution)
-        
+
+        # The copy rung's segments last from keyframe to keyframe: only its journal knows them
+        on_demand = HLS_JIT and movie.duration and movie.file_path and resolution != source_ladder(pk).copy
+        if on_demand and not os.path.exists(target_dir):
+            return self._generate_full_playlist(pk, resolution, movie.duration)
+
         if not os.path.exists(target_dir):
             return Response(status=status.HTTP_404_NOT_FOUND)
 
@@ -367,10 +197,17 @@ class VideoViewSet(viewsets.ViewSet):
         if os.path.exists(static_pl):
             try:
                 lines = []
+                media_url = f"/media/movies/{pk}/{resolution}"
                 with open(static_pl, 'r') as f:
                     for line in f.read().splitlines():
-                        if not line or line.startswith('#'):
+                        if line.startswith('#EXT-X-MAP:'):
+                            # CMAF init segment: fetched by the player straight from nginx
+                            lines.append(cmaf_map_re.sub(lambda m: f'URI="{media_url}/{m.group(1)}"', line))
+                        elif not line or line.startswith('#'):
                             lines.append(line)
+                        elif line.strip().endswith('.m4s'):
+                            # CMAF single file: byte ranges are served by nginx, no Django hop per segment
+                            lines.append(f"{media_url}/{line.strip()}")
                         else:
                             # rewrite segment filename to our stream_ts route
                             seg = line.strip()
@@ -379,25 +216,19 @@ class VideoViewSet(viewsets.ViewSet):
             except Exception:
                 pass
 
-        found = []
-        pattern = re.compile(r"^segment_(\d+)\.ts$")
-        try:
-            for f in os.listdir(target_dir):
-                match = pattern.match(f)
-                if match:
-                    found.append((int(match.group(1)), f))
-        except:
-            return Response(status=status.HTTP_404_NOT_FOUND)
+        if on_demand:
+            return self._generate_full_playlist(pk, resolution, movie.duration)
 
-        if not found:
+        # Only the gap-free run from segment 0: a lazily started rendition
+        # must not have its later segments mapped onto the start of the film.
+        # Served from the transcoder's journal, with real durations.
+        durations = contiguous_durations(target_dir)
+        if not durations:
              return Response(status=status.HTTP_404_NOT_FOUND)
 
-        found.sort(key=lambda x: x[0])
-        segments = [x[1] for x in found]
-
         is_finished = movie.download_status == 'READY'
         pl_type = "VOD" if is_finished else "EVENT"
-        seg_len = 10
+        seg_len = max(VideoService().segment_duration, math.ceil(max(durations)))
 
         content = [
             "#EXTM3U",
@@ -407,27 +238,71 @@ class VideoViewSet(viewsets.ViewSet):
             f"#EXT-X-PLAYLIST-TYPE:{pl_type}"
         ]
 
-        for seg in segments:
-            content.append(f"#EXTINF:{seg_len}.0,")
-            content.append(f"/api/video/{pk}/stream_ts/?file={seg}&res={resolution}")
+        for idx, seg_duration in enumerate(durations):
+            content.append(f"#EXTINF:{seg_duration:.3f},")
+            content.append(f"/api/video/{pk}/stream_ts/?file=segment_{idx:03d}.ts&res={resolution}")
 
         if is_finished:
             content.append("#EXT-X-ENDLIST")
 
         return HttpResponse("\n".join(content), content_type="application/vnd.apple.mpegurl")
 
+    def _generate_full_playlist(self, pk, resolution, duration):
+        """
+        JIT mode: advertise every segment of the film from its probed length.
+        Segments that do not exist yet are produced when stream_ts asks for them.
+        """
+        service = VideoService()
+        seg_len = service.segment_duration
+        total = service.expected_segments(duration)
+
+        content = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{seg_len}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+            "#EXT-X-PLAYLIST-TYPE:VOD",
+        ]
+        for idx in range(total):
+            seg_duration = min(seg_len, duration - idx * seg_len)
+            content.append(f"#EXTINF:{max(seg_duration, 0.1):.3f},")
+            content.append(f"/api/video/{pk}/stream_ts/?file=segment_{idx:03d}.ts&res={resolution}")
+        content.append("#EXT-X-ENDLIST")
+
+        return HttpResponse("\n".join(content), content_type="application/vnd.apple.mpegurl")
+
     @action(detail=True, methods=['get'])
     def stream_ts(self, request, pk=None):
         """
         Serves the .ts file via Nginx X-Accel-Redirect.
         URL: .../stream_ts/?file=segment_001.ts&res=720p
+        In JIT mode a missing segment is transcoded on the spot; the request is
+        held for up to JIT_WAIT_SECONDS before answering 503 + Retry-After.
         """
         file_name = request.query_params.get('file')
         res = request.query_params.get('res', '720p')
 
-        if not file_name or '..' in file_name: 
+        if not file_name or '..' in file_name or res not in ALL_RENDITIONS:
             return HttpResponse(status=400)
 
+        get_engine().demand(pk, res)
+        match = segment_re.match(file_name)
+        disk_path = os.path.join(settings.MEDIA_ROOT, 'movies', str(pk), res, file_name)
+        if HLS_JIT and match and not os.path.exists(disk_path):
+            movie = get_object_or_404(MovieFile, pk=pk)
+            if not movie.duration or not movie.file_path:
+                return HttpResponse(status=404)
+            try:
+                ready = get_engine().prioritize(pk, int(match.group(1)), JIT_WAIT_SECONDS, res=res)
+            except TorrentdError as e:
+                logger.warning(f"JIT request for movie={pk} failed: {e}")
+                ready = False
+            # The job may have succeeded without producing this rendition: never redirect to a missing file
+            if not ready or not os.path.exists(disk_path):
+                response = HttpResponse(status=503)
+                response['Retry-After'] = '2'
+                return response
+
         nginx_path = os.path.join('/media', 'movies', str(pk), res, file_name)
 
         response = HttpResponse()
@@ -457,39 +332,28 @@ class VideoViewSet(viewsets.ViewSet):
         """
         Report current movie status with swarm info; optionally cleanup on error.
         Query param: cleanup=1 to remove torrent handle if status=ERROR.
+        Answered from the pipeline's snapshot when the torrent engine runs it.
         """
+        snapshot = self._engine_snapshot(pk)
+        if snapshot is not None:
+            return self._snapshot_status(pk, snapshot, request.query_params.get('cleanup') == '1')
+
         try:
             movie = get_object_or_404(MovieFile, pk=pk)
             base_dir = os.path.join(settings.MEDIA_ROOT, 'movies', str(pk))
-            handle = None
             seeds = peers = 0
             down_kbps = 0.0
-            try:
-                handle_id = str(hash(movie.magnet_link)) if movie.magnet_link else None
-                if handle_id:
-                    handle = torrent_manager.get_handle(handle_id)
-                if handle and handle.is_valid():
-                    st = handle.status()
-                    seeds = getattr(st, 'num_seeds', 0)
-                    peers = getattr(st, 'num_peers', 0)
-                    down_kbps = round(getattr(st, 'download_rate', 0) / 1000.0, 1)
-            except Exception:
-                pass
 
             # Check variants readiness
             variants = {}
-            for r in ("1080p", "720p", "480p", "360p"):
+            ladder = source_ladder(pk)
+            for r in ladder.renditions + ([AUDIO_RENDITION] if ladder.audio else []):
                 rdir = os.path.join(base_dir, r)
                 static_pl = os.path.join(rdir, 'index.m3u8')
-                segs = 0
-                try:
-                    if os.path.isdir(rdir):
-                        segs = sum(1 for name in os.listdir(rdir) if name.startswith('segment_') and name.endswith('.ts'))
-                except Exception:
-                    pass
                 variants[r] = {
                     "static_playlist": os.path.exists(static_pl),
-                    "segments": segs,
+                    # From the transcoder's journal: CMAF renditions have no segment files to count
+                    "segments": len(read_manifest(rdir)),
                 }
 
             problem = None
@@ -501,9 +365,8 @@ class VideoViewSet(viewsets.ViewSet):
             # Optional cleanup on explicit request when in error
             if problem == 'error' and request.query_params.get('cleanup') == '1':
                 try:
-                    handle_id = str(hash(movie.magnet_link)) if movie.magnet_link else None
-                    if handle_id:
-                        torrent_manager.remove_torrent(handle_id)
+                    if movie.magnet_link:
+                        get_engine().remove(magnet_info_hash(movie.magnet_link))
                         logger.info(f"Cleanup: removed torrent handle for movie={movie.id}")
                 except Exception as e:
                     logger.warning(f"Cleanup failed for movie={movie.id}: {e}")
@@ -523,10 +386,107 @@ class VideoViewSet(viewsets.ViewSet):
             logger.error(f"status endpoint error: {e}")
             return Response({"error": "Internal error"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    def _snapshot_status(self, pk, snapshot, cleanup):
+        variants = snapshot.get("variants", {})
+        swarm = snapshot.get("swarm", {"seeds": 0, "peers": 0, "down_kbps": 0.0})
+
+        problem = None
+        if snapshot.get("status") == 'ERROR':
+            problem = 'error'
+        elif (swarm["seeds"] + swarm["peers"]) == 0 and not any(v["segments"] > 0 for v in variants.values()):
+            problem = 'no-peers'
+
+        if problem == 'error' and cleanup and snapshot.get("info_hash"):
+            try:
+                get_engine().remove(snapshot["info_hash"])
+                logger.info(f"Cleanup: removed torrent handle for movie={pk}")
+            except Exception as e:
+                logger.warning(f"Cleanup failed for movie={pk}: {e}")
+
+        return Response({
+            "id": int(pk),
+            "status": snapshot.get("status"),
+            "progress": snapshot.get("progress"),
+            "swarm": swarm,
+            "variants": variants,
+            "problem": problem,
+        }, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=["get"], url_path="scheduler")
+    def scheduler(self, request):
+        """
+        Transcode scheduler state: slot budget, queue depth per priority,
+        running jobs and recent queue wait times, as seen by the torrent engine.
+        """
+        try:
+            return Response(get_engine().stats(), status=status.HTTP_200_OK)
+        except TorrentdError as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    @action(detail=False, methods=["get"], url_path="metrics")
+    def metrics(self, request):
+        """
+        Prometheus scrape target: active torrents, swarm peers/seeds and download
+        rate, segment encode time and realtime factor, transcode backlog,
+        ffmpeg failures by cause and time spent in each pipeline phase.
+        """
+        try:
+            return HttpResponse(get_engine().metrics(), content_type=METRICS_CONTENT_TYPE)
+        except TorrentdError as e:
+            return HttpResponse(f"# torrent engine unavailable: {e}\n", status=503, content_type=METRICS_CONTENT_TYPE)
+
+    @action(detail=True, methods=["get"], url_path="timeline")
+    def timeline(self, request, pk=None):
+        """
+        Debug: spans of the movie's latest pipeline run (phases, ffprobe,
+        segment encodes, finalization, DB flushes) in seconds from its start.
+        """
+        try:
+            timeline = get_engine().timeline(movie_id=pk)
+        except TorrentdError as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except (TypeError, ValueError):
+            return Response({"error": "Invalid movie id"}, status=status.HTTP_400_BAD_REQUEST)
+        if timeline is None:
+            return Response({"error": "No timeline for this movie"}, status=status.HTTP_404_NOT_FOUND)
+        return Response(timeline, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=["get"], url_path="timelines")
+    def timelines(self, request):
+        """Debug: one summary per recently run pipeline, newest first."""
+        try:
+            return Response(get_engine().timeline(), status=status.HTTP_200_OK)
+        except TorrentdError as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+    @action(detail=False, methods=["get"], url_path="profile")
+    def profile(self, request):
+        """
+        Debug: sample the torrent engine's Python stacks for ?seconds=N (default 10)
+        and return them collapsed, ready for flamegraph.pl or speedscope.
+        ?movie=<id> keeps only the threads working for that movie.
+        Requires PIPELINE_PROFILER=1 on the engine.
+        """
+        try:
+            seconds = min(float(request.query_params.get('seconds', 10)), PROFILE_MAX_SECONDS)
+            movie_id = request.query_params.get('movie')
+            movie_id = int(movie_id) if movie_id else None
+        except ValueError:
+            return Response({"error": "Invalid seconds or movie"}, status=status.HTTP_400_BAD_REQUEST)
+        if seconds <= 0:
+            return Response({"error": "seconds must be positive"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            stacks = get_engine().profile(seconds, movie_id=movie_id)
+        except TorrentdError as e:
+            return Response({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        if stacks is None:
+            return Response({"error": "Profiler disabled (set PIPELINE_PROFILER=1)"}, status=status.HTTP_403_FORBIDDEN)
+        return HttpResponse(stacks, content_type="text/plain; charset=utf-8")
+
     @action(detail=True, methods=["post"], url_path="start")
     def start_stream(self, request, pk=None):
         """
-        Start movie download and processing (Threading).
+        Start movie download and processing (driven by the torrent supervisor).
         """
         magnet_link = request.data.get("magnet_link")
         imdb_id = request.data.get("imdb_id")
@@ -552,10 +512,18 @@ class VideoViewSet(viewsets.ViewSet):
                 "id": movie_file.id
             })
 
+        try:
+            started = get_engine().add(movie_file.id)["started"]
+        except TorrentdError as e:
+            logger.error(f"Could not start movie={movie_file.id}: {e}")
+            return Response({"error": "Torrent engine unavailable"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        thread = threading.Thread(target=process_video_thread, args=(movie_file.id,))
-        thread.daemon = True
-        thread.start()
+        if not started:
+            return Response({
+                "status": movie_file.download_status, 
+                "progress": movie_file.download_progress, 
+                "id": movie_file.id
+            })
 
         return Response({
             "status": "PENDING", 
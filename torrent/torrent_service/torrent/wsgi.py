@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'torrent.settings')
 
 application = get_wsgi_application()
+
+# In embedded mode the web process owns the torrents, so it also resumes
+# downloads a previous server process left unfinished (torrentd does this otherwise)
+from stream.engine import TORRENT_BACKEND, get_engine  # noqa: E402
+from stream.recovery import schedule_recovery  # noqa: E402
+
+if TORRENT_BACKEND == "embedded":
+    schedule_recovery(get_engine())